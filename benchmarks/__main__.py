@@ -0,0 +1,146 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess  # nosec B404
+import sys
+import time
+
+from benchmarks import datasets
+from benchmarks.runner import SRC_PATH, STORAGES, TARGETS, build_cases, report, run_cases
+from benchmarks.standins import NotifierStandIn, S3StandIn, SFTPStandIn
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()  # nosec B603 B607
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {(result['name'], result['iteration']): result for result in json.load(f)['results']}
+    report('\n%-60s %10s %10s %8s' % ('case', 'before', 'after', 'change'))
+    for result in results:
+        before = baseline.get((result['name'], result['iteration']))
+        if before is None or 'mb_per_s' not in before or 'mb_per_s' not in result:
+            continue
+        report('%-60s %10.1f %10.1f %+7.1f%%' % (
+            '%s #%s' % (result['name'], result['iteration']),
+            before['mb_per_s'], result['mb_per_s'], (result['mb_per_s'] / before['mb_per_s'] - 1) * 100,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description="Benchmark every target x storage combination against local stand-ins "
+                    "(temp directory, in-process SFTP, moto or MinIO S3, fake Slack/Telegram API).",
+    )
+    parser.add_argument('--workdir', default='/tmp/backup-benchmarks')
+    parser.add_argument('--scale', type=float, default=1.0, help="dataset size factor (1.0 = 2000 small files, 2 x 256 MiB files, a 256 MiB SQL dump)")
+    parser.add_argument('--targets', default=','.join(TARGETS))
+    parser.add_argument('--storages', default=','.join(STORAGES))
+    parser.add_argument('--compression', default='none', help="comma separated codecs, e.g. none,gzip,zstd")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=1800)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help="results JSON of an earlier run to compare MB/s against")
+    parser.add_argument('--s3-endpoint', help="use this S3 endpoint (e.g. MinIO) instead of moto")
+    parser.add_argument('--s3-access-key', default='bench')
+    parser.add_argument('--s3-secret-key', default='bench')
+    parser.add_argument('--s3-bucket', default='backup-benchmarks')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    sys.path.insert(0, SRC_PATH)
+    workdir = os.path.abspath(args.workdir)
+    report("Generating datasets in %s ..." % workdir)
+    data = datasets.generate(os.path.join(workdir, 'data'), args.scale)
+    datasets.install_fake_pg_dump(os.path.join(workdir, 'bin'), data['sql-dump']['path'])
+
+    requested = args.storages.split(',')
+    out_dir = os.path.join(workdir, 'out')
+    storages = {}
+    standins = []
+    s3_client = None
+    if 'local' in requested:
+        storages['local'] = {'type': 'local', 'params': {'backup_path': os.path.join(out_dir, 'local')}}
+    if 'sftp' in requested:
+        sftp = SFTPStandIn()
+        standins.append(sftp)
+        storages['sftp'] = {'type': 'remote', 'params': {
+            'ssh_username': 'bench', 'ssh_password': 'bench', 'ssh_host': '127.0.0.1', 'ssh_port': sftp.port,
+            'remote_dir_path': os.path.join(out_dir, 'sftp'),
+        }}
+    if 's3' in requested:
+        endpoint_url = args.s3_endpoint
+        if endpoint_url is None:
+            try:
+                s3 = S3StandIn()
+            except ImportError:
+                report("moto[server] is not installed and --s3-endpoint was not given, skipping S3")
+                s3 = None
+            if s3 is not None:
+                standins.append(s3)
+                endpoint_url = s3.endpoint_url
+        if endpoint_url is not None:
+            import boto3
+            s3_client = boto3.client(
+                's3', endpoint_url=endpoint_url, region_name='us-east-1',
+                aws_access_key_id=args.s3_access_key, aws_secret_access_key=args.s3_secret_key,
+            )
+            with contextlib.suppress(s3_client.exceptions.BucketAlreadyOwnedByYou):
+                s3_client.create_bucket(Bucket=args.s3_bucket)
+            storages['s3'] = {'type': 'aws', 'params': {
+                'aws_bucket_name': args.s3_bucket, 'aws_region': 'us-east-1',
+                'aws_access_key_id': args.s3_access_key, 'aws_secret_access_key': args.s3_secret_key,
+                'endpoint_url': endpoint_url,
+            }}
+
+    notifier = NotifierStandIn()
+    standins.append(notifier)
+    notifiers = [
+        {'type': 'slack', 'params': {'slack_channels': ['#bench'], 'slack_api_token': 'bench', 'api_url': notifier.url + '/api'}},
+        {'type': 'telegram', 'params': {'chat_ids': ['1'], 'bot_token': 'bench', 'api_url': notifier.url}},
+    ]
+
+    def cleanup():
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(os.path.join(out_dir, 'local'), exist_ok=True)
+        os.makedirs(os.path.join(out_dir, 'sftp'), exist_ok=True)
+        if s3_client is not None:
+            for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=args.s3_bucket):
+                keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+                if keys:
+                    s3_client.delete_objects(Bucket=args.s3_bucket, Delete={'Objects': keys})
+
+    cases = build_cases(data, storages, args.targets.split(','), args.compression.split(','), notifiers)
+    started_at = time.time()
+    try:
+        results = run_cases(cases, workdir, args.repeat, args.timeout, cleanup, args.log_level)
+    finally:
+        for standin in standins:
+            standin.close()
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': get_commit(),
+            'started_at': started_at,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scale': args.scale,
+            'datasets': data,
+            'results': results,
+        }, f, indent=2)
+    report("Results written to %s" % args.output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
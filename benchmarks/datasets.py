@@ -0,0 +1,111 @@
+import os
+import random
+import stat
+from typing import Dict
+
+# Half of every generated block is random and half is repeated text, so the
+# data compresses roughly like real application files instead of either not
+# at all (pure random) or perfectly (zeros).
+DATASET_BLOCK_SIZE = 64 * 1024
+
+
+def get_block(rng: random.Random) -> bytes:
+    half = DATASET_BLOCK_SIZE // 2
+    text = (b'lorem ipsum dolor sit amet %d ' % rng.randrange(1000)) * (half // 30 + 1)
+    return rng.randbytes(half) + text[:half]
+
+
+def write_file(path: str, size: int, rng: random.Random):
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            block = get_block(rng)[:left]
+            f.write(block)
+            left -= len(block)
+
+
+def generate_small_files(path: str, count: int, size: int, seed: int = 0) -> int:
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    for index in range(count):
+        directory = os.path.join(path, 'd%03d' % (index // 100))
+        os.makedirs(directory, exist_ok=True)
+        write_file(os.path.join(directory, 'f%05d.bin' % index), rng.randint(size // 2, size * 3 // 2), rng)
+    return get_size(path)
+
+
+def generate_huge_files(path: str, count: int, size: int, seed: int = 0) -> int:
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    for index in range(count):
+        write_file(os.path.join(path, 'huge%02d.bin' % index), size, rng)
+    return get_size(path)
+
+
+def generate_sql_dump(path: str, size: int, seed: int = 0) -> int:
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('CREATE TABLE events (id bigint, user_id bigint, kind text, payload text, created_at timestamptz);\n')
+        f.write('COPY events (id, user_id, kind, payload, created_at) FROM stdin;\n')
+        written, row = 0, 0
+        kinds = ('click', 'view', 'purchase', 'login')
+        while written < size:
+            lines = ''.join(
+                '%d\t%d\t%s\t%s\t2024-01-%02d 12:%02d:%02d+00\n' % (
+                    row + index, rng.randrange(100000), kinds[index % 4],
+                    rng.randbytes(24).hex(), index % 28 + 1, index % 60, rng.randrange(60),
+                )
+                for index in range(10000)
+            )
+            f.write(lines)
+            written += len(lines)
+            row += 10000
+        f.write('\\.\n')
+    return os.path.getsize(path)
+
+
+def get_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for current, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(current, filename))
+    return total
+
+
+def install_fake_pg_dump(bin_dir: str, sql_path: str) -> str:
+    # Replays a generated SQL dump, for plain and custom formats alike; the
+    # benchmark measures the backup pipeline, not PostgreSQL.
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, 'pg_dump')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n'
+                'out=""; prev=""\n'
+                'for arg in "$@"; do [ "$prev" = "-f" ] && out="$arg"; prev="$arg"; done\n'
+                'if [ -n "$out" ]; then exec cat "%s" > "$out"; fi\n'
+                'exec cat "%s"\n' % (sql_path, sql_path))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def generate(root: str, scale: float = 1.0) -> Dict[str, dict]:
+    # Sizes at scale 1: 2000 small files of ~16 KiB, 2 files of 256 MiB and a
+    # 256 MiB SQL dump.
+    datasets = {}
+    small = os.path.join(root, 'small-files')
+    if not os.path.exists(small):
+        generate_small_files(small, max(int(2000 * scale), 1), 16 * 1024)
+    datasets['small-files'] = {'path': small, 'bytes': get_size(small)}
+
+    huge = os.path.join(root, 'huge-files')
+    if not os.path.exists(huge):
+        generate_huge_files(huge, 2, max(int(256 * 1024 * 1024 * scale), DATASET_BLOCK_SIZE))
+    datasets['huge-files'] = {'path': huge, 'bytes': get_size(huge)}
+
+    sql = os.path.join(root, 'dump.sql')
+    if not os.path.exists(sql):
+        generate_sql_dump(sql, max(int(256 * 1024 * 1024 * scale), DATASET_BLOCK_SIZE))
+    datasets['sql-dump'] = {'path': sql, 'bytes': get_size(sql)}
+    return datasets
@@ -0,0 +1,209 @@
+import contextlib
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import time
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+TARGETS = ('file', 'directory', 'directory-dedup', 'postgresql', 'postgresql-streaming')
+STORAGES = ('local', 'sftp', 's3')
+
+# Datasets every target kind is benchmarked with.
+TARGET_DATASETS = {
+    'file': ('huge-files',),
+    'directory': ('small-files', 'huge-files'),
+    'directory-dedup': ('small-files', 'huge-files'),
+    'postgresql': ('sql-dump',),
+    'postgresql-streaming': ('sql-dump',),
+}
+
+
+def build_target_config(target: str, dataset: dict) -> dict:
+    if target == 'file':
+        return {'type': 'file', 'params': {'filepath': os.path.join(dataset['path'], 'huge00.bin')}}
+    if target in ('directory', 'directory-dedup'):
+        params = {'dirpath': dataset['path']}
+        if target == 'directory-dedup':
+            params['mode'] = 'dedup'
+        return {'type': 'directory', 'params': params}
+    return {
+        'type': 'postgresql',
+        'params': {
+            'postgres_host': '127.0.0.1',
+            'postgres_port': '5432',
+            'postgres_db': 'bench',
+            'postgres_user': 'bench',
+            'postgres_password': 'bench',
+            'streaming': target == 'postgresql-streaming',
+        },
+    }
+
+
+def get_dataset_bytes(target: str, dataset: dict) -> int:
+    if target == 'file':
+        return os.path.getsize(os.path.join(dataset['path'], 'huge00.bin'))
+    return dataset['bytes']
+
+
+def reset_peak_rss() -> bool:
+    # Writing 5 to clear_refs resets VmHWM to the current RSS (Linux 4.0+),
+    # so the peak excludes whatever was touched before the backup started.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_rss_kb(field: str) -> int | None:
+    with contextlib.suppress(OSError), open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return None
+
+
+def run_case(case: dict, queue: multiprocessing.Queue):
+    # Runs in a freshly spawned interpreter so that CPU time only covers this
+    # backup (and its pg_dump / compressor children). Peak RSS is measured
+    # from just before the backup, after the imports and the target build.
+    sys.path.insert(0, SRC_PATH)
+    os.environ['PATH'] = '%s:%s' % (case['bin_dir'], os.environ.get('PATH', ''))
+    logging.basicConfig(level=case['log_level'])
+
+    from utils.builders import TargetBuilder
+    from utils.environment import Environment
+
+    environment = Environment()
+    environment.APP_NAME = 'bench'  # type: ignore
+    environment.STATE_DIR = case['state_dir']  # type: ignore
+    try:
+        target = TargetBuilder(case['config'], environment, case['name']).build()
+        peak_reset = reset_peak_rss()
+        rss_before = get_rss_kb('VmRSS')
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started_at = time.perf_counter()
+        target.backup()
+        seconds = time.perf_counter() - started_at
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        peak_rss = get_rss_kb('VmHWM') if peak_reset else None
+    except Exception as e:
+        queue.put({'error': '%s: %s' % (type(e).__name__, e)})
+        return
+
+    queue.put({
+        'seconds': seconds,
+        'cpu_user': self_after.ru_utime - self_before.ru_utime,
+        'cpu_system': self_after.ru_stime - self_before.ru_stime,
+        'cpu_children': (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime),
+        # Without clear_refs this falls back to ru_maxrss, which includes the
+        # interpreter start-up. Both are in KiB on Linux.
+        'peak_rss_mb': (peak_rss if peak_rss is not None else self_after.ru_maxrss) / 1024,
+        'rss_before_mb': rss_before / 1024 if rss_before is not None else None,
+        'peak_rss_children_mb': children_after.ru_maxrss / 1024,
+    })
+
+
+def measure(case: dict, timeout: float) -> dict:
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(case, queue))
+    process.start()
+    process.join(timeout)
+    if process.is_alive():
+        process.kill()
+        process.join()
+        return {'error': 'timeout after %s seconds' % timeout}
+    if queue.empty():
+        return {'error': 'benchmark process exited with %s' % process.exitcode}
+    return queue.get()
+
+
+def build_cases(
+    datasets: Dict[str, dict],
+    storages: Dict[str, dict],
+    targets: List[str],
+    compressions: List[str],
+    notifiers: List[dict],
+) -> List[dict]:
+    cases = []
+    for target in targets:
+        for dataset_name in TARGET_DATASETS[target]:
+            for storage_name, storage_config in storages.items():
+                for compression in compressions:
+                    if target == 'directory-dedup' and compression != 'none':
+                        # Dedup chunks are stored uncompressed.
+                        continue
+                    config = {
+                        'target': build_target_config(target, datasets[dataset_name]),
+                        'storages': [storage_config],
+                        'notifiers': notifiers,
+                    }
+                    if compression != 'none':
+                        config['compression'] = {'codec': compression}
+                    cases.append({
+                        'name': '%s-%s-%s-%s' % (target, dataset_name, storage_name, compression),
+                        'target': target,
+                        'dataset': dataset_name,
+                        'storage': storage_name,
+                        'compression': compression,
+                        'bytes': get_dataset_bytes(target, datasets[dataset_name]),
+                        'config': config,
+                    })
+    return cases
+
+
+def run_cases(cases: List[dict], workdir: str, repeat: int, timeout: float, cleanup, log_level: str) -> List[dict]:
+    results = []
+    for case in cases:
+        state_dir = os.path.join(workdir, 'state', case['name'])
+        # Warm dedup iterations are incremental: they keep the chunk index in
+        # the state directory and the chunks it lists in the storages. Every
+        # other iteration starts with both empty, so neither goes stale.
+        incremental = case['target'] == 'directory-dedup'
+        for iteration in range(repeat):
+            if iteration == 0 or not incremental:
+                cleanup()
+                shutil.rmtree(state_dir, ignore_errors=True)
+            measured = measure({
+                **case,
+                'state_dir': state_dir,
+                'bin_dir': os.path.join(workdir, 'bin'),
+                'log_level': log_level,
+            }, timeout)
+            result = {key: case[key] for key in ('name', 'target', 'dataset', 'storage', 'compression', 'bytes')}
+            result['iteration'] = iteration
+            result.update(measured)
+            if 'seconds' in measured:
+                result['mb_per_s'] = case['bytes'] / 1024 / 1024 / measured['seconds']
+            results.append(result)
+            report(format_result(result))
+    cleanup()
+    return results
+
+
+def report(text: str):
+    # All progress and result lines go through here, flushed so they show up
+    # while the spawned cases are still running.
+    sys.stdout.write(text + '\n')
+    sys.stdout.flush()
+
+
+def format_result(result: dict) -> str:
+    if 'error' in result:
+        return '%-60s #%s  ERROR %s' % (result['name'], result['iteration'], result['error'])
+    return '%-60s #%s  %8.1f MB/s  %7.2f s  cpu %6.2f s (+%6.2f s children)  rss %6.1f MB' % (
+        result['name'], result['iteration'], result['mb_per_s'], result['seconds'],
+        result['cpu_user'] + result['cpu_system'], result['cpu_children'], result['peak_rss_mb'],
+    )
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+
+class SFTPServerHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class LocalSFTPInterface(paramiko.SFTPServerInterface):
+    # Maps SFTP requests 1:1 onto the local filesystem.
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_APPEND:
+            mode = 'ab'
+        elif flags & os.O_RDWR:
+            mode = 'r+b'
+        elif flags & os.O_WRONLY:
+            mode = 'wb'
+        else:
+            mode = 'rb'
+        handle = SFTPServerHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name) for name in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def mkdir(self, path, attr):
+        return self.call(os.mkdir, path)
+
+    def remove(self, path):
+        return self.call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self.call(os.rename, oldpath, newpath)
+
+    posix_rename = rename
+
+    @staticmethod
+    def call(func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class PasswordServer(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class SFTPStandIn:
+    # In-process SFTP server on 127.0.0.1 accepting any password.
+
+    def __init__(self):
+        # Clients of finished benchmark processes just drop their connection.
+        logging.getLogger('paramiko.transport').setLevel(logging.CRITICAL)
+        self.key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(64)
+        self.port = self.socket.getsockname()[1]
+        self.transports: List[paramiko.Transport] = []
+        threading.Thread(target=self.serve, name='sftp-standin', daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTPInterface)
+            transport.start_server(server=PasswordServer())
+            self.transports.append(transport)
+
+    def close(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class S3StandIn:
+    # moto's S3 server in a background thread. moto is only needed for the
+    # benchmarks; without it, pass --s3-endpoint to use e.g. a local MinIO.
+
+    def __init__(self):
+        from moto.server import ThreadedMotoServer
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.server = ThreadedMotoServer(ip_address='127.0.0.1', port=self.port, verbose=False)
+        self.server.start()
+        self.endpoint_url = 'http://127.0.0.1:%s' % self.port
+
+    def close(self):
+        self.server.stop()
+
+
+class NotifierRequestHandler(BaseHTTPRequestHandler):
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.server.requests += 1  # type: ignore
+        body = json.dumps({'ok': True, 'result': {}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NotifierStandIn:
+    # Answers every Slack and Telegram API call with {"ok": true}.
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), NotifierRequestHandler)
+        self.server.requests = 0  # type: ignore
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, name='notifier-standin', daemon=True).start()
+
+    @property
+    def requests(self) -> int:
+        return self.server.requests  # type: ignore
+
+    def close(self):
+        self.server.shutdown()
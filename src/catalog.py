@@ -0,0 +1,103 @@
+#!python
+
+
+import argparse
+import logging
+import sys
+from datetime import datetime, timezone
+
+import urllib3
+from utils.builders import TargetBuilder
+from utils.catalog import Catalog, get_catalog_path
+from utils.config import Config
+from utils.environment import Environment
+
+urllib3.disable_warnings()
+
+# Logging
+
+handler = logging.StreamHandler()
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter('[PID: %(process)d] - %(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+
+logging.basicConfig(level=logging.INFO, handlers=[handler])
+
+logger = logging.getLogger(__name__)
+
+
+def list_artifacts(catalog: Catalog, namespace: str | None, target):
+    for artifact in catalog.get_artifacts(target.get_catalog_namespace()):
+        sys.stdout.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (
+            namespace or '-',
+            datetime.fromtimestamp(artifact['created_at'], timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            artifact['size'] if artifact['size'] is not None else '-',
+            artifact['key'],
+            artifact['storage'],
+            artifact['checksum'] or '-',
+        ))
+
+
+def reconcile(catalog: Catalog, namespace: str | None, target):
+    for storage, stats in target.reconcile(catalog).items():
+        logger.info("Reconciled %s in %s: %s added, %s removed, %s kept" % (
+            namespace or '-', storage, stats['added'], stats['removed'], stats['kept'],
+        ))
+
+
+def prune(catalog: Catalog, namespace: str | None, target, dry_run: bool):
+    if target.retention is None:
+        logger.info("No retention configured for %s" % (namespace or '-'))
+        return
+    for storage, expired in target.prune(catalog, dry_run=dry_run).items():
+        for artifact in expired:
+            logger.info("%s %s from %s" % ('Would prune' if dry_run else 'Pruned', artifact['key'], storage))
+
+
+def verify(catalog: Catalog, namespace: str | None, target, samples: int) -> bool:
+    ok = True
+    for storage, report in target.verify(catalog, samples).items():
+        for key, error in report.items():
+            if error is None:
+                logger.info("Verified %s in %s" % (key, storage))
+            else:
+                logger.error("Verification of %s in %s failed: %s" % (key, storage, error))
+                ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and maintain the local backup catalog.")
+    parser.add_argument('command', choices=('list', 'reconcile', 'prune', 'verify'))
+    parser.add_argument('-n', '--namespace', action='append', help="only this namespace (repeatable)")
+    parser.add_argument('--dry-run', action='store_true', help="prune: only report what would be deleted")
+    parser.add_argument('--samples', type=int, default=2, help="verify: random parts read back per artifact")
+    args = parser.parse_args()
+
+    environment = Environment()
+    catalog = Catalog(get_catalog_path(environment.STATE_DIR))  # type: ignore
+    failed = False
+    try:
+        for namespace, builder_config in Config.load_namespaces(environment).items():
+            if args.namespace and namespace not in args.namespace:
+                continue
+            target = TargetBuilder(builder_config, environment, namespace).build()
+            try:
+                if args.command == 'list':
+                    list_artifacts(catalog, namespace, target)
+                elif args.command == 'reconcile':
+                    reconcile(catalog, namespace, target)
+                elif args.command == 'verify':
+                    failed = not verify(catalog, namespace, target, args.samples) or failed
+                else:
+                    prune(catalog, namespace, target, args.dry_run)
+            except Exception as e:
+                logger.error("%s of %s failed: %s" % (args.command, namespace or '-', e))
+                failed = True
+    finally:
+        catalog.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,71 +2,124 @@
 
 
 import logging
-import time
-from multiprocessing import Process
-from typing import List
+from typing import Dict, List
 
-import schedule
 import urllib3
-from services.cron import CronService
-from utils.builders import TargetBuilder
-from utils.config import Config
+from services.cluster import ClusterNode
+from services.cron import CronJob, CronService
+from services.metrics import MetricsExporter
+from services.workers import OVERLAP_SKIP, WorkerJob, WorkerPool, parse_resource_limits
+from utils.builders import TargetCache, build_lease_backend, run_backup
+from utils.config import ConfigStore
 from utils.environment import Environment
-from utils.targets.base import Target
+from utils.logs import start_log_listener
 
 urllib3.disable_warnings()
 
-# Logging
-
-handler = logging.StreamHandler()
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter('[PID: %(process)d] - %(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-
-logging.basicConfig(level=logging.INFO, handlers=[handler])
-
 logger = logging.getLogger(__name__)
 
 
-def backup(environment: Environment):
-    logger.info(">> Starting backup")
-
-    targets: List[Target] = []
-
+# How often BACKUP_CONFIG_FILE is checked for changes.
+CONFIG_RELOAD_CRON_EXPRESSION = '* * * * *'
+# Imported once by the forkserver (`__main__` as `__mp_main__`); workers are
+# forked from it with these already loaded.
+WORKER_PRELOAD_MODULES = ['__main__', 'utils.builders']
+
+
+def backup(environment: Environment, pool: WorkerPool | ClusterNode, store: ConfigStore, targets: TargetCache, namespaces: List[str] | None = None):
+    # Runs in the scheduler process: queues the backups of the namespaces
+    # that are due in the worker pool, which starts them as soon as a worker
+    # slot and all of their resources are free. In cluster mode `pool` is
+    # the ClusterNode, which queues a backup once this node holds its lease.
+    logger.info(">> Queue backup")
+
+    for namespace, builder_config in store.namespaces.items():
+        if namespaces is not None and namespace not in namespaces:
+            continue
+        target = targets.get(namespace)
+        if target.error is not None:
+            logger.error("Failed to build the target of namespace %s: %s", namespace, target.error)
+            continue
+        pool.submit(WorkerJob(
+            '%s (%s)' % (namespace, target.kind) if namespace is not None else target.kind,
+            run_backup,
+            args=(builder_config, environment, namespace),
+            resources=target.resources,
+            priority=builder_config.get('priority', 0),
+            deadline=builder_config.get('deadline'),
+            key=namespace,
+            overlap=builder_config.get('overlap', OVERLAP_SKIP),
+            lock_path=target.lock_path,
+            max_runtime=builder_config.get('max_runtime'),
+        ))
+
+
+def get_schedules(environment: Environment, store: ConfigStore) -> Dict[str, List[str]]:
+    # Namespaces without their own `cron` fall back to BACKUP_CRON_EXPRESSION.
+    # Namespaces sharing an expression are started together by one job.
+    schedules: Dict[str, List[str]] = {}
     if environment.USE_CONFIG == 'on':  # type: ignore
-        config = Config.load_config_from_string(environment.CONFIG)  # type: ignore
-        for namespace, builder_config in config.items():
-            target_builder = TargetBuilder(builder_config, environment, namespace)
-            targets.append(target_builder.build())
-    else:
-        config = Config.load_config_from_old_style()
-        target_builder = TargetBuilder(config, environment)
-        targets.append(target_builder.build())
-
-    processes: List[Process] = []
-    for target in targets:
-        process = Process(target=target.backup)
-        process.start()
-        if target.namespace is not None:
-            logger.info("Start target backup (PID: %s): %s (%s)" % (process.pid, type(target), target.namespace))
-        else:
-            logger.info("Start target backup (PID: %s): %s" % (process.pid, type(target),))
-        processes.append(process)
-
-    for process in processes:
-        process.join()
-
-    logger.info(">> Finished backup")
+        for namespace, builder_config in store.namespaces.items():
+            cron_expression = builder_config.get('cron') or environment.CRON_EXPRESSION  # type: ignore
+            if not cron_expression:
+                raise ValueError("No cron expression for namespace `%s`" % namespace)
+            schedules.setdefault(cron_expression, []).append(namespace)  # type: ignore
+    return schedules
+
+
+def schedule_backups(cron_service: CronService, environment: Environment, pool: WorkerPool | ClusterNode, store: ConfigStore, targets: TargetCache) -> List[CronJob]:
+    if environment.USE_CONFIG != 'on':  # type: ignore
+        return [cron_service.add_func(environment.CRON_EXPRESSION, backup, environment, pool, store, targets, spawn=False)]  # type: ignore
+    return [
+        cron_service.add_func(cron_expression, backup, environment, pool, store, targets, namespaces, name=', '.join(namespaces), spawn=False)
+        for cron_expression, namespaces in get_schedules(environment, store).items()
+    ]
+
+
+def reload_config(cron_service: CronService, environment: Environment, pool: WorkerPool | ClusterNode, store: ConfigStore, targets: TargetCache, jobs: List[CronJob]):
+    # Targets are described again on their next run; schedules are replaced
+    # at once.
+    if not store.reload():
+        return
+    for job in jobs:
+        cron_service.remove_func(job)
+    try:
+        jobs[:] = schedule_backups(cron_service, environment, pool, store, targets)
+    except ValueError as e:
+        logger.error("Failed to schedule the reloaded config: %s" % e)
+        jobs[:] = []
 
 
 if __name__ == '__main__':
     environment: Environment = Environment()
+    pool = WorkerPool(
+        environment.MAX_WORKERS,  # type: ignore
+        parse_resource_limits(environment.RESOURCE_LIMITS),  # type: ignore
+        environment.WORKER_START_METHOD,  # type: ignore
+        WORKER_PRELOAD_MODULES,
+    )
+    # Workers and the scheduler log through one listener in this process.
+    pool.log_queue = pool.context.Queue()
+    start_log_listener(pool.log_queue, environment.LOG_FORMAT, environment.LOG_LEVEL)  # type: ignore
+    store = ConfigStore(environment)
+    store.load()
+    targets = TargetCache(store, environment, pool.context)
     cron_service = CronService()
-
-    cron_service.add_func(environment.CRON_EXPRESSION, backup, environment)  # type: ignore
-
-    schedule.every(1).seconds.do(cron_service.run_pending)
-
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    pool.start()
+    MetricsExporter(environment).start()
+
+    # Cluster mode: nodes running the same config share the backups.
+    scheduler: WorkerPool | ClusterNode = pool
+    lease_backend = build_lease_backend(environment)
+    if lease_backend is not None:
+        scheduler = ClusterNode(lease_backend, pool, environment.CLUSTER_NODE_ID, environment.CLUSTER_LEASE_TTL)  # type: ignore
+        scheduler.start()
+
+    jobs = schedule_backups(cron_service, environment, scheduler, store, targets)
+    if environment.USE_CONFIG == 'on' and environment.CONFIG_FILE:  # type: ignore
+        cron_service.add_func(
+            CONFIG_RELOAD_CRON_EXPRESSION, reload_config, cron_service, environment, scheduler, store, targets, jobs,
+            name='config reload', spawn=False,
+        )
+
+    cron_service.run_forever()
@@ -0,0 +1,112 @@
+#!python
+
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+import urllib3
+from utils.builders import TargetBuilder
+from utils.catalog import Catalog, get_catalog_path
+from utils.config import Config
+from utils.environment import Environment
+from utils.storages.base import Storage
+from utils.targets.base import Target
+from utils.targets.postgresql_physical import PostgreSQLPhysicalTarget
+
+urllib3.disable_warnings()
+
+# Logging
+
+handler = logging.StreamHandler()
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter('[PID: %(process)d] - %(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+
+logging.basicConfig(level=logging.INFO, handlers=[handler])
+
+logger = logging.getLogger(__name__)
+
+
+def select_storage(target: Target, selector: str | None) -> Storage:
+    # By index in the namespace's `storages`, or by a part of its description.
+    if not target.storages:
+        raise ValueError("No storages configured")
+    if selector is None:
+        return target.storages[0]
+    if selector.isdigit():
+        return target.storages[int(selector)]
+    for storage in target.storages:
+        if selector in storage.describe():
+            return storage
+    raise ValueError("No storage matches `%s`" % selector)
+
+
+def parse_target_time(value: str) -> datetime:
+    # ISO 8601, UTC unless the value has an offset.
+    target_time = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return target_time if target_time.tzinfo is not None else target_time.replace(tzinfo=timezone.utc)
+
+
+def select_artifact(environment: Environment, target: Target, storage: Storage, from_listing: bool, before: float | None = None) -> str:
+    # The newest artifact (created before `before`) of the catalog, or of the
+    # storage listing when the catalog has none (e.g. on a fresh host).
+    if not from_listing:
+        catalog = Catalog(get_catalog_path(environment.STATE_DIR))  # type: ignore
+        try:
+            artifacts = catalog.get_artifacts(target.get_catalog_namespace(), storage.get_key())
+        finally:
+            catalog.close()
+        artifacts = [artifact for artifact in artifacts if before is None or artifact['created_at'] <= before]
+        if artifacts:
+            return artifacts[0]['key']
+        logger.info("No artifact in the catalog, listing %s" % storage.describe())
+    listed = {key: artifact for key, artifact in target.list_artifacts(storage).items() if before is None or artifact['modified'] <= before}
+    if not listed:
+        raise ValueError("No artifacts found in %s" % storage.describe())
+    return max(listed, key=lambda key: listed[key]['modified'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore a backup artifact from a storage.")
+    parser.add_argument('-n', '--namespace', help="namespace of the config to restore (required with BACKUP_USE_CONFIG=on)")
+    parser.add_argument('-s', '--storage', help="storage index or a part of its description (default: the first one)")
+    parser.add_argument('-a', '--artifact', help="artifact key (default: the latest one)")
+    parser.add_argument('--from-listing', action='store_true', help="pick the latest artifact from the storage listing instead of the catalog")
+    parser.add_argument('-o', '--output', help="file or parent directory to restore to, the database name, or the data directory of a base backup (default: the backed up source)")
+    parser.add_argument('--target-time', help="postgresql_physical: recover up to this time (ISO 8601, UTC by default) from the newest base backup before it")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="parallel downloads, extractions and pg_restore jobs")
+    args = parser.parse_args()
+
+    environment = Environment()
+    namespaces = Config.load_namespaces(environment)
+    if args.namespace is None and None not in namespaces:
+        parser.error("--namespace is required, one of: %s" % ', '.join(namespaces))
+    if args.namespace is not None and args.namespace not in namespaces:
+        parser.error("Unknown namespace `%s`" % args.namespace)
+
+    target = TargetBuilder(namespaces[args.namespace], environment, args.namespace).build()
+    before = None
+    if args.target_time is not None:
+        if not isinstance(target, PostgreSQLPhysicalTarget):
+            parser.error("--target-time needs a postgresql_physical target")
+        try:
+            target_time = parse_target_time(args.target_time)
+        except ValueError:
+            parser.error("Invalid --target-time `%s`" % args.target_time)
+        target.recovery_target_time = target_time.isoformat()
+        before = target_time.timestamp()
+    storage = select_storage(target, args.storage)
+    key = args.artifact or select_artifact(environment, target, storage, args.from_listing, before)
+    try:
+        stats = target.restore(storage, key, args.output, args.jobs)
+    except Exception as e:
+        logger.error("Restore of %s failed: %s" % (key, e))
+        sys.exit(1)
+    sys.stdout.write(stats.describe() + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import hashlib
+import logging
+import socket
+import threading
+import time
+from typing import Dict, List
+from urllib.parse import quote
+
+from services.workers import OVERLAP_SKIP, WorkerJob, WorkerPool
+from utils.leases.base import LeaseBackend
+from utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+CLUSTER_LEASE_TTL = 60
+CLUSTER_POLL_INTERVAL = 2
+# The nodes of a run's preference order try to claim it one after another,
+# this many seconds apart, so the preferred node gets it unless it is gone.
+CLUSTER_CLAIM_STAGGER = 5
+# Expected runtime of a namespace that has no finished run yet.
+CLUSTER_DEFAULT_RUN_SECONDS = 60
+# Cron fires at most once a minute, so nodes whose clocks differ by less
+# than half a minute agree on the tick of a run.
+CLUSTER_TICK = 60
+
+
+def get_tick(timestamp: float) -> int:
+    return int(round(timestamp / CLUSTER_TICK) * CLUSTER_TICK)
+
+
+def get_affinity(name: str, node: str) -> int:
+    # Rendezvous hash, so equally loaded nodes are ordered the same way on
+    # every node.
+    return int(hashlib.sha256(('%s\0%s' % (name, node)).encode()).hexdigest()[:16], 16)
+
+
+class ClusterClaim:
+    # A due run of a namespace waiting for the namespace's lease.
+
+    def __init__(self, job: WorkerJob, tick: int):
+        self.job = job
+        self.tick = tick
+        self.queued_at = time.time()
+        self.weight = float(CLUSTER_DEFAULT_RUN_SECONDS)
+        # Live nodes in the order they may claim the run; set by plan().
+        self.nodes: List[str] | None = None
+
+
+class ClusterLease:
+    # A lease held by this node for a job it handed to the worker pool.
+
+    def __init__(self, claim: ClusterClaim, record: dict, version: str):
+        self.claim = claim
+        self.record = record
+        self.version = version
+        self.renewed_at = time.time()
+
+
+class ClusterNode:
+    # Cluster mode: every node runs the same config and schedule, and every
+    # due run is submitted here instead of to the worker pool. A node only
+    # hands a run to its pool once it holds the namespace's lease in the
+    # shared lease backend. Each lease record holds the holder, the tick of
+    # the run, an expiry and the duration of the last run. The holder renews
+    # the lease while the job runs and marks the tick completed when it
+    # finishes, so the other nodes drop their claims.
+    #
+    # Runs of a tick are planned heaviest first, each to the live node with
+    # the least expected work. Nodes publish their load in a heartbeat. The
+    # other nodes follow in preference order, CLUSTER_CLAIM_STAGGER apart.
+    # They keep their claims while the run is held elsewhere and take it over
+    # when the holder's lease expires because the node died.
+
+    def __init__(self, backend: LeaseBackend, pool: WorkerPool, node_id: str | None = None, ttl: float = CLUSTER_LEASE_TTL):
+        self.backend = backend
+        self.pool = pool
+        self.node_id = node_id or socket.gethostname()
+        self.ttl = float(ttl)
+        self.claims: Dict[str, ClusterClaim] = {}
+        self.leases: Dict[str, ClusterLease] = {}
+        self.lock = threading.Lock()
+        self.node_version: str | None = None
+        self.heartbeat_at = 0.0
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def get_lease_name(self, job: WorkerJob) -> str:
+        return 'leases/%s' % quote(str(job.key), safe='')
+
+    def get_node_name(self) -> str:
+        return 'nodes/%s' % quote(self.node_id, safe='')
+
+    def get_load(self) -> float:
+        return sum(lease.claim.weight for lease in self.leases.values())
+
+    def submit(self, job: WorkerJob) -> WorkerJob | None:
+        logger.info("ClusterNode -> submit('%s')", job.name)
+        name = self.get_lease_name(job)
+        with self.lock:
+            if name in self.claims:
+                logger.info("ClusterNode -> %s replaces the waiting run of tick %s", job.name, self.claims[name].tick)
+            self.claims[name] = ClusterClaim(job, get_tick(time.time()))
+        self.wake()
+        return job
+
+    def heartbeat(self, now: float):
+        record = {'node': self.node_id, 'load': self.get_load(), 'leases': sorted(self.leases), 'expires_at': now + self.ttl}
+        version = self.backend.write(self.get_node_name(), record, self.node_version)
+        if version is None:
+            # First heartbeat of this process, the record may be left over
+            # from an earlier one.
+            _, self.node_version = self.backend.read(self.get_node_name())
+            version = self.backend.write(self.get_node_name(), record, self.node_version)
+        if version is not None:
+            self.node_version = version
+            self.heartbeat_at = now
+
+    def get_live_loads(self, now: float) -> Dict[str, float]:
+        loads = {
+            record['node']: float(record.get('load') or 0)
+            for record in self.backend.list('nodes/').values()
+            if record.get('expires_at', 0) > now
+        }
+        loads[self.node_id] = self.get_load()
+        return loads
+
+    def plan(self, claims: Dict[str, ClusterClaim], now: float):
+        # Longest runs first, each to the node with the least expected work
+        # so far. Every node sees the same records and gets the same plan.
+        loads = self.get_live_loads(now)
+        for name, claim in claims.items():
+            record, _ = self.backend.read(name)
+            if record is not None and record.get('duration'):
+                claim.weight = float(record['duration'])
+        for name, claim in sorted(claims.items(), key=lambda item: (-item[1].weight, item[0])):
+            claim.nodes = sorted(loads, key=lambda node: (loads[node], get_affinity(name, node)))
+            loads[claim.nodes[0]] += claim.weight
+
+    def process_claim(self, name: str, claim: ClusterClaim, now: float) -> bool:
+        # True once the claim is settled: run here, run elsewhere or skipped.
+        record, version = self.backend.read(name)
+        if record is not None:
+            if record.get('completed') and record.get('tick', 0) >= claim.tick:
+                logger.info("ClusterNode -> %s ran on node %s", claim.job.name, record['node'])
+                return True
+            if not record.get('completed') and record['expires_at'] > now:
+                if record['tick'] < claim.tick and claim.job.overlap == OVERLAP_SKIP:
+                    logger.warning("ClusterNode -> %s is still running on node %s, skipped this run", claim.job.name, record['node'])
+                    return True
+                return False
+        if claim.nodes is None:
+            return False
+        rank = claim.nodes.index(self.node_id) if self.node_id in claim.nodes else len(claim.nodes)
+        expired_at = record['expires_at'] if record is not None and not record.get('completed') else 0
+        if now < max(claim.queued_at, expired_at) + rank * CLUSTER_CLAIM_STAGGER:
+            return False
+
+        lease_record = {
+            'node': self.node_id,
+            'job': claim.job.name,
+            'tick': claim.tick,
+            'expires_at': now + self.ttl,
+            'completed': False,
+            'duration': record.get('duration') if record is not None else None,
+        }
+        new_version = self.backend.write(name, lease_record, version)
+        if new_version is None:
+            return False
+        if expired_at:
+            logger.warning("ClusterNode -> take over %s from node %s, whose lease expired", claim.job.name, record['node'])  # type: ignore
+            get_metrics().inc('backup_cluster_takeovers_total')
+        logger.info("ClusterNode -> acquired the lease of %s (tick %s)", claim.job.name, claim.tick)
+        lease = ClusterLease(claim, lease_record, new_version)
+        self.leases[name] = lease
+        if self.pool.submit(claim.job) is None:
+            self.release(name, lease)
+        return True
+
+    def renew(self, name: str, lease: ClusterLease, now: float):
+        record = dict(lease.record, expires_at=now + self.ttl)
+        version = self.backend.write(name, record, lease.version)
+        if version is None:
+            logger.error("ClusterNode -> lost the lease of %s, another node may run it as well", lease.claim.job.name)
+            get_metrics().inc('backup_cluster_lease_losses_total')
+            del self.leases[name]
+            return
+        lease.record = record
+        lease.version = version
+        lease.renewed_at = now
+
+    def release(self, name: str, lease: ClusterLease):
+        job = lease.claim.job
+        record = dict(lease.record, expires_at=0, completed=True)
+        if job.started_at is not None and job.finished_at is not None:
+            record['duration'] = job.finished_at - job.started_at
+        if self.backend.write(name, record, lease.version) is None:
+            logger.warning("ClusterNode -> the lease of %s was taken over before its run finished", job.name)
+        del self.leases[name]
+
+    def step(self):
+        now = time.time()
+        if now - self.heartbeat_at >= self.ttl / 3:
+            self.heartbeat(now)
+        for name, lease in list(self.leases.items()):
+            if lease.claim.job.finished.is_set():
+                self.release(name, lease)
+            elif now - lease.renewed_at >= self.ttl / 3:
+                self.renew(name, lease, now)
+
+        with self.lock:
+            claims = dict(self.claims)
+        unplanned = {name: claim for name, claim in claims.items() if claim.nodes is None}
+        if unplanned:
+            self.plan(unplanned, now)
+        for name, claim in claims.items():
+            if self.process_claim(name, claim, now):
+                with self.lock:
+                    if self.claims.get(name) is claim:
+                        del self.claims[name]
+        get_metrics().set('backup_cluster_leases', len(self.leases))
+
+    def run(self):
+        logger.info("ClusterNode -> node %s, leases in %s", self.node_id, self.backend.describe())
+        while not self.stopped:
+            try:
+                self.step()
+            except Exception as e:
+                logger.warning("ClusterNode -> lease backend %s failed: %s", self.backend.describe(), e)
+            self.wakeup.wait(CLUSTER_POLL_INTERVAL)
+            self.wakeup.clear()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='cluster-node', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
@@ -1,4 +1,8 @@
+import heapq
+import itertools
 import logging
+import threading
+import time
 from datetime import datetime
 from multiprocessing import Process
 from typing import Callable, List, Tuple
@@ -9,39 +13,145 @@ from utils.patterns import Singleton
 logger = logging.getLogger(__name__)
 
 
-class CronService(metaclass=Singleton):
+# The scheduler never sleeps longer than this, so a wall clock that was changed
+# or a host that was suspended is noticed within a bounded delay.
+CRON_MAX_SLEEP = 60
+CRON_CLOCK_JUMP_TOLERANCE = 5
+
+
+class CronJob:
+
+    def __init__(
+        self,
+        cron_expression: str,
+        func: Callable,
+        args: tuple,
+        kwargs: dict,
+        name: str | None = None,
+        spawn: bool = True,
+    ):
+        if not croniter.croniter.is_valid(cron_expression):
+            raise ValueError("Invalid cron expression: %s" % cron_expression)
+        self.cron_expression = cron_expression
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name or getattr(func, '__name__', str(func))
+        # Jobs that only hand work over to the worker pool run in the
+        # scheduler process instead of a process of their own.
+        self.spawn = spawn
+
+    def get_next(self, start: datetime) -> datetime | None:
+        try:
+            return croniter.croniter(self.cron_expression, start).get_next(datetime)
+        except croniter.CroniterBadDateError:
+            return None
 
-    crons_iters: List[croniter.croniter] = []
-    pendings: List[Tuple] = []
-    processes: List[Process] = []
+    def start(self) -> Process | None:
+        if not self.spawn:
+            logger.info("Run job %s (%s)" % (self.name, self.cron_expression))
+            try:
+                self.func(*self.args, **self.kwargs)
+            except Exception as e:
+                logger.exception("Job %s failed: %s" % (self.name, e))
+            return None
+        process = Process(target=self.func, args=self.args, kwargs=self.kwargs)
+        process.start()
+        logger.info("Start job %s (%s) with args %s and kwargs %s (PID: %s)" % (
+            self.name, self.cron_expression, self.args, self.kwargs, process.pid,
+        ))
+        return process
+
+
+class CronService(metaclass=Singleton):
+    # Jobs are kept in a heap ordered by their next due time; the service
+    # sleeps until the earliest one is due instead of polling every second.
+    # Runs missed while the host was suspended or the clock jumped forward are
+    # coalesced into a single catch-up run, and a backward clock jump
+    # reschedules every job from the new current time.
 
     def __init__(self):
-        pass
+        self.heap: List[Tuple[datetime, int, CronJob]] = []
+        self.counter = itertools.count()
+        self.processes: List[Process] = []
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.last_wall = datetime.now()
+        self.last_monotonic = time.monotonic()
+
+    def add_func(
+        self,
+        cron_expression: str,
+        func: Callable,
+        *args,
+        name: str | None = None,
+        spawn: bool = True,
+        **kwargs,
+    ) -> CronJob:
+        job = CronJob(cron_expression, func, args, kwargs, name, spawn)
+        self.schedule(job, datetime.now())
+        self.wakeup.set()
+        return job
 
-    def add_func(self, cron_expression: str, func: Callable, *args, **kwargs):
-        cron_iter = croniter.croniter(cron_expression, datetime.now())
-        self.crons_iters.append(cron_iter)
-        self.pendings.append((cron_iter.get_next(datetime), func, args, kwargs))
+    def remove_func(self, job: CronJob):
+        self.heap = [item for item in self.heap if item[2] is not job]
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def schedule(self, job: CronJob, start: datetime):
+        at = job.get_next(start)
+        if at is None:
+            logger.warning("Job %s (%s) has no further runs" % (job.name, job.cron_expression))
+            return
+        logger.info("Job %s (%s) is scheduled at %s" % (job.name, job.cron_expression, at))
+        heapq.heappush(self.heap, (at, next(self.counter), job))
+
+    def check_clock(self, now: datetime):
+        expected = self.last_wall.timestamp() + (time.monotonic() - self.last_monotonic)
+        if now.timestamp() < expected - CRON_CLOCK_JUMP_TOLERANCE:
+            logger.warning("Clock jumped back by %.0f seconds, rescheduling all jobs" % (expected - now.timestamp()))
+            jobs = [job for _, _, job in self.heap]
+            self.heap = []
+            for job in jobs:
+                self.schedule(job, now)
+        self.last_wall = now
+        self.last_monotonic = time.monotonic()
+
+    def run_pending(self, now: datetime | None = None):
+        now = now or datetime.now()
+        while self.heap and self.heap[0][0] <= now:
+            at, _, job = heapq.heappop(self.heap)
+            missed = job.get_next(at)
+            if missed is not None and missed <= now:
+                logger.warning("Job %s (%s) missed runs since %s, running once to catch up" % (job.name, job.cron_expression, at))
+            process = job.start()
+            if process is not None:
+                self.processes.append(process)
+            self.schedule(job, now)
+        self.clear_finished_processes()
 
     def clear_finished_processes(self):
         processes: List[Process] = []
         for process in self.processes:
-            v = process.exitcode
-            if v is None:
+            if process.exitcode is None:
                 processes.append(process)
+            else:
+                process.join()
         self.processes = processes
 
-    def run_pending(self):
-        current_dt = datetime.now()
-        for index, (at, func, args, kwargs) in enumerate(self.pendings):
-            if at < current_dt:
-                process = Process(target=func, args=args, kwargs=kwargs)
-                process.start()
-                logger.info("Start function %s with args %s and kwargs %s (PID: %s)" % (func, args, kwargs, process.pid))
-                self.processes.append(process)
-                try:
-                    self.pendings[index] = (self.crons_iters[index].get_next(datetime), func, args, kwargs)
-                except croniter.CroniterBadDateError:
-                    self.pendings.pop(index)
-                    self.crons_iters.pop(index)
-        self.clear_finished_processes()
+    def get_sleep_time(self, now: datetime) -> float:
+        if not self.heap:
+            return CRON_MAX_SLEEP
+        return max(0.0, min((self.heap[0][0] - now).total_seconds(), CRON_MAX_SLEEP))
+
+    def run_forever(self):
+        while not self.stopped:
+            now = datetime.now()
+            self.check_clock(now)
+            self.run_pending(now)
+            self.wakeup.clear()
+            self.wakeup.wait(self.get_sleep_time(datetime.now()))
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
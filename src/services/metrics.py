@@ -0,0 +1,72 @@
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.environment import Environment
+from utils.metrics import collect, render
+
+logger = logging.getLogger(__name__)
+
+
+METRICS_TEXTFILE_INTERVAL = 15
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    state_dir = ''
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render(collect(self.state_dir)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("MetricsHandler -> %s" % (format % args))
+
+
+class MetricsExporter:
+    # Serves the metrics aggregated from all worker processes on
+    # http://<host>:BACKUP_METRICS_PORT/metrics and/or writes them to
+    # BACKUP_METRICS_TEXTFILE for the node_exporter textfile collector.
+
+    def __init__(self, environment: Environment):
+        self.environment = environment
+        self.state_dir: str = environment.STATE_DIR  # type: ignore
+        self.server: ThreadingHTTPServer | None = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.environment.METRICS_PORT:  # type: ignore
+            handler = type('Handler', (MetricsHandler,), {'state_dir': self.state_dir})
+            self.server = ThreadingHTTPServer(('', int(self.environment.METRICS_PORT)), handler)  # type: ignore
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+            logger.info("MetricsExporter -> serving /metrics on port %s" % self.environment.METRICS_PORT)  # type: ignore
+        if self.environment.METRICS_TEXTFILE:  # type: ignore
+            threading.Thread(target=self.run_textfile, name='metrics-textfile', daemon=True).start()
+
+    def write_textfile(self):
+        path: str = self.environment.METRICS_TEXTFILE  # type: ignore
+        temp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(render(collect(self.state_dir)))
+        os.replace(temp_path, path)
+
+    def run_textfile(self):
+        while not self.stopped.is_set():
+            try:
+                self.write_textfile()
+            except Exception as e:
+                logger.warning("MetricsExporter -> failed to write %s: %s" % (self.environment.METRICS_TEXTFILE, e))  # type: ignore
+            self.stopped.wait(METRICS_TEXTFILE_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
@@ -0,0 +1,299 @@
+import contextlib
+import heapq
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+from typing import Callable, Dict, List, Tuple
+
+from utils.locks import FileLock
+from utils.logs import attach_log_queue
+from utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+WORKER_POOL_MAX_WORKERS = 4
+# How often jobs waiting for a lock held outside of the pool (e.g. by a run
+# that survived a restart of the scheduler) are checked again.
+WORKER_POOL_LOCK_POLL_INTERVAL = 5
+# Time between SIGTERM and SIGKILL for jobs that exceeded their max runtime.
+WORKER_POOL_KILL_GRACE_PERIOD = 30
+
+OVERLAP_SKIP = 'skip'
+OVERLAP_QUEUE_ONE = 'queue-one'
+OVERLAP_ALLOW = 'allow'
+OVERLAP_POLICIES = (OVERLAP_SKIP, OVERLAP_QUEUE_ONE, OVERLAP_ALLOW)
+
+_counter = itertools.count()
+
+
+def parse_resource_limits(value: str | dict | None) -> Dict[str, int]:
+    # Accepts a mapping or a `key=limit,key=limit` string. A key is either a
+    # resource kind (`postgres`, `s3`, `sftp`, `disk`) or a full resource key
+    # such as `postgres:db1:5432`.
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return {str(key): int(limit) for key, limit in value.items()}
+    limits = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        key, _, limit = item.partition('=')
+        limits[key.strip()] = int(limit)
+    return limits
+
+
+def run_worker(
+    name: str,
+    func: Callable,
+    args: tuple,
+    kwargs: dict,
+    lock_path: str | None,
+    log_queue: Queue | None = None,
+    log_level: int = logging.INFO,
+):
+    # Entry point of a worker process. It leads its own process group so that
+    # a runaway job can be stopped together with its children (pg_dump, zstd).
+    os.setpgid(0, 0)
+    if log_queue is not None:
+        attach_log_queue(log_queue, log_level)
+    lock = None
+    if lock_path is not None:
+        lock = FileLock(lock_path)
+        if not lock.acquire():
+            logger.warning("Job %s is already running (%s), skipped" % (name, lock.get_holder()))
+            return
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        # Logged, so that the traceback reaches the log listener too.
+        logger.exception("Job %s failed", name)
+        sys.exit(1)
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+class WorkerJob:
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        args: tuple = (),
+        kwargs: dict | None = None,
+        resources: List[str] | None = None,
+        priority: int = 0,
+        deadline: float | None = None,
+        key: str | None = None,
+        overlap: str = OVERLAP_ALLOW,
+        lock_path: str | None = None,
+        max_runtime: float | None = None,
+    ):
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError("Unknown overlap policy: %s" % overlap)
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.resources = resources or []
+        self.priority = int(priority)
+        self.queued_at = time.time()
+        # `deadline` is given in seconds after the job was queued.
+        self.deadline = self.queued_at + float(deadline) if deadline is not None else None
+        self.sequence = next(_counter)
+        # Runs of the same `key` are subject to the overlap policy: `skip`
+        # drops a run while another one is queued or running, `queue-one`
+        # keeps at most one run waiting behind the running one and `allow`
+        # lets runs overlap freely.
+        self.key = key or name
+        self.overlap = overlap
+        self.lock_path = lock_path if overlap != OVERLAP_ALLOW else None
+        self.max_runtime = float(max_runtime) if max_runtime else None
+        self.process: BaseProcess | None = None
+        self.started_at: float | None = None
+        self.terminated_at: float | None = None
+        self.finished_at: float | None = None
+        # Set once the job's process was reaped.
+        self.finished = threading.Event()
+
+    def get_runtime_limit(self) -> float | None:
+        if self.max_runtime is None or self.started_at is None:
+            return None
+        if self.terminated_at is not None:
+            return self.terminated_at + WORKER_POOL_KILL_GRACE_PERIOD
+        return self.started_at + self.max_runtime
+
+    def get_sort_key(self) -> Tuple:
+        # Higher priority first, then the earliest deadline, then FIFO.
+        return (-self.priority, self.deadline if self.deadline is not None else math.inf, self.sequence)
+
+
+class WorkerPool:
+    # Runs queued jobs in worker processes, at most `max_workers` at a time and
+    # at most `resource_limits[key]` per shared resource (a database host, a
+    # storage endpoint, a local disk). A job that cannot start because one of
+    # its resources is saturated does not block queued jobs behind it that
+    # only need idle resources.
+    #
+    # Workers are started with `start_method`. With `forkserver` they are
+    # forked from a small server process that only imported `preload`, not
+    # from the scheduler, so they neither inherit its memory nor the modules
+    # of backends they do not use.
+
+    def __init__(
+        self,
+        max_workers: int = WORKER_POOL_MAX_WORKERS,
+        resource_limits: Dict[str, int] | None = None,
+        start_method: str | None = None,
+        preload: List[str] | None = None,
+    ):
+        self.max_workers = max(int(max_workers), 1)
+        self.resource_limits = resource_limits or {}
+        self.context = multiprocessing.get_context(start_method)
+        if self.context.get_start_method() == 'forkserver' and preload:
+            self.context.set_forkserver_preload(preload)  # type: ignore
+        self.pending: List[Tuple[Tuple, WorkerJob]] = []
+        self.running: Dict[int, WorkerJob] = {}
+        self.usage: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.thread: threading.Thread | None = None
+        # Workers send their log records to the listener of the scheduler
+        # through this queue (see utils.logs), made with `self.context`.
+        self.log_queue: Queue | None = None
+
+    def get_limit(self, key: str) -> int | None:
+        if key in self.resource_limits:
+            return self.resource_limits[key]
+        return self.resource_limits.get(key.split(':', 1)[0])
+
+    def is_running(self, job: WorkerJob) -> bool:
+        if any(running.key == job.key for running in self.running.values()):
+            return True
+        return job.lock_path is not None and FileLock(job.lock_path).is_locked()
+
+    def can_start(self, job: WorkerJob) -> bool:
+        if job.overlap != OVERLAP_ALLOW and self.is_running(job):
+            return False
+        for key in job.resources:
+            limit = self.get_limit(key)
+            if limit is not None and self.usage.get(key, 0) >= limit:
+                return False
+        return True
+
+    def submit(self, job: WorkerJob) -> WorkerJob | None:
+        logger.info("WorkerPool -> submit('%s', priority=%s, resources=%s)" % (job.name, job.priority, job.resources))
+        with self.lock:
+            if job.overlap != OVERLAP_ALLOW:
+                queued = any(pending.key == job.key for _, pending in self.pending)
+                if job.overlap == OVERLAP_SKIP and (queued or self.is_running(job)):
+                    logger.warning("Job %s is still queued or running, skipped this run" % job.name)
+                    return None
+                if job.overlap == OVERLAP_QUEUE_ONE and queued:
+                    logger.warning("Job %s already has a queued run, coalesced this run into it" % job.name)
+                    return None
+            heapq.heappush(self.pending, (job.get_sort_key(), job))
+        self.wake()
+        return job
+
+    def wake(self):
+        os.write(self.wakeup_write, b'\0')
+
+    def start_job(self, job: WorkerJob):
+        if job.deadline is not None and time.time() > job.deadline:
+            logger.warning("Job %s starts after its deadline (queued %.0f seconds ago)" % (job.name, time.time() - job.queued_at))
+        job.process = self.context.Process(target=run_worker, args=(  # type: ignore
+            job.name, job.func, job.args, job.kwargs, job.lock_path, self.log_queue, logging.getLogger().getEffectiveLevel(),
+        ))
+        job.process.start()
+        job.started_at = time.time()
+        for key in job.resources:
+            self.usage[key] = self.usage.get(key, 0) + 1
+        self.running[job.process.sentinel] = job
+        logger.info("Start job %s (PID: %s, waited %.1f seconds)" % (job.name, job.process.pid, job.started_at - job.queued_at))
+
+    def reap(self):
+        for sentinel, job in list(self.running.items()):
+            if job.process.exitcode is None:  # type: ignore
+                continue
+            job.process.join()  # type: ignore
+            del self.running[sentinel]
+            for key in job.resources:
+                self.usage[key] -= 1
+            job.finished_at = time.time()
+            job.finished.set()
+            logger.info("Finished job %s (PID: %s, exit code: %s) in %.1f seconds" % (
+                job.name, job.process.pid, job.process.exitcode, time.time() - job.started_at,  # type: ignore
+            ))
+
+    def check_runtimes(self):
+        now = time.time()
+        for job in self.running.values():
+            limit = job.get_runtime_limit()
+            if limit is None or now < limit or job.process.exitcode is not None:  # type: ignore
+                continue
+            with contextlib.suppress(ProcessLookupError):
+                if job.terminated_at is None:
+                    logger.error("Job %s exceeded its max runtime of %.0f seconds, terminating" % (job.name, job.max_runtime))
+                    os.killpg(job.process.pid, signal.SIGTERM)  # type: ignore
+                    job.terminated_at = now
+                else:
+                    logger.error("Job %s did not stop after SIGTERM, killing" % job.name)
+                    os.killpg(job.process.pid, signal.SIGKILL)  # type: ignore
+                    job.max_runtime = None
+
+    def get_wait_timeout(self) -> float | None:
+        timeouts = []
+        for job in self.running.values():
+            limit = job.get_runtime_limit()
+            if limit is not None:
+                timeouts.append(max(limit - time.time(), 0))
+        if self.pending:
+            timeouts.append(WORKER_POOL_LOCK_POLL_INTERVAL)
+        return min(timeouts) if timeouts else None
+
+    def dispatch(self):
+        with self.lock:
+            self.reap()
+            self.check_runtimes()
+            blocked = []
+            while self.pending and len(self.running) < self.max_workers:
+                item = heapq.heappop(self.pending)
+                if self.can_start(item[1]):
+                    self.start_job(item[1])
+                else:
+                    blocked.append(item)
+            for item in blocked:
+                heapq.heappush(self.pending, item)
+            get_metrics().set('backup_jobs_queued', len(self.pending))
+            get_metrics().set('backup_jobs_running', len(self.running))
+
+    def run(self):
+        while not self.stopped:
+            self.dispatch()
+            with self.lock:
+                sentinels = list(self.running)
+                timeout = self.get_wait_timeout()
+            ready = wait([self.wakeup_read] + sentinels, timeout)
+            if self.wakeup_read in ready:
+                os.read(self.wakeup_read, 1024)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='worker-pool', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
@@ -1,85 +1,53 @@
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.context import BaseContext
+from typing import Dict, List
 
+from utils.config import Config, ConfigStore
 from utils.environment import Environment
+from utils.leases.base import LeaseBackend
+from utils.logs import log_context
 from utils.notifiers.base import Notifier
-from utils.notifiers.slack import SlackNotifier
-from utils.notifiers.telegram import TelegramNotifier
-from utils.storages.aws import AWSStorage
+from utils.plugins import LEASES, NOTIFIERS, STORAGES, TARGETS
 from utils.storages.base import Storage
-from utils.storages.local import LocalStorage
-from utils.storages.remote import RemoteStorage
 from utils.targets.base import Target
-from utils.targets.directory import DirectoryTarget
-from utils.targets.file import FileTarget
-from utils.targets.postgresql import PostgreSQLTarget
+
+# Namespace settings handed to the target only when they are configured, so
+# targets written against the plain signature keep working.
+TARGET_OPTIONS = ('compression', 'retry', 'throttle', 'retention', 'encryption')
 
 
 class TargetBuilder:
 
-    def __init__(self, builder_config: dict, environment: Environment, namespace: str = None):
+    def __init__(self, builder_config: dict, environment: Environment, namespace: str | None = None):
         self.builder_config = builder_config
         self.environment = environment
         self.namespace = namespace
 
-    def build_storage_from_config(self, storage_config: dict):
-        if storage_config.get('type') == 'aws':
-            return AWSStorage(
-                **(storage_config.get('params', {})),
-                environment=self.environment,
-                namespace=self.namespace,
-            )
-        elif storage_config.get('type') == 'local':
-            return LocalStorage(
-                **(storage_config.get('params', {})),
-                environment=self.environment,
-                namespace=self.namespace,
-            )
-        elif storage_config.get('type') == 'remote':
-            return RemoteStorage(
-                **(storage_config.get('params', {})),
-                environment=self.environment,
-                namespace=self.namespace,
-            )
-
-    def build_notifier_from_config(self, notifier_config: dict):
-        if notifier_config.get('type') == 'slack':
-            return SlackNotifier(
-                **(notifier_config.get('params', {})),
-                environment=self.environment,
-                namespace=self.namespace,
-            )
-        elif notifier_config.get('type') == 'telegram':
-            return TelegramNotifier(
-                **(notifier_config.get('params', {})),
-                environment=self.environment,
-                namespace=self.namespace,
-            )
-
-    def build_target_from_config(self, target_config: dict, storages: List[Storage], notifiers: List[Notifier]):
-        if target_config.get('type') == 'postgresql':
-            return PostgreSQLTarget(
-                **(target_config.get('params', {})),
-                storages=storages,
-                notifiers=notifiers,
-                environment=self.environment,
-                namespace=self.namespace,
-            )
-        elif target_config.get('type') == 'file':
-            return FileTarget(
-                **(target_config.get('params', {})),
-                storages=storages,
-                notifiers=notifiers,
-                environment=self.environment,
-                namespace=self.namespace,
-            )
-        elif target_config.get('type') == 'directory':
-            return DirectoryTarget(
-                **(target_config.get('params', {})),
-                storages=storages,
-                notifiers=notifiers,
-                environment=self.environment,
-                namespace=self.namespace,
-            )
+    def build_storage_from_config(self, storage_config: dict) -> Storage:
+        return STORAGES.get(storage_config.get('type'))(  # type: ignore
+            **(storage_config.get('params', {})),
+            environment=self.environment,
+            namespace=self.namespace,
+            # Same reasoning as TARGET_OPTIONS.
+            **({'throttle': storage_config['throttle']} if storage_config.get('throttle') is not None else {}),
+        )
+
+    def build_notifier_from_config(self, notifier_config: dict) -> Notifier:
+        return NOTIFIERS.get(notifier_config.get('type'))(  # type: ignore
+            **(notifier_config.get('params', {})),
+            environment=self.environment,
+            namespace=self.namespace,
+        )
+
+    def build_target_from_config(self, target_config: dict, storages: List[Storage], notifiers: List[Notifier]) -> Target:
+        return TARGETS.get(target_config.get('type'))(  # type: ignore
+            **(target_config.get('params', {})),
+            storages=storages,
+            notifiers=notifiers,
+            environment=self.environment,
+            namespace=self.namespace,
+            **{key: self.builder_config[key] for key in TARGET_OPTIONS if self.builder_config.get(key) is not None},
+        )
 
     def build(self) -> Target:
         storages = []
@@ -95,3 +63,69 @@ class TargetBuilder:
         target = self.build_target_from_config(self.builder_config.get('target', {}), storages, notifiers)
 
         return target
+
+
+class TargetDescriptor:
+    # What the scheduler needs to queue a backup of a target: its class name,
+    # the resources it keeps busy and its run lock, or why it failed to build.
+
+    def __init__(self, kind: str, resources: List[str], lock_path: str | None, error: str | None = None):
+        self.kind = kind
+        self.resources = resources
+        self.lock_path = lock_path
+        self.error = error
+
+
+def describe_targets(namespaces: Dict[str | None, dict], environment: Environment) -> Dict[str | None, TargetDescriptor]:
+    # Runs in a worker process, see TargetCache.
+    descriptors = {}
+    for namespace, builder_config in namespaces.items():
+        try:
+            target = TargetBuilder(builder_config, environment, namespace).build()
+            descriptors[namespace] = TargetDescriptor(type(target).__name__, target.get_resource_keys(), target.get_lock_path())
+        except Exception as e:
+            descriptors[namespace] = TargetDescriptor('', [], None, '%s: %s' % (type(e).__name__, e))
+    return descriptors
+
+
+class TargetCache:
+    # Descriptors of the targets of the scheduler process, refreshed once per
+    # config version. Building a target imports its backends (boto3,
+    # paramiko, aiohttp), so targets are built in a short-lived process of
+    # the worker pool's context and only their descriptors come back.
+    # Backups run in workers that build their own target (see run_backup).
+
+    def __init__(self, store: ConfigStore, environment: Environment, context: BaseContext):
+        self.store = store
+        self.environment = environment
+        self.context = context
+        self.descriptors: Dict[str | None, TargetDescriptor] = {}
+        self.version: int | None = None
+
+    def refresh(self):
+        with ProcessPoolExecutor(max_workers=1, mp_context=self.context) as executor:
+            self.descriptors = executor.submit(describe_targets, self.store.namespaces, self.environment).result()
+        self.version = self.store.version
+
+    def get(self, namespace: str | None) -> TargetDescriptor:
+        if self.version != self.store.version:
+            self.refresh()
+        return self.descriptors[namespace]
+
+
+def run_backup(builder_config: dict, environment: Environment, namespace: str | None = None):
+    # Entry point of a backup worker. The target is built in the worker from
+    # its config, so only the backends it uses get imported there.
+    with log_context(namespace=namespace):
+        TargetBuilder(builder_config, environment, namespace).build().backup()
+
+
+def build_lease_backend(environment: Environment) -> LeaseBackend | None:
+    # BACKUP_CLUSTER holds the lease backend of cluster mode as YAML, e.g.
+    # `{type: directory, params: {path: /shared/leases}}`.
+    if not environment.CLUSTER:  # type: ignore
+        return None
+    config = Config.load_config_from_string(environment.CLUSTER)  # type: ignore
+    if not isinstance(config, dict) or not isinstance(config.get('params', {}), dict):
+        raise ValueError("BACKUP_CLUSTER must be a mapping with a `type` and `params`")
+    return LEASES.get(config.get('type'))(**config.get('params', {}), environment=environment)  # type: ignore
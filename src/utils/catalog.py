@@ -0,0 +1,137 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+
+CATALOG_TIMEOUT = 60
+
+CATALOG_COLUMNS = (
+    'namespace', 'storage', 'key', 'size', 'checksum', 'codec', 'is_prefix',
+    'run_id', 'created_at', 'uploaded_at', 'upload_seconds', 'source',
+)
+
+CATALOG_SOURCE_BACKUP = 'backup'
+CATALOG_SOURCE_LISTING = 'listing'
+
+
+def get_catalog_path(state_dir: str) -> str:
+    return '%s/catalog.sqlite' % state_dir
+
+
+class Catalog:
+    # Local SQLite record of every artifact uploaded to a storage, shared by
+    # all namespaces and worker processes. Retention and restores look
+    # artifacts up here instead of listing buckets and remote directories;
+    # `reconcile` resyncs it from the listings when they drifted apart.
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        # WAL lets backups of other namespaces write while one is pruning.
+        self.connection = sqlite3.connect(path, timeout=CATALOG_TIMEOUT, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS artifacts (
+                namespace TEXT NOT NULL,
+                storage TEXT NOT NULL,
+                key TEXT NOT NULL,
+                size INTEGER,
+                checksum TEXT,
+                codec TEXT,
+                is_prefix INTEGER NOT NULL DEFAULT 0,
+                run_id TEXT,
+                created_at REAL NOT NULL,
+                uploaded_at REAL,
+                upload_seconds REAL,
+                source TEXT NOT NULL,
+                PRIMARY KEY (storage, key)
+            );
+            CREATE INDEX IF NOT EXISTS artifacts_created_at ON artifacts (namespace, storage, created_at);
+        ''')
+
+    def record(
+        self,
+        namespace: str,
+        storage: str,
+        key: str,
+        size: int | None,
+        checksum: str | None = None,
+        codec: str | None = None,
+        is_prefix: bool = False,
+        run_id: str | None = None,
+        created_at: float | None = None,
+        upload_seconds: float | None = None,
+        source: str = CATALOG_SOURCE_BACKUP,
+    ):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO artifacts (%s) VALUES (%s)' % (', '.join(CATALOG_COLUMNS), ', '.join('?' * len(CATALOG_COLUMNS))),
+                (namespace, storage, key, size, checksum, codec, int(is_prefix), run_id,
+                 now if created_at is None else created_at, now, upload_seconds, source),
+            )
+
+    def get_artifacts(self, namespace: str, storage: str | None = None) -> List[dict]:
+        query = 'SELECT * FROM artifacts WHERE namespace = ?'
+        params: tuple = (namespace,)
+        if storage is not None:
+            query += ' AND storage = ?'
+            params += (storage,)
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY created_at DESC', params).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_latest(self, namespace: str, storage: str | None = None) -> dict | None:
+        query = 'SELECT * FROM artifacts WHERE namespace = ?'
+        params: tuple = (namespace,)
+        if storage is not None:
+            query += ' AND storage = ?'
+            params += (storage,)
+        with self.lock:
+            row = self.connection.execute(query + ' ORDER BY created_at DESC LIMIT 1', params).fetchone()
+        return dict(row) if row else None
+
+    def get_storages(self, namespace: str) -> List[str]:
+        with self.lock:
+            rows = self.connection.execute('SELECT DISTINCT storage FROM artifacts WHERE namespace = ?', (namespace,))
+            return [storage for storage, in rows]
+
+    def get_namespaces(self, prefix: str = '') -> List[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT DISTINCT namespace FROM artifacts WHERE substr(namespace, 1, ?) = ? ORDER BY namespace', (len(prefix), prefix),
+            )
+            return [namespace for namespace, in rows]
+
+    def remove(self, storage: str, keys: Iterable[str]):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM artifacts WHERE storage = ? AND key = ?', [(storage, key) for key in keys])
+
+    def reconcile(self, namespace: str, storage: str, listed: Dict[str, dict]) -> Dict[str, int]:
+        # Makes the catalog of one storage match its listing: artifacts the
+        # listing does not know any more are dropped, unknown ones are added
+        # with what the listing tells about them. Known artifacts keep their
+        # richer records (checksum, codec, run).
+        known = {artifact['key'] for artifact in self.get_artifacts(namespace, storage)}
+        missing = known - set(listed)
+        added = [key for key in listed if key not in known]
+        self.remove(storage, missing)
+        for key in added:
+            self.record(
+                namespace, storage, key, listed[key]['size'],
+                is_prefix=listed[key].get('is_prefix', False),
+                created_at=listed[key]['modified'],
+                source=CATALOG_SOURCE_LISTING,
+            )
+        return {'added': len(added), 'removed': len(missing), 'kept': len(known) - len(missing)}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,75 @@
+import hashlib
+import json
+from typing import List
+
+CHECKSUM_PART_SIZE = 8 * 1024 * 1024
+
+# Sidecar written next to every artifact, e.g. `<artifact>.manifest.json`.
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+class StreamDigest:
+    # Digests of a stream computed while it passes through: SHA-256 of the
+    # whole stream and MD5 of every `part_size` part. The part digests give
+    # the S3 multipart ETag and let a verification check single ranges
+    # without reading the whole artifact.
+
+    def __init__(self, part_size: int = CHECKSUM_PART_SIZE):
+        self.part_size = part_size
+        self.sha256 = hashlib.sha256()
+        self.part = hashlib.md5(usedforsecurity=False)
+        self.part_left = part_size
+        self.parts: List[str] = []
+        self.size = 0
+
+    def update(self, data: bytes):
+        self.sha256.update(data)
+        self.size += len(data)
+        view = memoryview(data)
+        while view:
+            piece = view[:self.part_left]
+            self.part.update(piece)
+            self.part_left -= len(piece)
+            view = view[len(piece):]
+            if not self.part_left:
+                self.parts.append(self.part.hexdigest())
+                self.part = hashlib.md5(usedforsecurity=False)
+                self.part_left = self.part_size
+
+    def get_part_digests(self) -> List[str]:
+        if self.part_left < self.part_size or not self.parts:
+            return self.parts + [self.part.hexdigest()]
+        return list(self.parts)
+
+    def get_checksum(self) -> str:
+        return 'sha256:%s' % self.sha256.hexdigest()
+
+    def get_etag(self, multipart_threshold: int) -> str | None:
+        # The ETag S3 assigns when the stream is uploaded with parts of
+        # `part_size` once it reaches `multipart_threshold` bytes. A single
+        # PUT's ETag is the MD5 of the object, only known here when it fits in
+        # one part. Empty objects are always a single PUT.
+        parts = self.get_part_digests()
+        if self.size < multipart_threshold or not self.size:
+            return parts[0] if len(parts) == 1 else None
+        return '%s-%s' % (hashlib.md5(b''.join(bytes.fromhex(part) for part in parts), usedforsecurity=False).hexdigest(), len(parts))
+
+    def get_manifest(self) -> dict:
+        return {
+            'size': self.size,
+            'sha256': self.sha256.hexdigest(),
+            'part_size': self.part_size,
+            'parts': self.get_part_digests(),
+        }
+
+
+def get_manifest_key(key: str) -> str:
+    return key + MANIFEST_SUFFIX
+
+
+def check_range(manifest: dict, index: int, data: bytes) -> bool:
+    return hashlib.md5(data, usedforsecurity=False).hexdigest() == manifest['parts'][index]
+
+
+def dump_manifest(manifest: dict) -> bytes:
+    return json.dumps(manifest, sort_keys=True).encode()
@@ -0,0 +1,69 @@
+import hashlib
+import random
+from typing import BinaryIO, Iterator, Tuple
+
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+# Every byte value is mapped to one pseudo-random bit. The bits of the last N
+# bytes form a rolling fingerprint of an N-byte window and a chunk ends where
+# that fingerprint equals a fixed N-bit pattern. Both the mapping and the
+# pattern are seeded so chunk boundaries (and with them the chunk addresses
+# already stored remotely) stay stable across runs. bytes.translate() and
+# bytes.find() scan the window in C, which keeps chunking close to disk speed.
+_RANDOM = random.Random(0x6364632d62797465)  # nosec B311
+_BIT_TABLE = bytes(_RANDOM.getrandbits(1) for _ in range(256))
+_PATTERN_SEED = _RANDOM.getrandbits(64)
+
+
+def _pattern(length: int) -> bytes:
+    bits = [(_PATTERN_SEED >> (i % 64)) & 1 for i in range(length)]
+    # Mixed bits keep runs of identical bytes (zeroes, padding) from matching
+    # at every position.
+    bits[0], bits[-1] = 1, 0
+    return bytes(bits)
+
+
+class ContentDefinedChunker:
+    # Content-defined chunking: boundaries depend on the content around them,
+    # so an insertion only changes the chunks it touches instead of shifting
+    # every following chunk like fixed-size blocks would.
+
+    def __init__(self, min_size: int = CHUNK_MIN_SIZE, avg_size: int = CHUNK_AVG_SIZE, max_size: int = CHUNK_MAX_SIZE):
+        if not 0 < min_size < avg_size < max_size:
+            raise ValueError("Chunk sizes must satisfy 0 < min_size < avg_size < max_size")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.pattern = _pattern(max(2, (avg_size - min_size).bit_length() - 1))
+
+    def find_boundary(self, data: bytes, start: int, end: int) -> int:
+        size = min(end - start, self.max_size)
+        if size <= self.min_size:
+            return size
+        window_start = start + self.min_size - len(self.pattern)
+        window = data[window_start:start + size].translate(_BIT_TABLE)
+        index = window.find(self.pattern)
+        if index < 0:
+            return size
+        return window_start + index + len(self.pattern) - start
+
+    def iter_chunks(self, fileobj: BinaryIO) -> Iterator[Tuple[str, bytes]]:
+        buffer = b''
+        offset = 0
+        eof = False
+        while True:
+            if not eof and len(buffer) - offset < self.max_size:
+                data = fileobj.read(self.max_size * 2)
+                if not data:
+                    eof = True
+                buffer = buffer[offset:] + data
+                offset = 0
+                continue
+            if offset >= len(buffer):
+                return
+            size = self.find_boundary(buffer, offset, len(buffer))
+            chunk = buffer[offset:offset + size]
+            offset += size
+            yield hashlib.sha256(chunk).hexdigest(), chunk
@@ -0,0 +1,181 @@
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+
+from utils.chunking import ContentDefinedChunker
+from utils.storages.base import Storage
+from utils.throttling import Throttle, throttled
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_UPLOAD_WORKERS = 8
+
+
+def get_chunk_path(prefix: str, digest: str) -> str:
+    return '%s/chunks/%s/%s' % (prefix, digest[:2], digest)
+
+
+class ChunkIndex:
+    # Local SQLite index of the chunks every storage is known to hold and of
+    # the chunk lists of files seen in previous runs. It lets a dedup run skip
+    # both listing the remote storages and re-chunking unchanged files.
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                storage TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                PRIMARY KEY (storage, digest)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                chunks TEXT NOT NULL
+            );
+        ''')
+
+    def load_known_chunks(self, storage_key: str) -> Set[str]:
+        with self.lock:
+            rows = self.connection.execute('SELECT digest FROM chunks WHERE storage = ?', (storage_key,))
+            return {digest for digest, in rows}
+
+    def add_known_chunk(self, storage_key: str, digest: str):
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO chunks (storage, digest) VALUES (?, ?)', (storage_key, digest))
+
+    def get_file_chunks(self, path: str, stat: os.stat_result) -> List[str] | None:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT chunks FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?',
+                (path, stat.st_size, stat.st_mtime_ns, stat.st_ino),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_file_chunks(self, path: str, stat: os.stat_result, chunks: List[str]):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, chunks) VALUES (?, ?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, json.dumps(chunks)),
+            )
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class ChunkStore:
+    # Content-addressed chunk store on top of regular storages. Chunks live at
+    # `<prefix>/chunks/<aa>/<digest>` and every snapshot is a small JSON
+    # manifest listing the chunks of each file.
+
+    def __init__(
+        self,
+        storages: List[Storage],
+        index: ChunkIndex,
+        prefix: str,
+        chunker: ContentDefinedChunker,
+        workers: int = CHUNK_UPLOAD_WORKERS,
+        throttles: List[Throttle | None] | None = None,
+    ):
+        self.storages = storages
+        self.index = index
+        self.prefix = prefix
+        self.chunker = chunker
+        self.workers = workers
+        self.throttles = throttles or []
+        self.storage_keys = [storage.get_key() for storage in storages]
+        self.known: Dict[str, Set[str]] = {key: index.load_known_chunks(key) for key in self.storage_keys}
+        self.errors: Dict[str, Exception] = {}
+        self.uploaded_chunks = 0
+        self.uploaded_bytes = 0
+        self.submitted: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def get_chunk_path(self, digest: str) -> str:
+        return get_chunk_path(self.prefix, digest)
+
+    def is_known_everywhere(self, digests: List[str]) -> bool:
+        return all(digest in self.known[key] for key in self.storage_keys for digest in digests)
+
+    def upload_chunk(self, digest: str, chunk: bytes):
+        for storage, key in zip(self.storages, self.storage_keys):
+            with self.lock:
+                if key in self.errors or digest in self.known[key]:
+                    continue
+            try:
+                storage.upload_stream(io.BytesIO(chunk), self.get_chunk_path(digest))
+            except Exception as e:
+                logger.warning("ChunkStore -> upload of chunk %s failed in %s: %s", digest, storage.describe(), e)
+                with self.lock:
+                    self.errors.setdefault(key, e)
+                continue
+            with self.lock:
+                self.known[key].add(digest)
+                self.uploaded_chunks += 1
+                self.uploaded_bytes += len(chunk)
+            self.index.add_known_chunk(key, digest)
+
+    def add_file(self, path: str, executor: ThreadPoolExecutor, pending: List) -> List[str]:
+        stat = os.stat(path)
+        digests = self.index.get_file_chunks(path, stat)
+        if digests is not None and self.is_known_everywhere(digests):
+            return digests
+
+        digests = []
+        with open(path, 'rb') as f:
+            for digest, chunk in self.chunker.iter_chunks(throttled(f, self.throttles)):  # type: ignore
+                digests.append(digest)
+                if digest not in self.submitted and not self.is_known_everywhere([digest]):
+                    self.submitted.add(digest)
+                    pending.append(executor.submit(self.upload_chunk, digest, chunk))
+                # Keep the number of chunks held in memory bounded.
+                while len(pending) > self.workers * 2:
+                    pending.pop(0).result()
+        self.index.set_file_chunks(path, stat, digests)
+        return digests
+
+    def snapshot(self, dirpath: str) -> Tuple[dict, Dict[str, Exception]]:
+        logger.info("ChunkStore -> snapshot('%s')", dirpath)
+        root = os.path.basename(os.path.normpath(dirpath))
+        manifest: dict = {'version': 1, 'root': root, 'directories': [], 'files': []}
+        pending: List = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for current, dirnames, filenames in os.walk(dirpath):
+                dirnames.sort()
+                relative_dir = os.path.relpath(current, dirpath)
+                manifest['directories'].append(relative_dir)
+                for filename in sorted(filenames):
+                    path = os.path.join(current, filename)
+                    if not os.path.isfile(path):
+                        continue
+                    stat = os.stat(path)
+                    manifest['files'].append({
+                        'path': os.path.normpath(os.path.join(relative_dir, filename)),
+                        'size': stat.st_size,
+                        'mode': stat.st_mode & 0o7777,
+                        'mtime': stat.st_mtime,
+                        'chunks': self.add_file(path, executor, pending),
+                    })
+            for future in pending:
+                future.result()
+
+        self.index.commit()
+        logger.info("ChunkStore -> uploaded %s new chunks (%s bytes)", self.uploaded_chunks, self.uploaded_bytes)
+        return manifest, dict(self.errors)
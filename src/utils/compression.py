@@ -0,0 +1,165 @@
+import gzip
+import io
+import logging
+import lzma
+import os
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Deque, Dict, Type
+
+from utils.io import ProcessFilterReader
+
+logger = logging.getLogger(__name__)
+
+
+CODEC_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class Codec(ABC):
+
+    name = ''
+    extension = ''
+
+    def __init__(self, level: int | None = None, threads: int | None = None, block_size: int = CODEC_BLOCK_SIZE):
+        self.level = level
+        self.threads = int(threads or os.cpu_count() or 1)
+        self.block_size = int(block_size)
+
+    @abstractmethod
+    def compress(self, fileobj: BinaryIO) -> BinaryIO:
+        pass
+
+    @abstractmethod
+    def decompress(self, fileobj: BinaryIO) -> BinaryIO:
+        pass
+
+    def get_metadata(self) -> dict:
+        return {'codec': self.name, 'codec-level': str(self.level)}
+
+
+class BlockCodec(Codec):
+    # Codecs whose format allows concatenating independently compressed
+    # members (gzip, xz). Blocks are compressed on a thread pool (zlib and
+    # lzma release the GIL) and written out in order.
+
+    @abstractmethod
+    def compress_block(self, data: bytes) -> bytes:
+        pass
+
+    def compress(self, fileobj: BinaryIO) -> BinaryIO:
+        return ParallelCompressingReader(fileobj, self)  # type: ignore
+
+
+class GzipCodec(BlockCodec):
+
+    name = 'gzip'
+    extension = 'gz'
+
+    def __init__(self, level: int | None = 6, threads: int | None = None, block_size: int = CODEC_BLOCK_SIZE):
+        super(GzipCodec, self).__init__(6 if level is None else level, threads, block_size)
+
+    def compress_block(self, data: bytes) -> bytes:
+        return gzip.compress(data, compresslevel=self.level, mtime=0)  # type: ignore
+
+    def decompress(self, fileobj: BinaryIO) -> BinaryIO:
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')  # type: ignore
+
+
+class XzCodec(BlockCodec):
+
+    name = 'xz'
+    extension = 'xz'
+
+    def __init__(self, level: int | None = 6, threads: int | None = None, block_size: int = CODEC_BLOCK_SIZE):
+        super(XzCodec, self).__init__(6 if level is None else level, threads, block_size)
+
+    def compress_block(self, data: bytes) -> bytes:
+        return lzma.compress(data, preset=self.level)
+
+    def decompress(self, fileobj: BinaryIO) -> BinaryIO:
+        return lzma.LZMAFile(fileobj, mode='rb')  # type: ignore
+
+
+class ZstdCodec(Codec):
+    # Runs the zstd binary, which compresses with its own worker threads.
+
+    name = 'zstd'
+    extension = 'zst'
+
+    def __init__(self, level: int | None = 3, threads: int | None = None, block_size: int = CODEC_BLOCK_SIZE):
+        super(ZstdCodec, self).__init__(3 if level is None else level, threads, block_size)
+
+    def compress(self, fileobj: BinaryIO) -> BinaryIO:
+        args = ['zstd', '-q', '-c', '-%s' % self.level, '-T%s' % self.threads]
+        if self.level > 19:  # type: ignore
+            args.append('--ultra')
+        return ProcessFilterReader(fileobj, args, 'zstd')  # type: ignore
+
+    def decompress(self, fileobj: BinaryIO) -> BinaryIO:
+        return ProcessFilterReader(fileobj, ['zstd', '-q', '-d', '-c'], 'zstd')  # type: ignore
+
+
+class ParallelCompressingReader(io.RawIOBase):
+
+    def __init__(self, fileobj: BinaryIO, codec: BlockCodec):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.executor = ThreadPoolExecutor(max_workers=codec.threads)
+        self.pending: Deque[Future] = deque()
+        self.buffer = memoryview(b'')
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        while not self.eof and len(self.pending) < self.codec.threads * 2:
+            data = self.fileobj.read(self.codec.block_size)
+            if not data:
+                self.eof = True
+                break
+            self.pending.append(self.executor.submit(self.codec.compress_block, data))
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            self.fill()
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        super(ParallelCompressingReader, self).close()
+
+
+CODECS: Dict[str, Type[Codec]] = {
+    GzipCodec.name: GzipCodec,
+    XzCodec.name: XzCodec,
+    ZstdCodec.name: ZstdCodec,
+}
+
+CODECS_BY_EXTENSION = {codec.extension: codec for codec in CODECS.values()}
+
+
+def build_codec(compression: dict | None) -> Codec | None:
+    if not compression or compression.get('codec') in (None, 'none'):
+        return None
+    codec = compression['codec']
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec: %s" % codec)
+    return CODECS[codec](
+        level=compression.get('level'),
+        threads=compression.get('threads'),
+        block_size=compression.get('block_size', CODEC_BLOCK_SIZE),
+    )
+
+
+def detect_codec(filename: str) -> Codec | None:
+    extension = os.path.splitext(filename)[1].lstrip('.')
+    codec = CODECS_BY_EXTENSION.get(extension)
+    return codec() if codec else None
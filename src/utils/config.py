@@ -1,7 +1,10 @@
 import logging
 import os
+from typing import Dict, List, Tuple
 
 import yaml
+from utils.environment import Environment
+from utils.plugins import NOTIFIERS, STORAGES, TARGETS, PluginRegistry
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +15,55 @@ class Config:
     def load_config_from_string(plain_text):
         return yaml.safe_load(plain_text)
 
+    @staticmethod
+    def load_config_from_file(path: str):
+        with open(path) as f:
+            return yaml.safe_load(f)
+
+    @staticmethod
+    def load_namespaces(environment: Environment) -> Dict[str | None, dict]:
+        # Builder configs by namespace; the old-style config has none.
+        # BACKUP_CONFIG_FILE takes precedence over an inline BACKUP_CONFIG.
+        if environment.USE_CONFIG == 'on':  # type: ignore
+            if environment.CONFIG_FILE:  # type: ignore
+                namespaces = Config.load_config_from_file(environment.CONFIG_FILE)  # type: ignore
+            else:
+                namespaces = Config.load_config_from_string(environment.CONFIG)  # type: ignore
+        else:
+            namespaces = {None: Config.load_config_from_old_style()}
+        Config.validate(namespaces)
+        return namespaces
+
+    @staticmethod
+    def validate(namespaces) -> None:
+        # Checks the structure and the backend types of every namespace
+        # without importing any backend, so a typo fails at startup instead
+        # of at the first run.
+        if not isinstance(namespaces, dict) or not namespaces:
+            raise ValueError("Config must be a non-empty mapping of namespaces")
+        errors: List[str] = []
+        for namespace, builder_config in namespaces.items():
+            name = namespace or '-'
+            if not isinstance(builder_config, dict):
+                errors.append("%s: must be a mapping" % name)
+                continue
+            sections: List[Tuple[str, object, PluginRegistry]] = [('target', builder_config.get('target'), TARGETS)]
+            for key, registry in (('storages', STORAGES), ('notifiers', NOTIFIERS)):
+                items = builder_config.get(key) or []
+                if not isinstance(items, list):
+                    errors.append("%s: `%s` must be a list" % (name, key))
+                    continue
+                sections.extend(('%s[%s]' % (key, index), item, registry) for index, item in enumerate(items))
+            for path, section, registry in sections:
+                if not isinstance(section, dict):
+                    errors.append("%s: `%s` must be a mapping" % (name, path))
+                elif section.get('type') not in registry:
+                    errors.append("%s: `%s` has an unknown type `%s`" % (name, path, section.get('type')))
+                elif not isinstance(section.get('params', {}), dict):
+                    errors.append("%s: `%s.params` must be a mapping" % (name, path))
+        if errors:
+            raise ValueError("Invalid config: %s" % '; '.join(errors))
+
     @staticmethod
     def load_config_from_old_style():
         return {
@@ -47,3 +99,42 @@ class Config:
                 }
             ]
         }
+
+
+class ConfigStore:
+    # The namespaces of the scheduler, parsed and validated once at startup.
+    # With BACKUP_CONFIG_FILE the file is read again only when its mtime,
+    # size or inode changed; a changed file that fails to load or validate is
+    # logged and the previous namespaces are kept.
+
+    def __init__(self, environment: Environment):
+        self.environment = environment
+        self.namespaces: Dict[str | None, dict] = {}
+        self.signature: Tuple | None = None
+        self.version = 0
+
+    def get_signature(self) -> Tuple | None:
+        if self.environment.USE_CONFIG != 'on' or not self.environment.CONFIG_FILE:  # type: ignore
+            return None
+        stat = os.stat(self.environment.CONFIG_FILE)  # type: ignore
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def load(self) -> Dict[str | None, dict]:
+        signature = self.get_signature()
+        self.namespaces = Config.load_namespaces(self.environment)
+        self.signature = signature
+        self.version += 1
+        return self.namespaces
+
+    def reload(self) -> bool:
+        # Returns whether the namespaces changed.
+        try:
+            if self.get_signature() == self.signature:
+                return False
+            previous = self.namespaces
+            self.load()
+        except Exception as e:
+            logger.error("Failed to reload the config, keeping the previous one: %s" % e)
+            return False
+        logger.info("Config reloaded (version %s)" % self.version)
+        return self.namespaces != previous
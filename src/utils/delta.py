@@ -0,0 +1,250 @@
+import errno
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+DELTA_BLOCK_SIZE = 256 * 1024
+# Every n-th run of a chain uploads the whole file again, so a restore never
+# reads more than n blobs and old blobs can be pruned.
+DELTA_FULL_EVERY = 7
+
+# (weak, strong) of a block: Adler-32 is cheap enough to compare every block
+# first, SHA-256 decides.
+Signature = Tuple[int, bytes]
+# (source, offset) of a block: the blob holding it and its index in there.
+BlockRef = Tuple[str, int]
+
+
+def get_data_ranges(fd: int, size: int) -> List[Tuple[int, int]]:
+    # [start, end) of the regions of a sparse file that hold data, from
+    # SEEK_DATA/SEEK_HOLE. Filesystems without them report a single region.
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+    ranges = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left.
+                break
+            return [(0, size)]
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        ranges.append((start, end))
+        offset = end
+    return ranges
+
+
+def encode_extents(blocks: List[BlockRef | None]) -> Tuple[List[str], List[list]]:
+    # Runs of blocks stored back to back in the same blob become one
+    # [first block, count, source, offset] extent. Holes are left out.
+    sources: List[str] = []
+    extents: List[list] = []
+    for index, block in enumerate(blocks):
+        if block is None:
+            continue
+        source, offset = block
+        if source not in sources:
+            sources.append(source)
+        source_index = sources.index(source)
+        if extents:
+            first, count, last_source, last_offset = extents[-1]
+            if first + count == index and last_source == source_index and last_offset + count == offset:
+                extents[-1][1] += 1
+                continue
+        extents.append([index, 1, source_index, offset])
+    return sources, extents
+
+
+def decode_extents(manifest: dict) -> List[BlockRef | None]:
+    blocks: List[BlockRef | None] = [None] * get_block_count(manifest['size'], manifest['block_size'])
+    for first, count, source, offset in manifest['extents']:
+        for index in range(count):
+            blocks[first + index] = (manifest['sources'][source], offset + index)
+    return blocks
+
+
+def get_block_count(size: int, block_size: int) -> int:
+    return (size + block_size - 1) // block_size
+
+
+class DeltaIndex:
+    # Local SQLite index of the version every storage holds: its manifest,
+    # the fingerprint (size, mtime, inode) of the file it was made from and
+    # the signature of each block. Storages that missed a run keep their
+    # older version and get a delta against it.
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS versions (
+                storage TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                manifest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS signatures (
+                version TEXT NOT NULL,
+                block INTEGER NOT NULL,
+                weak INTEGER NOT NULL,
+                strong BLOB NOT NULL,
+                PRIMARY KEY (version, block)
+            ) WITHOUT ROWID;
+        ''')
+
+    def get_version(self, storage_key: str) -> dict | None:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT version, manifest, size, mtime_ns, inode FROM versions WHERE storage = ?', (storage_key,),
+            ).fetchone()
+        if row is None:
+            return None
+        version, manifest, size, mtime_ns, inode = row
+        return {'version': version, 'manifest': json.loads(manifest), 'size': size, 'mtime_ns': mtime_ns, 'inode': inode}
+
+    def get_signatures(self, version: str) -> Dict[int, Signature]:
+        with self.lock:
+            rows = self.connection.execute('SELECT block, weak, strong FROM signatures WHERE version = ?', (version,))
+            return {block: (weak, strong) for block, weak, strong in rows}
+
+    def add_version(self, version: str, signatures: Dict[int, Signature]):
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO signatures (version, block, weak, strong) VALUES (?, ?, ?, ?)',
+                ((version, block, weak, strong) for block, (weak, strong) in signatures.items()),
+            )
+
+    def set_version(self, storage_key: str, version: str, manifest: dict, stat: os.stat_result):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO versions (storage, version, manifest, size, mtime_ns, inode) VALUES (?, ?, ?, ?, ?, ?)',
+                (storage_key, version, json.dumps(manifest), stat.st_size, stat.st_mtime_ns, stat.st_ino),
+            )
+
+    def remove_unused(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM signatures WHERE version NOT IN (SELECT version FROM versions)')
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class DeltaReader(io.RawIOBase):
+    # Reads a file block by block and returns only the blocks the previous
+    # version does not have: the blob of one run. Blocks that are unchanged
+    # or moved to another block-aligned offset keep pointing into older
+    # blobs; holes and blocks of zeroes are not stored at all. `blocks` and
+    # `signatures` describe the new version once the reader is exhausted.
+
+    def __init__(self, fileobj: BinaryIO, size: int, block_size: int, source: str, previous: dict | None = None, signatures: Dict[int, Signature] | None = None):
+        self.fileobj = fileobj
+        self.size = size
+        self.block_size = block_size
+        self.source = source
+        self.previous_blocks = decode_extents(previous) if previous is not None else []
+        self.previous_signatures = signatures or {}
+        self.previous_by_weak: Dict[int, List[int]] = {}
+        for index, (weak, _) in self.previous_signatures.items():
+            self.previous_by_weak.setdefault(weak, []).append(index)
+        self.blocks: List[BlockRef | None] = []
+        self.signatures: Dict[int, Signature] = {}
+        self.new_blocks: Dict[bytes, BlockRef] = {}
+        self.changed_bytes = 0
+        self.chunks = self.iter_new_blocks()
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def find_block(self, index: int, data: bytes) -> Tuple[BlockRef | None, Signature]:
+        # The block at `index` of the previous version is compared first;
+        # otherwise every previous block with the same weak checksum.
+        weak = zlib.adler32(data)
+        strong = None
+        candidates = self.previous_by_weak.get(weak, [])
+        if index in candidates:
+            candidates = [index] + [candidate for candidate in candidates if candidate != index]
+        for candidate in candidates:
+            strong = strong or hashlib.sha256(data).digest()
+            if self.previous_signatures[candidate][1] == strong and candidate < len(self.previous_blocks):
+                return self.previous_blocks[candidate], (weak, strong)
+        strong = strong or hashlib.sha256(data).digest()
+        return self.new_blocks.get(strong), (weak, strong)
+
+    def iter_new_blocks(self) -> Iterator[bytes]:
+        ranges = get_data_ranges(self.fileobj.fileno(), self.size)
+        zeroes = bytes(self.block_size)
+        range_index = 0
+        position = -1
+        for index in range(get_block_count(self.size, self.block_size)):
+            start = index * self.block_size
+            length = min(self.block_size, self.size - start)
+            while range_index < len(ranges) and ranges[range_index][1] <= start:
+                range_index += 1
+            if range_index == len(ranges) or ranges[range_index][0] >= start + length:
+                self.blocks.append(None)
+                continue
+            if position != start:
+                self.fileobj.seek(start)
+            data = self.fileobj.read(length)
+            position = start + len(data)
+            if len(data) != length:
+                raise IOError("%s shrank while it was read" % self.fileobj.name)
+            if data == zeroes[:length]:
+                self.blocks.append(None)
+                continue
+            block, signature = self.find_block(index, data)
+            self.signatures[index] = signature
+            if block is None:
+                block = (self.source, len(self.new_blocks))
+                self.new_blocks[signature[1]] = block
+                self.changed_bytes += length
+                self.blocks.append(block)
+                yield data
+            else:
+                self.blocks.append(block)
+
+    def get_extents(self) -> Tuple[List[str], List[list]]:
+        return encode_extents(self.blocks)
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = memoryview(chunk)
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        self.chunks.close()
+        super(DeltaReader, self).close()
+
+
+def read_block(fileobj: BinaryIO, size: int) -> bytes:
+    # Decompressing streams may return less than asked for.
+    data = b''
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
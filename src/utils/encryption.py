@@ -0,0 +1,237 @@
+import base64
+import io
+import logging
+import os
+import struct
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Callable, Deque, Tuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from utils.io import read_full
+
+logger = logging.getLogger(__name__)
+
+
+ENCRYPTION_EXTENSION = 'enc'
+ENCRYPTION_CHUNK_SIZE = 1024 * 1024
+ENCRYPTION_MAGIC = b'BKENC'
+ENCRYPTION_VERSION = 1
+ENCRYPTION_SALT_SIZE = 16
+ENCRYPTION_TAG_SIZE = 16
+ENCRYPTION_KDF_INFO = b'backup-encryption-v1'
+
+# magic, version, chunk size, salt, key id length; followed by the key id.
+HEADER_FORMAT = '>5sBI%ssB' % ENCRYPTION_SALT_SIZE
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+class EncryptionError(Exception):
+    pass
+
+
+class Encryption:
+    # Chunked AES-256-GCM. Every artifact gets its own key, derived with HKDF
+    # from the master key and a random salt in its header, so chunk nonces
+    # can simply count from zero. Chunks have a fixed plaintext size, which
+    # puts chunk N at a known offset and lets ranges be decrypted without
+    # reading what precedes them. The header, the chunk index and a
+    # last-chunk flag are authenticated with every chunk, so reordered,
+    # dropped or truncated chunks fail to decrypt.
+    #
+    # Layout: header | chunk 0 | chunk 1 | ... where each chunk is the
+    # ciphertext of `chunk_size` bytes (less for the last one) plus a 16 byte
+    # tag. An empty artifact still has one empty last chunk.
+
+    def __init__(self, key: bytes, key_id: str = '', chunk_size: int = ENCRYPTION_CHUNK_SIZE, threads: int | None = None):
+        if len(key) != 32:
+            raise ValueError("Encryption keys must be 32 bytes (AES-256), got %s" % len(key))
+        self.key = key
+        self.key_id = key_id
+        self.chunk_size = int(chunk_size)
+        self.threads = int(threads or os.cpu_count() or 1)
+
+    @classmethod
+    def from_config(cls, config: dict | None, default_key: str | None = None) -> 'Encryption | None':
+        # The key (base64) comes from `key`, the environment variable named by
+        # `key_env` or the file at `key_file`; without any of them, from
+        # BACKUP_ENCRYPTION_KEY.
+        config = config or {}
+        if config.get('enabled') is False:
+            return None
+        if config.get('key'):
+            encoded = config['key']
+        elif config.get('key_env'):
+            encoded = os.environ.get(config['key_env'])
+            if not encoded:
+                raise ValueError("Environment variable %s with the encryption key is not set" % config['key_env'])
+        elif config.get('key_file'):
+            with open(config['key_file']) as f:
+                encoded = f.read().strip()
+        else:
+            encoded = default_key
+        if not encoded:
+            if config:
+                raise ValueError("No encryption key configured")
+            return None
+        return cls(
+            base64.b64decode(encoded),
+            key_id=config.get('key_id', ''),
+            chunk_size=config.get('chunk_size', ENCRYPTION_CHUNK_SIZE),
+            threads=config.get('threads'),
+        )
+
+    def get_metadata(self) -> dict:
+        return {'encryption': 'aes-256-gcm', 'encryption-key-id': self.key_id}
+
+    def encrypt(self, fileobj: BinaryIO) -> BinaryIO:
+        return EncryptingReader(fileobj, self)  # type: ignore
+
+    def decrypt(self, fileobj: BinaryIO) -> BinaryIO:
+        return DecryptingReader(fileobj, self)  # type: ignore
+
+    def create_header(self) -> Tuple[bytes, AESGCM]:
+        salt = os.urandom(ENCRYPTION_SALT_SIZE)
+        key_id = self.key_id.encode()
+        header = struct.pack(HEADER_FORMAT, ENCRYPTION_MAGIC, ENCRYPTION_VERSION, self.chunk_size, salt, len(key_id)) + key_id
+        return header, AESGCM(self.derive_key(salt))
+
+    def parse_header(self, read: Callable[[int], bytes]) -> Tuple[bytes, int, AESGCM]:
+        # Returns the header, the chunk size and the artifact's cipher.
+        fixed = read(HEADER_SIZE)
+        if len(fixed) != HEADER_SIZE:
+            raise EncryptionError("Truncated encryption header")
+        magic, version, chunk_size, salt, key_id_size = struct.unpack(HEADER_FORMAT, fixed)
+        if magic != ENCRYPTION_MAGIC or version != ENCRYPTION_VERSION:
+            raise EncryptionError("Not an encrypted artifact (or an unsupported version)")
+        key_id = read(key_id_size)
+        if key_id.decode() != self.key_id:
+            logger.warning("Artifact was encrypted with key `%s`, decrypting with key `%s`" % (key_id.decode(), self.key_id))
+        return fixed + key_id, chunk_size, AESGCM(self.derive_key(salt))
+
+    def derive_key(self, salt: bytes) -> bytes:
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=ENCRYPTION_KDF_INFO).derive(self.key)
+
+    @staticmethod
+    def get_nonce(index: int) -> bytes:
+        return struct.pack('>4xQ', index)
+
+    @staticmethod
+    def get_aad(header: bytes, index: int, last: bool) -> bytes:
+        return header + struct.pack('>QB', index, last)
+
+    def encrypt_chunk(self, cipher: AESGCM, header: bytes, index: int, data: bytes, last: bool) -> bytes:
+        return cipher.encrypt(self.get_nonce(index), data, self.get_aad(header, index, last))
+
+    def decrypt_chunk(self, cipher: AESGCM, header: bytes, index: int, data: bytes, last: bool) -> bytes:
+        try:
+            return cipher.decrypt(self.get_nonce(index), data, self.get_aad(header, index, last))
+        except InvalidTag:
+            raise EncryptionError("Chunk %s failed authentication (wrong key, corrupt or truncated artifact)" % index)
+
+    def read_range(self, read_range: Callable[[int, int], bytes], size: int, offset: int, length: int) -> bytes:
+        # Decrypts `length` plaintext bytes at `offset` of an artifact of
+        # `size` encrypted bytes, fetching only the header and the chunks
+        # covering the range through `read_range(offset, length)`.
+        position = [0]
+
+        def read(count: int) -> bytes:
+            data = read_range(position[0], count)
+            position[0] += len(data)
+            return data
+
+        header, chunk_size, cipher = self.parse_header(read)
+        stored_chunk_size = chunk_size + ENCRYPTION_TAG_SIZE
+        chunk_count = max((size - len(header) + stored_chunk_size - 1) // stored_chunk_size, 1)
+        first = offset // chunk_size
+        last = min((offset + length - 1) // chunk_size, chunk_count - 1) if length > 0 else first
+        if first >= chunk_count:
+            return b''
+        start = len(header) + first * stored_chunk_size
+        data = read_range(start, min((last - first + 1) * stored_chunk_size, size - start))
+        plaintext = []
+        for index in range(first, last + 1):
+            chunk = data[(index - first) * stored_chunk_size:(index - first + 1) * stored_chunk_size]
+            plaintext.append(self.decrypt_chunk(cipher, header, index, chunk, index == chunk_count - 1))
+        skip = offset - first * chunk_size
+        return b''.join(plaintext)[skip:skip + length]
+
+
+class ChunkedCryptReader(io.RawIOBase):
+    # Runs `process(index, chunk, last)` over consecutive chunks of `fileobj`
+    # on a thread pool (OpenSSL's AES-GCM runs without the GIL) and returns
+    # the results in order. One chunk is read ahead to know which one is the
+    # last.
+
+    def __init__(self, fileobj: BinaryIO, encryption: Encryption):
+        self.fileobj = fileobj
+        self.encryption = encryption
+        self.executor = ThreadPoolExecutor(max_workers=encryption.threads)
+        self.pending: Deque[Future] = deque()
+        self.buffer = memoryview(b'')
+        self.index = 0
+        self.next: bytes | None = None
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def read_chunk(self) -> bytes:
+        raise NotImplementedError
+
+    def process(self, index: int, chunk: bytes, last: bool) -> bytes:
+        raise NotImplementedError
+
+    def fill(self):
+        while not self.eof and len(self.pending) < self.encryption.threads * 2:
+            chunk = self.read_chunk() if self.next is None else self.next
+            self.next = self.read_chunk()
+            last = not self.next
+            self.pending.append(self.executor.submit(self.process, self.index, chunk, last))
+            self.index += 1
+            self.eof = last
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            self.fill()
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        super(ChunkedCryptReader, self).close()
+
+
+class EncryptingReader(ChunkedCryptReader):
+
+    def __init__(self, fileobj: BinaryIO, encryption: Encryption):
+        super(EncryptingReader, self).__init__(fileobj, encryption)
+        self.header, self.cipher = encryption.create_header()
+        self.buffer = memoryview(self.header)
+
+    def read_chunk(self) -> bytes:
+        return read_full(self.fileobj, self.encryption.chunk_size)
+
+    def process(self, index: int, chunk: bytes, last: bool) -> bytes:
+        return self.encryption.encrypt_chunk(self.cipher, self.header, index, chunk, last)
+
+
+class DecryptingReader(ChunkedCryptReader):
+
+    def __init__(self, fileobj: BinaryIO, encryption: Encryption):
+        super(DecryptingReader, self).__init__(fileobj, encryption)
+        self.header, self.chunk_size, self.cipher = encryption.parse_header(lambda size: read_full(fileobj, size))
+
+    def read_chunk(self) -> bytes:
+        return read_full(self.fileobj, self.chunk_size + ENCRYPTION_TAG_SIZE)
+
+    def process(self, index: int, chunk: bytes, last: bool) -> bytes:
+        return self.encryption.decrypt_chunk(self.cipher, self.header, index, chunk, last)
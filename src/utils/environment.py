@@ -11,6 +11,20 @@ ENVS = {
     'CRON_EXPRESSION': None,
     'USE_CONFIG': None,
     'CONFIG': None,
+    'CONFIG_FILE': None,
+    'STATE_DIR': '/var/lib/backup',
+    'MAX_WORKERS': '4',
+    'WORKER_START_METHOD': 'forkserver',
+    'RESOURCE_LIMITS': None,
+    'THROTTLE': None,
+    'METRICS_PORT': None,
+    'METRICS_TEXTFILE': None,
+    'ENCRYPTION_KEY': None,
+    'LOG_FORMAT': 'json',
+    'LOG_LEVEL': 'INFO',
+    'CLUSTER': None,
+    'CLUSTER_NODE_ID': None,
+    'CLUSTER_LEASE_TTL': '60',
 }
 
 
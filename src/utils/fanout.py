@@ -0,0 +1,210 @@
+import io
+import logging
+import queue
+import threading
+import time
+from typing import BinaryIO, Dict, List
+
+from utils.checksums import CHECKSUM_PART_SIZE, StreamDigest
+from utils.logs import bind_log_context
+from utils.storages.base import Storage
+
+logger = logging.getLogger(__name__)
+
+
+FANOUT_CHUNK_SIZE = 1024 * 1024
+FANOUT_QUEUE_SIZE = 16
+FANOUT_PUT_TIMEOUT = 0.5
+
+_EOF = object()
+
+
+class FanOutResult:
+
+    def __init__(self, storage: Storage, output: str | None = None):
+        self.storage = storage
+        self.output = output
+        self.error: Exception | None = None
+        self.bytes_written = 0
+        self.checksum: str | None = None
+        # Sidecar manifest entry of the uploaded object, and of every object
+        # for results merged from several uploads.
+        self.digest: dict | None = None
+        self.files: Dict[str, dict] = {}
+        self.started_at = time.monotonic()
+        self.finished_at: float | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+
+class _SourceError:
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class QueueReader(io.RawIOBase):
+    # File-like view over a queue of chunks fed by FanOut. Storages consume it
+    # with their regular upload_stream implementation.
+
+    def __init__(self, chunks: queue.Queue, result: FanOutResult):
+        self.chunks = chunks
+        self.result = result
+        self.buffer = memoryview(b'')
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.buffer:
+            if self.eof:
+                return 0
+            chunk = self.chunks.get()
+            if isinstance(chunk, _SourceError):
+                raise chunk.error
+            if chunk is _EOF:
+                self.eof = True
+                return 0
+            self.buffer = memoryview(chunk)
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.result.bytes_written += size
+        return size
+
+
+class FanOut:
+    # Reads a source once and tees its chunks to every storage concurrently.
+    # Each storage gets a bounded queue, so the source is only read as fast as
+    # the slowest healthy storage accepts data, while a failed storage is
+    # dropped from the fan-out instead of stalling the others.
+
+    def __init__(self, storages: List[Storage], chunk_size: int = FANOUT_CHUNK_SIZE, queue_size: int = FANOUT_QUEUE_SIZE):
+        self.storages = storages
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        # Time spent waiting on the source and bytes read from it, e.g. to
+        # tell a slow dump or compressor apart from slow storages.
+        self.read_seconds = 0.0
+        self.bytes_read = 0
+        # Parts are digested at the part size of the first storage that
+        # derives its ETags from them (S3), so its ETag can be predicted.
+        configs = [storage.get_multipart_config() for storage in storages]
+        part_size = next((config[1] for config in configs if config is not None), CHECKSUM_PART_SIZE)
+        self.digest = StreamDigest(part_size)
+
+    def upload(self, fileobj: BinaryIO, output: str, metadata: dict | None = None) -> List[FanOutResult]:
+        logger.info("FanOut -> upload('%s') to %s storages", output, len(self.storages))
+        results = [FanOutResult(storage, output) for storage in self.storages]
+        queues: List[queue.Queue] = [queue.Queue(maxsize=self.queue_size) for _ in self.storages]
+        done = [threading.Event() for _ in self.storages]
+
+        def consume(index: int):
+            result = results[index]
+            try:
+                # Buffered, so read(n) returns n bytes until EOF: S3 turns every
+                # read of an unseekable stream into one multipart part, and all
+                # parts but the last must be at least 5 MiB.
+                with io.BufferedReader(QueueReader(queues[index], result), self.chunk_size) as reader:
+                    result.storage.upload_stream(reader, output, metadata)  # type: ignore
+                duration = time.monotonic() - result.started_at
+                logger.info("FanOut -> uploaded '%s' to %s in %.1f seconds", output, result.storage.describe(), duration, extra={
+                    'storage': result.storage.describe(), 'bytes': result.bytes_written, 'duration': duration,
+                })
+            except Exception as e:
+                logger.warning("FanOut -> %s failed: %s", type(result.storage).__name__, e)
+                result.error = e
+            finally:
+                result.finished_at = time.monotonic()
+                done[index].set()
+
+        threads = [threading.Thread(target=bind_log_context(consume), args=(index,), daemon=True) for index in range(len(self.storages))]
+        for thread in threads:
+            thread.start()
+
+        def put(index: int, chunk):
+            while not done[index].is_set():
+                try:
+                    queues[index].put(chunk, timeout=FANOUT_PUT_TIMEOUT)
+                    return
+                except queue.Full:
+                    continue
+
+        try:
+            while not all(event.is_set() for event in done):
+                read_started_at = time.monotonic()
+                chunk = fileobj.read(self.chunk_size)
+                self.read_seconds += time.monotonic() - read_started_at
+                if not chunk:
+                    break
+                self.bytes_read += len(chunk)
+                self.digest.update(chunk)
+                for index in range(len(self.storages)):
+                    put(index, chunk)
+            for index in range(len(self.storages)):
+                put(index, _EOF)
+        except Exception as e:
+            for index in range(len(self.storages)):
+                put(index, _SourceError(e))
+
+        for thread in threads:
+            thread.join()
+
+        for result in results:
+            if not result.ok:
+                continue
+            if result.bytes_written != self.bytes_read:
+                # The storage returned before consuming the whole stream.
+                result.error = IOError("%s of %s bytes uploaded" % (result.bytes_written, self.bytes_read))
+                logger.warning("FanOut -> upload of '%s' incomplete in %s: %s", result.output, result.storage.describe(), result.error)
+            else:
+                result.checksum = self.digest.get_checksum()
+                result.digest = self.get_digest(result.storage)
+                self.check(result)
+        return results
+
+    def get_digest(self, storage: Storage) -> dict:
+        digest = self.digest.get_manifest()
+        config = storage.get_multipart_config()
+        if config is not None and config[1] == self.digest.part_size:
+            digest['etag'] = self.digest.get_etag(config[0])
+        return digest
+
+    def check(self, result: FanOutResult):
+        # Compares the stored object's size, and its ETag where the storage
+        # has one, with what was streamed. A metadata request per storage, no
+        # data is read back.
+        try:
+            stat = result.storage.stat(result.output)  # type: ignore
+            if stat['size'] != self.bytes_read:
+                raise IOError("stored size %s != %s bytes uploaded" % (stat['size'], self.bytes_read))
+            etag = result.digest.get('etag')  # type: ignore
+            if etag and stat.get('etag') and stat['etag'] != etag:
+                raise IOError("stored ETag %s != %s computed during upload" % (stat['etag'], etag))
+        except Exception as e:
+            logger.warning("FanOut -> verification of '%s' failed in %s: %s", result.output, result.storage.describe(), e)
+            result.error = e
+
+
+def merge_upload_results(storages: List[Storage], uploads: List[List[FanOutResult]]) -> List[FanOutResult]:
+    # Folds the results of several fan-out uploads (e.g. one per file of a
+    # multi-file artifact) into one result per storage.
+    merged = {storage.get_key(): FanOutResult(storage) for storage in storages}
+    for results in uploads:
+        for result in results:
+            total = merged[result.storage.get_key()]
+            total.bytes_written += result.bytes_written
+            total.started_at = min(total.started_at, result.started_at)
+            total.finished_at = max(total.finished_at or 0, result.finished_at or 0)
+            if total.error is None:
+                total.error = result.error
+            if result.digest is not None:
+                total.files[result.output] = result.digest  # type: ignore
+    return list(merged.values())
@@ -1,4 +1,6 @@
 import logging
+import os
+import random
 import time
 from typing import Callable
 
@@ -17,12 +19,12 @@ def retry_if_exception(times: int, sleep: int):
                     return result
                 except Exception as e:
                     exc = e
-                    logger.warn(e)
+                    logger.warning(e)
 
-                    logger.info("Sleep %s seconds" % sleep)
+                    logger.info("Sleep %s seconds", sleep)
                     time.sleep(sleep)
 
-                    logger.info("Retry (left attemps: %s) ..." % _times)
+                    logger.info("Retry (left attemps: %s) ...", _times)
             raise exc
         return _func
 
@@ -41,13 +43,68 @@ def retry_if_exception_for_method(times: int, sleep: int):
                     return result
                 except Exception as e:
                     exc = e
-                    logger.warn(e)
+                    logger.warning(e)
 
-                    logger.info("Sleep %s seconds" % sleep)
+                    logger.info("Sleep %s seconds", sleep)
                     time.sleep(sleep)
 
-                    logger.info("Retry (left attemps: %s) ..." % _times)
+                    logger.info("Retry (left attemps: %s) ...", _times)
 
             raise exc
         return _func
     return _retry
+
+
+class RetryPolicy:
+
+    def __init__(self, times: int, sleep: float, max_sleep: float, jitter: bool = True):
+        self.times = int(times)
+        self.sleep = float(sleep)
+        self.max_sleep = float(max_sleep)
+        self.jitter = jitter
+
+    @classmethod
+    def from_config(cls, config: dict | None, default: 'RetryPolicy') -> 'RetryPolicy':
+        config = config or {}
+        return cls(
+            times=config.get('times', default.times),
+            sleep=config.get('sleep', default.sleep),
+            max_sleep=config.get('max_sleep', default.max_sleep),
+            jitter=config.get('jitter', default.jitter),
+        )
+
+    def get_delay(self, attempt: int) -> float:
+        # Exponential backoff capped at max_sleep. Full jitter spreads retries
+        # of parallel jobs that failed at the same moment.
+        delay = min(self.max_sleep, self.sleep * (2 ** attempt))
+        if self.jitter:
+            delay = random.uniform(0, delay)  # nosec B311
+        return delay
+
+
+def call_with_backoff(func: Callable, policy: RetryPolicy, name: str, *args, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            attempt += 1
+            if attempt >= policy.times:
+                raise
+            logger.warning("%s failed: %s", name, e)
+
+            delay = policy.get_delay(attempt - 1)
+            logger.info("Sleep %.1f seconds", delay)
+            time.sleep(delay)
+
+            logger.info("Retry %s (left attempts: %s) ...", name, policy.times - attempt)
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
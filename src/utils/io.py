@@ -1,5 +1,173 @@
+import contextlib
+import io
 import os
+import shutil
+import subprocess  # nosec B404
+import tarfile
+import threading
+from typing import BinaryIO, List, Set
+
+PIPE_CHUNK_SIZE = 1024 * 1024
+
+
+def read_full(fileobj: BinaryIO, size: int) -> bytes:
+    # Pipes and raw streams may return less than asked for before EOF.
+    data = fileobj.read(size)
+    if not data or len(data) == size:
+        return data
+    parts = [data]
+    left = size - len(data)
+    while left:
+        data = fileobj.read(left)
+        if not data:
+            break
+        parts.append(data)
+        left -= len(data)
+    return b''.join(parts)
+
 
 def delete_file_if_exists(path):
     if os.path.exists(path):
         os.remove(path)
+
+
+def get_disk_key(path: str) -> str:
+    # Resource key of the block device holding `path` (or its nearest existing
+    # parent), used to limit how many jobs hit the same disk at once.
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    st_dev = os.stat(path).st_dev
+    return 'disk:%s:%s' % (os.major(st_dev), os.minor(st_dev))
+
+
+def get_open_file_paths(dirpath: str) -> Set[str]:
+    # Linux only: walks /proc/<pid>/fd of every visible process and returns the
+    # files below `dirpath` that are still held open by someone.
+    dirpath = os.path.realpath(dirpath) + os.sep
+    paths = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fd_dir = '/proc/%s/fd' % pid
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                path = os.readlink('%s/%s' % (fd_dir, fd))
+            except OSError:
+                continue
+            if path.startswith(dirpath):
+                paths.add(path)
+    return paths
+
+
+class ProcessOutputReader(io.RawIOBase):
+    # Reads the stdout of a running process and fails at EOF when the process
+    # exited with a non-zero code, so a truncated dump is never committed as a
+    # complete upload.
+
+    def __init__(self, process: subprocess.Popen, name: str):
+        self.process = process
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.process.stdout.readinto(buffer)  # type: ignore
+        if not size:
+            exit_code = self.process.wait()
+            if exit_code != 0:
+                raise Exception("%s failed with the exit code: %s" % (self.name, exit_code))
+        return size
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()  # type: ignore
+        self.process.wait()
+        super(ProcessOutputReader, self).close()
+
+
+class ProcessFilterReader(ProcessOutputReader):
+    # Pipes `fileobj` through the stdin of a command (e.g. a compressor) and
+    # reads the result from its stdout. A feeder thread writes stdin so both
+    # ends of the pipe make progress at the same time.
+
+    def __init__(self, fileobj: BinaryIO, args: List[str], name: str):
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)  # nosec B603
+        super(ProcessFilterReader, self).__init__(process, name)
+        self.fileobj = fileobj
+        self.error: Exception | None = None
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+    def feed(self):
+        try:
+            shutil.copyfileobj(self.fileobj, self.process.stdin, PIPE_CHUNK_SIZE)  # type: ignore
+        except Exception as e:
+            self.error = e
+        finally:
+            with contextlib.suppress(OSError):
+                self.process.stdin.close()  # type: ignore
+
+    def readinto(self, buffer):
+        size = super(ProcessFilterReader, self).readinto(buffer)
+        if not size:
+            self.feeder.join()
+            if self.error is not None:
+                raise self.error
+        return size
+
+    def close(self):
+        super(ProcessFilterReader, self).close()
+        self.feeder.join()
+
+
+class ThreadedWriterReader(io.RawIOBase):
+    # Turns a writer function into a readable stream: `writer(fileobj)` runs
+    # in a background thread and writes into a pipe whose read end is exposed
+    # by this object.
+
+    def __init__(self, writer):
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, 'rb')
+        self.writer = os.fdopen(write_fd, 'wb')
+        self.error: Exception | None = None
+        self.thread = threading.Thread(target=self.run, args=(writer,), daemon=True)
+        self.thread.start()
+
+    def run(self, writer):
+        try:
+            writer(self.writer)
+        except Exception as e:
+            self.error = e
+        finally:
+            with contextlib.suppress(OSError):
+                self.writer.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.reader.readinto(buffer)
+        if not size:
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+        return size
+
+    def close(self):
+        self.reader.close()
+        self.thread.join()
+        super(ThreadedWriterReader, self).close()
+
+
+def open_tar_stream(dirpath: str) -> BinaryIO:
+    def write(fileobj):
+        with tarfile.open(fileobj=fileobj, mode='w|', bufsize=PIPE_CHUNK_SIZE) as tar:
+            tar.add(dirpath, arcname=os.path.basename(os.path.normpath(dirpath)))
+    return ThreadedWriterReader(write)  # type: ignore
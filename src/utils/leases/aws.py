@@ -0,0 +1,83 @@
+import json
+import logging
+from typing import Dict, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+from utils.environment import Environment
+from utils.leases.base import LeaseBackend
+
+logger = logging.getLogger(__name__)
+
+
+# Error codes of a conditional write that lost against another node.
+S3_CONDITIONAL_WRITE_ERRORS = ('PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey')
+S3_NOT_FOUND_ERRORS = ('NoSuchKey', '404')
+
+
+class AWSLeaseBackend(LeaseBackend):
+    # Records are objects below `prefix`. Writes are conditional requests
+    # (If-None-Match to create, If-Match on the ETag to replace), so S3
+    # rejects the loser of a race itself. Needs a store that supports
+    # conditional writes (AWS S3, MinIO).
+
+    def __init__(
+        self,
+        aws_bucket_name: str,
+        aws_region: str,
+        aws_access_key_id: str,
+        aws_secret_access_key: str,
+        environment: Environment,
+        endpoint_url: str | None = None,
+        prefix: str = 'leases/',
+    ):
+        super(AWSLeaseBackend, self).__init__(environment)
+        self.aws_bucket_name = aws_bucket_name
+        self.aws_region = aws_region
+        self.prefix = prefix
+        self.client = boto3.session.Session().client(
+            's3',
+            region_name=aws_region,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            endpoint_url=endpoint_url,
+        )
+
+    def read(self, name: str) -> Tuple[dict | None, str | None]:
+        try:
+            response = self.client.get_object(Bucket=self.aws_bucket_name, Key=self.prefix + name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in S3_NOT_FOUND_ERRORS:
+                return None, None
+            raise
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def write(self, name: str, record: dict, version: str | None) -> str | None:
+        condition = {'IfNoneMatch': '*'} if version is None else {'IfMatch': version}
+        try:
+            response = self.client.put_object(
+                Bucket=self.aws_bucket_name,
+                Key=self.prefix + name,
+                Body=json.dumps(record).encode(),
+                ContentType='application/json',
+                **condition,
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in S3_CONDITIONAL_WRITE_ERRORS:
+                return None
+            raise
+        return response['ETag']
+
+    def list(self, prefix: str) -> Dict[str, dict]:
+        records = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.aws_bucket_name, Prefix=self.prefix + prefix):
+            for item in page.get('Contents', []):
+                name = item['Key'][len(self.prefix):]
+                record, _ = self.read(name)
+                if record is not None:
+                    records[name] = record
+        return records
+
+    def describe(self) -> str:
+        return '(AWS region: %s, S3 Bucket: %s, prefix: %s)' % (self.aws_region, self.aws_bucket_name, self.prefix)
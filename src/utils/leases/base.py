@@ -0,0 +1,35 @@
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, Tuple
+
+from utils.environment import Environment
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseBackend(ABC):
+    # Small JSON records (namespace leases, node heartbeats) shared by the
+    # nodes of a cluster. Writes are compare-and-swap: a write names the
+    # version it replaces, or None to create the record, and fails when
+    # another node wrote in between. Names are `/`-separated paths.
+
+    def __init__(self, environment: Environment):
+        self.environment = environment
+
+    @abstractmethod
+    def read(self, name: str) -> Tuple[dict | None, str | None]:
+        # (record, version), or (None, None) when there is no such record.
+        pass
+
+    @abstractmethod
+    def write(self, name: str, record: dict, version: str | None) -> str | None:
+        # The new version, or None when `version` is no longer current.
+        pass
+
+    @abstractmethod
+    def list(self, prefix: str) -> Dict[str, dict]:
+        # Records by name of every name below `prefix`.
+        pass
+
+    def describe(self) -> str:
+        return '()'
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from typing import Dict, Tuple
+
+from utils.environment import Environment
+from utils.leases.base import LeaseBackend
+
+logger = logging.getLogger(__name__)
+
+
+LEASE_FILE_SUFFIX = '.json'
+# The mutex of a writer that died mid-write is broken after this many seconds.
+LEASE_MUTEX_TIMEOUT = 10
+
+
+class DirectoryLeaseBackend(LeaseBackend):
+    # Records are files in a directory shared by the nodes (NFS, a mounted
+    # volume), or a local one for nodes on the same host and for tests. A
+    # write holds a mkdir() mutex, which is atomic on network filesystems
+    # too, while it compares the version and replaces the file. The mutex
+    # holds a file named after its owner's token.
+
+    def __init__(self, path: str, environment: Environment, mutex_timeout: float = LEASE_MUTEX_TIMEOUT):
+        super(DirectoryLeaseBackend, self).__init__(environment)
+        self.path = path
+        self.mutex_timeout = float(mutex_timeout)
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.path, *name.split('/')) + LEASE_FILE_SUFFIX
+
+    def read(self, name: str) -> Tuple[dict | None, str | None]:
+        try:
+            with open(self.get_path(name)) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None, None
+        return data['record'], data['version']
+
+    def lock(self, path: str) -> str | None:
+        # Returns the owner token written into the mutex, or None if another
+        # writer holds it.
+        mutex = path + '.lock'
+        token = uuid.uuid4().hex
+        try:
+            os.mkdir(mutex)
+        except FileExistsError:
+            if not self.break_stale(mutex):
+                return None
+            try:
+                os.mkdir(mutex)
+            except FileExistsError:
+                return None
+        with open(os.path.join(mutex, token), 'w'):
+            pass
+        return token
+
+    def unlock(self, path: str, token: str):
+        # Only the owner's own mutex is removed; if it was broken as stale,
+        # whatever is at its path now belongs to another writer.
+        mutex = path + '.lock'
+        try:
+            os.remove(os.path.join(mutex, token))
+        except FileNotFoundError:
+            logger.warning("DirectoryLeaseBackend -> the mutex %s was broken while held", mutex)
+            return
+        os.rmdir(mutex)
+
+    def break_stale(self, mutex: str) -> bool:
+        # The stale mutex is renamed away first, which only one of several
+        # breakers can do. If its mtime shows it was replaced by a live one
+        # in between, it is put back.
+        try:
+            if time.time() - os.stat(mutex).st_mtime < self.mutex_timeout:
+                return False
+            stale = '%s.%s.stale' % (mutex, uuid.uuid4().hex)
+            os.rename(mutex, stale)
+        except FileNotFoundError:
+            return True
+        if time.time() - os.stat(stale).st_mtime < self.mutex_timeout:
+            try:
+                os.rename(stale, mutex)
+            except OSError:
+                logger.warning("DirectoryLeaseBackend -> could not restore the live mutex %s", mutex)
+            return False
+        logger.warning("DirectoryLeaseBackend -> break the stale mutex %s", mutex)
+        shutil.rmtree(stale, ignore_errors=True)
+        return True
+
+    def write(self, name: str, record: dict, version: str | None) -> str | None:
+        path = self.get_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        token = self.lock(path)
+        if token is None:
+            return None
+        try:
+            if self.read(name)[1] != version:
+                return None
+            new_version = uuid.uuid4().hex
+            temp_path = '%s.%s.tmp' % (path, new_version)
+            with open(temp_path, 'w') as f:
+                json.dump({'version': new_version, 'record': record}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+            return new_version
+        finally:
+            self.unlock(path, token)
+
+    def list(self, prefix: str) -> Dict[str, dict]:
+        prefix = prefix.strip('/')
+        directory = os.path.join(self.path, *prefix.split('/'))
+        if not os.path.isdir(directory):
+            return {}
+        records = {}
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(LEASE_FILE_SUFFIX):
+                continue
+            name = '%s/%s' % (prefix, filename[:-len(LEASE_FILE_SUFFIX)])
+            record, _ = self.read(name)
+            if record is not None:
+                records[name] = record
+        return records
+
+    def describe(self) -> str:
+        return '(Lease directory: %s)' % self.path
@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import re
+import subprocess  # nosec B404
+import uuid
+from typing import Dict, List, Tuple
+
+from utils.environment import Environment
+from utils.leases.base import LeaseBackend
+
+logger = logging.getLogger(__name__)
+
+
+PG_LEASE_TABLE = 'backup_leases'
+PG_LEASE_TABLE_PATTERN = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+# Values are passed as psql variables and quoted by psql (`:'name'`). The
+# advisory lock keeps nodes that start together from racing on CREATE TABLE.
+PG_LEASE_INIT_QUERY = '''
+BEGIN;
+SELECT pg_advisory_xact_lock(hashtext(:'table'));
+CREATE TABLE IF NOT EXISTS %(table)s (name text PRIMARY KEY, version text NOT NULL, record text NOT NULL);
+COMMIT;
+'''
+PG_LEASE_READ_QUERY = "SELECT version, record FROM %(table)s WHERE name = :'name';"
+PG_LEASE_CREATE_QUERY = (
+    "INSERT INTO %(table)s (name, version, record) VALUES (:'name', :'version', :'record') "
+    "ON CONFLICT (name) DO NOTHING RETURNING version;"
+)
+PG_LEASE_UPDATE_QUERY = (
+    "UPDATE %(table)s SET version = :'version', record = :'record' "
+    "WHERE name = :'name' AND version = :'expected' RETURNING version;"
+)
+PG_LEASE_LIST_QUERY = "SELECT name, record FROM %(table)s WHERE left(name, length(:'prefix')) = :'prefix' ORDER BY name;"
+
+
+class PostgreSQLLeaseBackend(LeaseBackend):
+    # Records are rows of a table that is created on first use. A write is a
+    # single conditional INSERT or UPDATE, so the database picks the winner
+    # of a race. Queries run through psql like the rest of the PostgreSQL
+    # support, without a driver.
+
+    def __init__(
+        self,
+        postgres_host: str,
+        postgres_user: str,
+        postgres_password: str,
+        environment: Environment,
+        postgres_port: str = '5432',
+        postgres_db: str = 'postgres',
+        table: str = PG_LEASE_TABLE,
+    ):
+        super(PostgreSQLLeaseBackend, self).__init__(environment)
+        if not PG_LEASE_TABLE_PATTERN.match(table):
+            raise ValueError("Invalid lease table name `%s`" % table)
+        self.postgres_host = postgres_host
+        self.postgres_port = postgres_port
+        self.postgres_user = postgres_user
+        self.postgres_password = postgres_password
+        self.postgres_db = postgres_db
+        self.table = table
+        self.initialized = False
+
+    def run(self, query: str, **variables: str) -> List[List[str]]:
+        args = [
+            'psql', '-X', '-q', '-A', '-t', '-F', '\t', '-v', 'ON_ERROR_STOP=1',
+            '-h', self.postgres_host, '-p', str(self.postgres_port), '-U', self.postgres_user, '-d', self.postgres_db,
+        ]
+        for key, value in variables.items():
+            args.extend(['-v', '%s=%s' % (key, value)])
+        process = subprocess.run(  # nosec B603 B607
+            args,
+            input=query % {'table': self.table},
+            env={**os.environ, 'PGPASSWORD': self.postgres_password},
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if process.returncode != 0:
+            raise Exception("psql failed with the exit code: %s: %s" % (process.returncode, process.stderr.strip()))
+        return [line.split('\t') for line in process.stdout.splitlines() if line]
+
+    def query(self, query: str, **variables: str) -> List[List[str]]:
+        if not self.initialized:
+            self.run(PG_LEASE_INIT_QUERY, table=self.table)
+            self.initialized = True
+        return self.run(query, **variables)
+
+    def read(self, name: str) -> Tuple[dict | None, str | None]:
+        rows = self.query(PG_LEASE_READ_QUERY, name=name)
+        if not rows:
+            return None, None
+        version, record = rows[0]
+        return json.loads(record), version
+
+    def write(self, name: str, record: dict, version: str | None) -> str | None:
+        new_version = uuid.uuid4().hex
+        if version is None:
+            rows = self.query(PG_LEASE_CREATE_QUERY, name=name, version=new_version, record=json.dumps(record))
+        else:
+            rows = self.query(PG_LEASE_UPDATE_QUERY, name=name, version=new_version, record=json.dumps(record), expected=version)
+        return new_version if rows else None
+
+    def list(self, prefix: str) -> Dict[str, dict]:
+        return {name: json.loads(record) for name, record in self.query(PG_LEASE_LIST_QUERY, prefix=prefix)}
+
+    def describe(self) -> str:
+        return '(PostgreSQL host: %s, database: %s, table: %s)' % (self.postgres_host, self.postgres_db, self.table)
@@ -0,0 +1,70 @@
+import fcntl
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock:
+    # Exclusive flock on a file in the state directory. The kernel drops the
+    # lock when the holding process exits, so a crashed or killed run never
+    # leaves a stale lock behind, while a run that outlives a restart of the
+    # scheduler still holds it. The holder's PID is recorded in the file.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: int | None = None
+
+    def open(self) -> int:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self) -> bool:
+        fd = self.open()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps({'pid': os.getpid(), 'started_at': time.time()}).encode())
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def is_locked(self) -> bool:
+        if self.fd is not None:
+            return True
+        if not os.path.exists(self.path):
+            return False
+        fd = self.open()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def get_holder(self) -> dict | None:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise BlockingIOError("%s is locked by %s" % (self.path, self.get_holder()))
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,140 @@
+import atexit
+import contextvars
+import copy
+import functools
+import json
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.queues import Queue as ProcessQueue
+from queue import Queue
+from typing import Callable, Iterator
+
+LOG_FORMAT_JSON = 'json'
+LOG_FORMAT_TEXT = 'text'
+LOG_FORMATS = (LOG_FORMAT_JSON, LOG_FORMAT_TEXT)
+LOG_TEXT_FORMAT = '[PID: %(process)d] - %(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Attributes of every LogRecord; any other attribute was passed in `extra`
+# or copied from the log context.
+LOG_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+LOG_EXTRA_TYPES = (str, int, float, bool, type(None))
+
+# The scheduler passes a queue of its multiprocessing context, tests and
+# single-process use may pass a plain one.
+LogQueue = Queue | ProcessQueue
+
+# Fields (namespace, run_id, stage) added to every record of the current
+# thread. New threads start without them, see bind_log_context().
+_log_context: contextvars.ContextVar[dict | None] = contextvars.ContextVar('log_context', default=None)
+
+
+def get_log_context() -> dict:
+    return _log_context.get() or {}
+
+
+@contextmanager
+def log_context(**fields) -> Iterator[dict]:
+    context = {**get_log_context(), **fields}
+    token = _log_context.set(context)
+    try:
+        yield context
+    finally:
+        _log_context.reset(token)
+
+
+def bind_log_context(func: Callable) -> Callable:
+    # Runs `func` (e.g. the target of a thread) with the log context of the
+    # thread that bound it.
+    fields = get_log_context()
+
+    @functools.wraps(func)
+    def _func(*args, **kwargs):
+        with log_context(**fields):
+            return func(*args, **kwargs)
+    return _func
+
+
+class LogContextFilter(logging.Filter):
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in get_log_context().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class LogQueueHandler(QueueHandler):
+    # Hands records to the listener of the scheduler without waiting for it.
+    # Only the message is merged here, since its args may not pickle; the
+    # line is formatted by the listener.
+
+    def __init__(self, queue: LogQueue):
+        super(LogQueueHandler, self).__init__(queue)
+        self.addFilter(LogContextFilter())
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for key, value in list(vars(record).items()):
+            if key not in LOG_RECORD_ATTRIBUTES and not isinstance(value, LOG_EXTRA_TYPES):
+                setattr(record, key, str(value))
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, with the log context and any `extra` (e.g.
+    # duration, bytes) as top-level fields.
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def get_formatter(log_format: str) -> logging.Formatter:
+    if log_format == LOG_FORMAT_JSON:
+        return JsonFormatter()
+    if log_format == LOG_FORMAT_TEXT:
+        return logging.Formatter(LOG_TEXT_FORMAT)
+    raise ValueError("Unknown log format `%s`, one of: %s" % (log_format, ', '.join(LOG_FORMATS)))
+
+
+def attach_log_queue(queue: LogQueue, level: int | str):
+    # Replaces the handlers of the root logger, in the scheduler and in every
+    # worker process.
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LogQueueHandler(queue))
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+
+def start_log_listener(queue: LogQueue, log_format: str, level: int | str) -> QueueListener:
+    # A single thread of the scheduler writes every line, so lines of
+    # parallel workers never interleave and a slow consumer of stderr only
+    # holds up this thread, not a backup.
+    handler = logging.StreamHandler()
+    handler.setFormatter(get_formatter(log_format))
+    listener = QueueListener(queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    attach_log_queue(queue, level)
+    return listener
@@ -0,0 +1,186 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from utils.functions import is_process_alive
+
+logger = logging.getLogger(__name__)
+
+
+METRIC_COUNTER = 'counter'
+METRIC_GAUGE = 'gauge'
+METRIC_SUMMARY = 'summary'
+
+METRICS = {
+    'backup_runs_total': (METRIC_COUNTER, "Finished backup runs by status."),
+    'backup_stage_duration_seconds': (METRIC_SUMMARY, "Duration of backup stages (dump, upload, notify)."),
+    'backup_stage_retries_total': (METRIC_COUNTER, "Retried attempts of backup stages."),
+    'backup_source_read_seconds_total': (METRIC_COUNTER, "Time spent waiting for the source stream (dump, archive and compression)."),
+    'backup_source_bytes_total': (METRIC_COUNTER, "Bytes read from the source stream after compression."),
+    'backup_storage_bytes_total': (METRIC_COUNTER, "Bytes written to a storage."),
+    'backup_storage_upload_seconds_total': (METRIC_COUNTER, "Time spent uploading to a storage."),
+    'backup_storage_upload_errors_total': (METRIC_COUNTER, "Failed uploads to a storage."),
+    'backup_storage_throughput_bytes_per_second': (METRIC_GAUGE, "Throughput of the last upload to a storage."),
+    'backup_notification_seconds': (METRIC_SUMMARY, "Latency of notification deliveries."),
+    'backup_notification_errors_total': (METRIC_COUNTER, "Notifications that could not be delivered."),
+    'backup_last_success_timestamp_seconds': (METRIC_GAUGE, "Unix time of the last successful backup."),
+    'backup_last_duration_seconds': (METRIC_GAUGE, "Duration of the last backup run."),
+    'backup_jobs_queued': (METRIC_GAUGE, "Backup jobs waiting in the worker pool."),
+    'backup_jobs_running': (METRIC_GAUGE, "Backup jobs running in the worker pool."),
+    'backup_wal_segments_total': (METRIC_COUNTER, "WAL files archived to or fetched from the storages."),
+    'backup_wal_last_archived_timestamp_seconds': (METRIC_GAUGE, "Unix time of the last archived WAL file."),
+    'backup_cluster_leases': (METRIC_GAUGE, "Namespace leases held by this node in cluster mode."),
+    'backup_cluster_takeovers_total': (METRIC_COUNTER, "Runs taken over from a node whose lease expired."),
+    'backup_cluster_lease_losses_total': (METRIC_COUNTER, "Leases this node failed to renew while its run was active."),
+}
+
+
+def get_label_key(labels: dict) -> str:
+    return json.dumps(sorted((str(key), str(value)) for key, value in labels.items()))
+
+
+class MetricsRegistry:
+    # Metrics of one process. Counters and summaries ({sum, count}) are summed
+    # across processes when collected, gauges keep the most recent value.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values: Dict[str, Dict[str, object]] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = get_label_key(labels)
+            series[key] = series.get(key, 0) + amount  # type: ignore
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.values.setdefault(name, {})[get_label_key(labels)] = [value, time.time()]
+
+    def observe(self, name: str, value: float, **labels):
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = get_label_key(labels)
+            summary = series.setdefault(key, [0.0, 0])
+            summary[0] += value  # type: ignore
+            summary[1] += 1  # type: ignore
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        with self.lock:
+            return json.loads(json.dumps(self.values))
+
+    def flush(self, state_dir: str):
+        # Worker processes publish their metrics as one JSON file per PID; the
+        # scheduler process aggregates them.
+        path = '%s/metrics/%s.json' % (state_dir, os.getpid())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Threads of one process (e.g. the databases of a cluster target)
+        # may flush at the same time.
+        temp_path = '%s.%s.tmp' % (path, threading.get_ident())
+        with open(temp_path, 'w') as f:
+            json.dump({'pid': os.getpid(), 'values': self.snapshot()}, f)
+        os.replace(temp_path, path)
+
+
+def merge_values(target: Dict[str, Dict[str, object]], source: Dict[str, Dict[str, object]]):
+    for name, series in source.items():
+        kind = METRICS.get(name, (METRIC_COUNTER, ''))[0]
+        merged = target.setdefault(name, {})
+        for key, value in series.items():
+            if key not in merged:
+                merged[key] = value
+            elif kind == METRIC_GAUGE:
+                if value[1] >= merged[key][1]:  # type: ignore
+                    merged[key] = value
+            elif kind == METRIC_SUMMARY:
+                merged[key] = [merged[key][0] + value[0], merged[key][1] + value[1]]  # type: ignore
+            else:
+                merged[key] = merged[key] + value  # type: ignore
+
+
+def collect(state_dir: str) -> Dict[str, Dict[str, object]]:
+    # Files of processes that have exited are folded into `totals.json` and
+    # removed, so counters stay monotonic without the directory growing.
+    directory = '%s/metrics' % state_dir
+    os.makedirs(directory, exist_ok=True)
+    totals_path = '%s/totals.json' % directory
+    with open('%s/.lock' % directory, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(totals_path) as f:
+                totals = json.load(f)
+        except (OSError, ValueError):
+            totals = {}
+
+        live: List[Tuple[str, dict]] = []
+        compacted = False
+        for path in glob.glob('%s/[0-9]*.json' % directory):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data['pid'] == os.getpid():
+                continue
+            if is_process_alive(data['pid']):
+                live.append((path, data['values']))
+            else:
+                merge_values(totals, data['values'])
+                os.remove(path)
+                compacted = True
+
+        if compacted:
+            with open(totals_path + '.tmp', 'w') as f:
+                json.dump(totals, f)
+            os.replace(totals_path + '.tmp', totals_path)
+
+    values = json.loads(json.dumps(totals))
+    for _, data in live:
+        merge_values(values, data)
+    merge_values(values, get_metrics().snapshot())
+    return values
+
+
+def format_labels(key: str) -> str:
+    labels = json.loads(key)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels)
+
+
+def render(values: Dict[str, Dict[str, object]]) -> str:
+    # Prometheus text exposition format.
+    lines = []
+    for name in sorted(values):
+        kind, help_text = METRICS.get(name, (METRIC_COUNTER, ''))
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for key, value in sorted(values[name].items()):
+            labels = format_labels(key)
+            if kind == METRIC_SUMMARY:
+                lines.append('%s_sum%s %s' % (name, labels, value[0]))  # type: ignore
+                lines.append('%s_count%s %s' % (name, labels, value[1]))  # type: ignore
+            elif kind == METRIC_GAUGE:
+                lines.append('%s%s %s' % (name, labels, value[0]))  # type: ignore
+            else:
+                lines.append('%s%s %s' % (name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+
+_registry: MetricsRegistry | None = None
+_registry_pid: int | None = None
+
+
+def get_metrics() -> MetricsRegistry:
+    # A forked worker starts from an empty registry instead of the copy of
+    # its parent's, which would otherwise be counted twice.
+    global _registry, _registry_pid
+    if _registry is None or _registry_pid != os.getpid():
+        _registry = MetricsRegistry()
+        _registry_pid = os.getpid()
+    return _registry
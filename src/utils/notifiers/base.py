@@ -1,17 +1,50 @@
 import logging
 from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any, List
 
 from utils.environment import Environment
+from utils.functions import RetryPolicy
+
+if TYPE_CHECKING:
+    # Imported by the concrete notifiers and the dispatcher only; importing
+    # aiohttp costs more than the rest of a worker's startup.
+    import aiohttp
 
 logger = logging.getLogger(__name__)
 
 
+class NotifierError(Exception):
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super(NotifierError, self).__init__(message, retry_after)
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return str(self.args[0])
+
+
 class Notifier(ABC):
 
+    # Requests per second the dispatcher sends to this provider, shared by all
+    # notifiers of the provider in the process.
+    provider = 'default'
+    rate_limit = 1.0
+
     def __init__(self, environment: Environment, namespace: str | None):
         self.environment = environment
         self.namespace = namespace
 
     @abstractmethod
-    def notify(self, text):
+    def get_destinations(self) -> List[Any]:
         pass
+
+    @abstractmethod
+    async def send(self, session: 'aiohttp.ClientSession', destination: Any, text: str):
+        pass
+
+    def notify(self, text: str, policy: RetryPolicy | None = None):
+        # Queues the message in the background dispatcher and returns at once;
+        # delivery never blocks the backup.
+        from utils.notifiers.dispatcher import get_dispatcher
+        logger.info("%s -> notify('%s')" % (type(self).__name__, text))
+        get_dispatcher().dispatch(self, text, policy)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, wait
+from typing import TYPE_CHECKING, Any, Dict, Set
+
+from utils.functions import RetryPolicy
+from utils.metrics import get_metrics
+from utils.notifiers.base import Notifier, NotifierError
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+NOTIFIER_TIMEOUT = 30
+NOTIFIER_FLUSH_TIMEOUT = 60
+NOTIFIER_RETRY_POLICY = RetryPolicy(times=3, sleep=3, max_sleep=30)
+
+
+class RateLimiter:
+    # Spaces requests to one provider at least 1 / rate seconds apart.
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = asyncio.Lock()
+        self.next_at = 0.0
+
+    async def wait(self):
+        async with self.lock:
+            delay = self.next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_at = max(self.next_at, time.monotonic()) + self.interval
+
+
+class NotificationDispatcher:
+    # Delivers notifications from a background thread running an asyncio
+    # loop. Each provider gets one pooled aiohttp session and its own rate
+    # limiter; failed deliveries are retried per destination with backoff.
+    # Callers only enqueue, so a slow or unavailable provider never delays the
+    # backup; flush() waits for outstanding deliveries before the process
+    # exits.
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.sessions: Dict[str, 'aiohttp.ClientSession'] = {}
+        self.limiters: Dict[str, RateLimiter] = {}
+        self.pending: Set[Future] = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='notifier-dispatcher', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def get_session(self, provider: str) -> 'aiohttp.ClientSession':
+        if provider not in self.sessions:
+            import aiohttp
+            self.sessions[provider] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=NOTIFIER_TIMEOUT))
+        return self.sessions[provider]
+
+    def get_limiter(self, notifier: Notifier) -> RateLimiter:
+        if notifier.provider not in self.limiters:
+            self.limiters[notifier.provider] = RateLimiter(notifier.rate_limit)
+        return self.limiters[notifier.provider]
+
+    def dispatch(self, notifier: Notifier, text: str, policy: RetryPolicy | None = None):
+        for destination in notifier.get_destinations():
+            future = asyncio.run_coroutine_threadsafe(
+                self.deliver(notifier, destination, text, policy or NOTIFIER_RETRY_POLICY), self.loop,
+            )
+            with self.lock:
+                self.pending.add(future)
+            future.add_done_callback(self.discard)
+
+    def discard(self, future: Future):
+        with self.lock:
+            self.pending.discard(future)
+
+    async def deliver(self, notifier: Notifier, destination: Any, text: str, policy: RetryPolicy):
+        name = type(notifier).__name__
+        started_at = time.monotonic()
+        for attempt in range(max(policy.times, 1)):
+            await self.get_limiter(notifier).wait()
+            try:
+                await notifier.send(self.get_session(notifier.provider), destination, text)
+                get_metrics().observe('backup_notification_seconds', time.monotonic() - started_at, provider=notifier.provider)
+                return
+            except Exception as e:
+                if attempt + 1 >= policy.times:
+                    get_metrics().inc('backup_notification_errors_total', provider=notifier.provider)
+                    logger.error("%s -> failed to deliver to %s after %s attempts: %s", name, destination, attempt + 1, e)
+                    return
+                delay = policy.get_delay(attempt)
+                if isinstance(e, NotifierError) and e.retry_after is not None:
+                    delay = max(delay, e.retry_after)
+                logger.warning("%s -> delivery to %s failed (%s), retry in %.1f seconds", name, destination, e, delay)
+                await asyncio.sleep(delay)
+
+    def flush(self, timeout: float = NOTIFIER_FLUSH_TIMEOUT) -> bool:
+        with self.lock:
+            pending = set(self.pending)
+        if not pending:
+            return True
+        _, not_done = wait(pending, timeout)
+        if not_done:
+            logger.warning("%s notifications were not delivered within %s seconds", len(not_done), timeout)
+        return not not_done
+
+    async def close_sessions(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
+
+    def close(self, timeout: float = NOTIFIER_FLUSH_TIMEOUT):
+        self.flush(timeout)
+        asyncio.run_coroutine_threadsafe(self.close_sessions(), self.loop).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+
+_dispatcher: NotificationDispatcher | None = None
+_dispatcher_pid: int | None = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> NotificationDispatcher:
+    # One dispatcher per process. A forked worker does not inherit the
+    # parent's loop thread, so it starts its own.
+    global _dispatcher, _dispatcher_pid
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher_pid != os.getpid():
+            _dispatcher = NotificationDispatcher()
+            _dispatcher_pid = os.getpid()
+        return _dispatcher
+
+
+def flush_notifications(timeout: float = NOTIFIER_FLUSH_TIMEOUT) -> bool:
+    if _dispatcher is None or _dispatcher_pid != os.getpid():
+        return True
+    return _dispatcher.flush(timeout)
@@ -1,39 +1,46 @@
 import logging
-from typing import List
+from typing import Any, List
 
-from slack import WebClient
-from slack.errors import SlackApiError
+import aiohttp
 from utils.environment import Environment
-from utils.functions import retry_if_exception_for_method
-from utils.notifiers.base import Notifier
+from utils.notifiers.base import Notifier, NotifierError
 
 logger = logging.getLogger(__name__)
 
 
-NOTIFIER_RETRY_COUNT = 3
-NOTIFIER_RETRY_SLEEP = 3
+SLACK_API_URL = 'https://slack.com/api'
 
 
 class SlackNotifier(Notifier):
 
+    provider = 'slack'
+    rate_limit = 1.0
+
     def __init__(
         self,
         slack_channels: List[str],
         slack_api_token: str,
         environment: Environment,
         namespace: str | None,
+        api_url: str = SLACK_API_URL,
     ):
         super(SlackNotifier, self).__init__(environment, namespace)
         self.slack_channels = slack_channels
         self.slack_api_token = slack_api_token
-
-    @retry_if_exception_for_method(NOTIFIER_RETRY_COUNT, NOTIFIER_RETRY_SLEEP)
-    def notify(self, text: str):
-        logger.info("SlackNotifier -> notify('%s')" % text)
-        for channel in self.slack_channels:
-            slack_client = WebClient(token=self.slack_api_token)
-            try:
-                slack_client.chat_postMessage(channel=channel, text=text)
-            except SlackApiError as e:
-                # You will get a SlackApiError if "ok" is False
-                assert e.response["error"]  # str like 'invalid_auth', 'channel_not_found'
+        self.api_url = api_url.rstrip('/')
+
+    def get_destinations(self) -> List[Any]:
+        return list(self.slack_channels)
+
+    async def send(self, session: aiohttp.ClientSession, destination: Any, text: str):
+        async with session.post(
+            '%s/chat.postMessage' % self.api_url,
+            json={'channel': destination, 'text': text},
+            headers={'Authorization': 'Bearer %s' % self.slack_api_token},
+        ) as response:
+            if response.status == 429:
+                raise NotifierError("Slack rate limit", float(response.headers.get('Retry-After', 1)))
+            data = await response.json(content_type=None)
+        if not data.get('ok'):
+            # e.g. 'invalid_auth', 'channel_not_found'
+            raise NotifierError("Slack error for channel %s: %s" % (destination, data.get('error')))
@@ -1,48 +1,50 @@
 import logging
-from typing import List
+from typing import Any, List
 
-import requests
+import aiohttp
 from utils.environment import Environment
-from utils.functions import retry_if_exception_for_method
-from utils.notifiers.base import Notifier
+from utils.notifiers.base import Notifier, NotifierError
 
 logger = logging.getLogger(__name__)
 
 
-NOTIFIER_RETRY_COUNT = 3
-NOTIFIER_RETRY_SLEEP = 3
+TELEGRAM_API_URL = 'https://api.telegram.org'
 
 
 class TelegramNotifier(Notifier):
 
+    provider = 'telegram'
+    rate_limit = 20.0
+
     def __init__(
         self,
         chat_ids: List[str],
         bot_token: str,
         environment: Environment,
         namespace: str | None,
+        api_url: str = TELEGRAM_API_URL,
     ):
         super(TelegramNotifier, self).__init__(environment, namespace)
         self.chat_ids = chat_ids
         self.bot_token = bot_token
-
-    @retry_if_exception_for_method(NOTIFIER_RETRY_COUNT, NOTIFIER_RETRY_SLEEP)
-    def notify(self, text: str):
-        logger.info("TelegramNotifier -> notify('%s')" % text)
-        for chat_id in self.chat_ids:
-            if type(chat_id) in (tuple, list):
-                url = "https://api.telegram.org/bot%(bot_token)s/sendMessage?chat_id=%(chat_id)s&text=%(text)s&reply_to_message_id=%(reply_to_message_id)s" % {
-                    'bot_token': self.bot_token,
-                    'chat_id': chat_id[0],
-                    'text': text,
-                    'reply_to_message_id': chat_id[1],
-                }
-            else:
-                url = "https://api.telegram.org/bot%(bot_token)s/sendMessage?chat_id=%(chat_id)s&text=%(text)s" % {
-                    'bot_token': self.bot_token,
-                    'chat_id': chat_id,
-                    'text': text,
-                }
-            resp = requests.get(url, verify=False).json()  # nosec B501
-            if not resp['ok']:
-                assert resp
+        self.api_url = api_url.rstrip('/')
+
+    def get_destinations(self) -> List[Any]:
+        return list(self.chat_ids)
+
+    async def send(self, session: aiohttp.ClientSession, destination: Any, text: str):
+        params = {'text': text}
+        if type(destination) in (tuple, list):
+            params['chat_id'] = str(destination[0])
+            params['reply_to_message_id'] = str(destination[1])
+        else:
+            params['chat_id'] = str(destination)
+        async with session.get(
+            '%s/bot%s/sendMessage' % (self.api_url, self.bot_token),
+            params=params,
+            ssl=False,  # nosec B501
+        ) as response:
+            data = await response.json(content_type=None)
+        if not data.get('ok'):
+            retry_after = data.get('parameters', {}).get('retry_after')
+            raise NotifierError("Telegram error for chat %s: %s" % (params['chat_id'], data.get('description')), retry_after)
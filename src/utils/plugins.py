@@ -0,0 +1,94 @@
+import importlib
+import logging
+from importlib.metadata import entry_points
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+# Third-party packages register backends under these entry point groups, e.g.
+# `[tool.poetry.plugins."backup.storages"] gcs = "backup_gcs:GCSStorage"`.
+PLUGIN_ENTRY_POINT_GROUPS = {
+    'target': 'backup.targets',
+    'storage': 'backup.storages',
+    'notifier': 'backup.notifiers',
+    'lease': 'backup.leases',
+}
+
+
+class PluginRegistry:
+    # Maps the `type` of a config section to the class implementing it. The
+    # registry only holds `module:Class` paths; a backend's module (and with
+    # it boto3, paramiko or aiohttp) is imported the first time a config asks
+    # for it. Entry points are looked up once, also without loading them.
+
+    def __init__(self, kind: str, builtins: Dict[str, str]):
+        self.kind = kind
+        self.paths = dict(builtins)
+        self.classes: Dict[str, type] = {}
+        self.entry_points_loaded = False
+
+    def register(self, name: str, plugin: str | type):
+        if isinstance(plugin, str):
+            self.paths[name] = plugin
+            self.classes.pop(name, None)
+        else:
+            self.paths[name] = '%s:%s' % (plugin.__module__, plugin.__qualname__)
+            self.classes[name] = plugin
+
+    def load_entry_points(self):
+        if self.entry_points_loaded:
+            return
+        self.entry_points_loaded = True
+        for entry_point in entry_points(group=PLUGIN_ENTRY_POINT_GROUPS[self.kind]):
+            if entry_point.name in self.paths:
+                logger.warning("Plugin %s `%s` from %s is shadowed by %s" % (
+                    self.kind, entry_point.name, entry_point.value, self.paths[entry_point.name],
+                ))
+                continue
+            self.paths[entry_point.name] = entry_point.value
+
+    def get_names(self) -> List[str]:
+        self.load_entry_points()
+        return sorted(self.paths)
+
+    def __contains__(self, name: object) -> bool:
+        self.load_entry_points()
+        return name in self.paths
+
+    def get(self, name: str) -> type:
+        if name not in self.classes:
+            if name not in self:
+                raise ValueError("Unknown %s type `%s`, one of: %s" % (self.kind, name, ', '.join(self.get_names())))
+            module_name, _, attribute = self.paths[name].partition(':')
+            plugin = importlib.import_module(module_name)
+            for part in attribute.split('.'):
+                plugin = getattr(plugin, part)
+            self.classes[name] = plugin  # type: ignore
+        return self.classes[name]
+
+
+TARGETS = PluginRegistry('target', {
+    'postgresql': 'utils.targets.postgresql:PostgreSQLTarget',
+    'postgresql_cluster': 'utils.targets.postgresql_cluster:PostgreSQLClusterTarget',
+    'postgresql_physical': 'utils.targets.postgresql_physical:PostgreSQLPhysicalTarget',
+    'file': 'utils.targets.file:FileTarget',
+    'directory': 'utils.targets.directory:DirectoryTarget',
+})
+
+STORAGES = PluginRegistry('storage', {
+    'aws': 'utils.storages.aws:AWSStorage',
+    'local': 'utils.storages.local:LocalStorage',
+    'remote': 'utils.storages.remote:RemoteStorage',
+})
+
+NOTIFIERS = PluginRegistry('notifier', {
+    'slack': 'utils.notifiers.slack:SlackNotifier',
+    'telegram': 'utils.notifiers.telegram:TelegramNotifier',
+})
+
+LEASES = PluginRegistry('lease', {
+    'directory': 'utils.leases.directory:DirectoryLeaseBackend',
+    'aws': 'utils.leases.aws:AWSLeaseBackend',
+    'postgresql': 'utils.leases.postgresql:PostgreSQLLeaseBackend',
+})
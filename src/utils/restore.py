@@ -0,0 +1,211 @@
+import contextlib
+import io
+import logging
+import os
+import shutil
+import subprocess  # nosec B404
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List
+
+from utils.compression import detect_codec
+from utils.encryption import ENCRYPTION_EXTENSION, Encryption
+from utils.metrics import get_metrics
+from utils.storages.base import Storage
+
+logger = logging.getLogger(__name__)
+
+
+RESTORE_CHUNK_SIZE = 1024 * 1024
+
+
+class RestoreStats:
+    # Bytes fetched from the storage and bytes written to the destination
+    # (after decompression) of one restore.
+
+    def __init__(self, key: str):
+        self.key = key
+        self.bytes_downloaded = 0
+        self.bytes_restored = 0
+        self.files = 0
+        self.started_at = time.monotonic()
+        self.finished_at: float | None = None
+        self.lock = threading.Lock()
+
+    def add(self, downloaded: int = 0, restored: int = 0, files: int = 0):
+        with self.lock:
+            self.bytes_downloaded += downloaded
+            self.bytes_restored += restored
+            self.files += files
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def finish(self, labels: Dict[str, str]):
+        self.finished_at = time.monotonic()
+        metrics = get_metrics()
+        metrics.observe('backup_restore_seconds', self.duration, **labels)
+        metrics.inc('backup_restore_bytes_total', self.bytes_downloaded, **labels)
+        if self.duration > 0:
+            metrics.set('backup_restore_throughput_bytes_per_second', self.bytes_restored / self.duration, **labels)
+
+    def describe(self) -> str:
+        duration = max(self.duration, 1e-6)
+        return "%s: %.1f MiB downloaded, %.1f MiB restored (%s files) in %.1f s, %.1f MiB/s" % (
+            self.key, self.bytes_downloaded / 1024 / 1024, self.bytes_restored / 1024 / 1024,
+            self.files, duration, self.bytes_restored / 1024 / 1024 / duration,
+        )
+
+
+class CountingReader(io.RawIOBase):
+
+    def __init__(self, fileobj: BinaryIO, stats: RestoreStats):
+        self.fileobj = fileobj
+        self.stats = stats
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.fileobj.read(len(buffer))
+        buffer[:len(data)] = data
+        self.stats.add(downloaded=len(data))
+        return len(data)
+
+    def close(self):
+        self.fileobj.close()
+        super(CountingReader, self).close()
+
+
+def strip_encryption_suffix(key: str) -> str:
+    suffix = '.%s' % ENCRYPTION_EXTENSION
+    return key[:-len(suffix)] if key.endswith(suffix) else key
+
+
+def open_download(storage: Storage, key: str, stats: RestoreStats, encryption: Encryption | None = None, raw: bool = False) -> BinaryIO:
+    # Downloads `key` as a stream, decrypted and (unless `raw`) decompressed
+    # according to its extensions.
+    stream: BinaryIO = io.BufferedReader(CountingReader(storage.download_stream(key), stats), RESTORE_CHUNK_SIZE)  # type: ignore
+    name = strip_encryption_suffix(key)
+    if name != key:
+        if encryption is None:
+            stream.close()
+            raise ValueError("%s is encrypted but no encryption key is configured" % key)
+        stream = encryption.decrypt(stream)
+    codec = detect_codec(name) if not raw else None
+    return codec.decompress(stream) if codec is not None else stream
+
+
+def copy_to_file(fileobj: BinaryIO, path: str, stats: RestoreStats):
+    # Written next to the destination and renamed, so an interrupted restore
+    # never leaves a truncated file under the real name.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    partial_path = path + '.part'
+    with open(partial_path, 'wb') as f:
+        while True:
+            data = fileobj.read(RESTORE_CHUNK_SIZE)
+            if not data:
+                break
+            f.write(data)
+            stats.add(restored=len(data))
+    os.replace(partial_path, path)
+    stats.add(files=1)
+
+
+def pipe_to_process(fileobj: BinaryIO, args: List[str], env: Dict[str, str], name: str, stats: RestoreStats):
+    logger.info("Restore -> pipe into %s" % name)
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, env=env)  # nosec B603
+    try:
+        while True:
+            data = fileobj.read(RESTORE_CHUNK_SIZE)
+            if not data:
+                break
+            process.stdin.write(data)  # type: ignore
+            stats.add(restored=len(data))
+    except BrokenPipeError:
+        pass
+    finally:
+        with contextlib.suppress(BrokenPipeError):
+            process.stdin.close()  # type: ignore
+    exit_code = process.wait()
+    if exit_code != 0:
+        raise Exception("%s failed with the exit code: %s" % (name, exit_code))
+
+
+def run_process(args: List[str], env: Dict[str, str], name: str):
+    logger.info("Restore -> run %s" % name)
+    exit_code = subprocess.call(args, env=env)  # nosec B603
+    if exit_code != 0:
+        raise Exception("%s failed with the exit code: %s" % (name, exit_code))
+
+
+def download_files(storage: Storage, files: Dict[str, str], jobs: int, stats: RestoreStats, encryption: Encryption | None = None):
+    # Downloads several objects concurrently, each to its local path.
+    # Encrypted objects are decrypted on the way.
+    def download(key: str, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if strip_encryption_suffix(key) != key:
+            with open_download(storage, key, stats, encryption, raw=True) as stream:
+                copy_to_file(stream, path, stats)
+            return
+        storage.download(key, path)
+        size = os.path.getsize(path)
+        stats.add(downloaded=size, restored=size, files=1)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for future in [executor.submit(download, key, path) for key, path in files.items()]:
+            future.result()
+
+
+def extract_zip(path: str, destination: str, jobs: int, stats: RestoreStats):
+    # Members are split across threads that each open the archive on their
+    # own; zlib releases the GIL, so inflating runs in parallel.
+    with zipfile.ZipFile(path) as archive:
+        members = [member for member in archive.infolist() if not member.is_dir()]
+        for member in archive.infolist():
+            if member.is_dir():
+                archive.extract(member, destination)
+    members.sort(key=lambda member: member.file_size, reverse=True)
+    groups: List[List[zipfile.ZipInfo]] = [[] for _ in range(max(jobs, 1))]
+    sizes = [0] * len(groups)
+    for member in members:
+        index = sizes.index(min(sizes))
+        groups[index].append(member)
+        sizes[index] += member.file_size
+
+    def extract(group: List[zipfile.ZipInfo]):
+        with zipfile.ZipFile(path) as archive:
+            for member in group:
+                archive.extract(member, destination)
+                stats.add(restored=member.file_size, files=1)
+
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        for future in [executor.submit(extract, group) for group in groups if group]:
+            future.result()
+
+
+def extract_tar_stream(fileobj: BinaryIO, destination: str, stats: RestoreStats):
+    # Members are extracted as they arrive, the archive is never staged.
+    root = os.path.realpath(destination)
+    with tarfile.open(fileobj=fileobj, mode='r|') as archive:
+        for member in archive:
+            path = os.path.realpath(os.path.join(root, member.name))
+            if path != root and not path.startswith(root + os.sep):
+                raise ValueError("%s points outside of %s" % (member.name, destination))
+            if hasattr(tarfile, 'data_filter'):
+                archive.extract(member, root, filter='data')
+            else:
+                archive.extract(member, root)
+            if member.isfile():
+                stats.add(restored=member.size, files=1)
+
+
+def remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
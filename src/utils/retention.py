@@ -0,0 +1,58 @@
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+
+# Bucket of a timestamp for every retention period. The newest artifact of a
+# bucket represents it.
+RETENTION_PERIODS: Dict[str, Callable[[datetime], str]] = {
+    'hourly': lambda moment: moment.strftime('%Y-%m-%dT%H'),
+    'daily': lambda moment: moment.strftime('%Y-%m-%d'),
+    'weekly': lambda moment: '%s-W%02d' % moment.isocalendar()[:2],
+    'monthly': lambda moment: moment.strftime('%Y-%m'),
+    'yearly': lambda moment: moment.strftime('%Y'),
+}
+
+
+class RetentionPolicy:
+    # Grandfather-father-son retention: keeps the `last` N artifacts plus the
+    # newest artifact of each of the last N hours, days, weeks, months and
+    # years that have one. The newest artifact is always kept.
+
+    def __init__(self, last: int = 1, min_age: float = 0, **periods: int):
+        unknown = set(periods) - set(RETENTION_PERIODS)
+        if unknown:
+            raise ValueError("Unknown retention periods: %s" % ', '.join(sorted(unknown)))
+        self.last = max(int(last), 1)
+        self.min_age = float(min_age)
+        self.periods = {name: int(count) for name, count in periods.items() if count}
+
+    @classmethod
+    def from_config(cls, config: dict | None) -> 'RetentionPolicy | None':
+        if not config:
+            return None
+        return cls(**config)
+
+    def get_expired(self, artifacts: List[dict], now: float | None = None) -> List[dict]:
+        # `artifacts` are catalog rows with a `created_at` timestamp. Artifacts
+        # younger than `min_age` seconds are never expired.
+        now = time.time() if now is None else now
+        ordered = sorted(artifacts, key=lambda artifact: artifact['created_at'], reverse=True)
+        keep: Set[int] = set(range(min(self.last, len(ordered))))
+        for name, count in self.periods.items():
+            buckets: Set[str] = set()
+            for index, artifact in enumerate(ordered):
+                bucket = RETENTION_PERIODS[name](datetime.fromtimestamp(artifact['created_at'], timezone.utc))
+                if bucket in buckets:
+                    continue
+                if len(buckets) >= count:
+                    break
+                buckets.add(bucket)
+                keep.add(index)
+        return [
+            artifact for index, artifact in enumerate(ordered)
+            if index not in keep and now - artifact['created_at'] >= self.min_age
+        ]
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, List
+
+from utils.functions import RetryPolicy, call_with_backoff, is_process_alive
+from utils.logs import log_context
+from utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+RUN_STATUS_RUNNING = 'running'
+RUN_STATUS_DONE = 'done'
+RUN_STATUS_FAILED = 'failed'
+
+# A failed run keeps its dump for this many resumptions before the next run
+# starts over with a fresh one.
+RUN_MAX_RESUMES = 3
+
+
+class RunJournal:
+    # Checkpoint journal of one backup run, stored as JSON in the state
+    # directory. It records the run's output filename and every stage that
+    # already completed together with its result (e.g. the dump artifact).
+
+    def __init__(self, path: str, data: dict):
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def load(cls, path: str) -> 'RunJournal | None':
+        try:
+            with open(path) as f:
+                return cls(path, json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def create(cls, path: str, output_filename: str) -> 'RunJournal':
+        journal = cls(path, {
+            'run_id': uuid.uuid4().hex,
+            'pid': os.getpid(),
+            'status': RUN_STATUS_RUNNING,
+            'output_filename': output_filename,
+            'started_at': time.time(),
+            'stages': {},
+        })
+        journal.save()
+        return journal
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(temp_path, self.path)
+
+    def is_done(self, stage: str) -> bool:
+        return self.data['stages'].get(stage, {}).get('status') == RUN_STATUS_DONE
+
+    def get_result(self, stage: str) -> Any:
+        return self.data['stages'].get(stage, {}).get('result')
+
+    def mark(self, stage: str, status: str, result: Any = None, **fields):
+        entry = self.data['stages'].setdefault(stage, {'attempts': 0})
+        entry.update(fields)
+        entry['status'] = status
+        entry['result'] = result
+        entry['updated_at'] = time.time()
+        self.save()
+
+
+class BackupRun:
+    # Per-run state machine. Each stage runs with its own retry policy and is
+    # checkpointed in the journal, so a retry resumes at the first stage that
+    # has not completed instead of starting the whole backup over. A run that
+    # failed or was interrupted (its process died) is resumed by the next run
+    # of the same target when the artifact of its dump stage is still on disk.
+
+    def __init__(
+        self,
+        journal_path: str,
+        output_filename: str,
+        policies: Dict[str, RetryPolicy],
+        labels: Dict[str, str] | None = None,
+    ):
+        self.policies = policies
+        self.labels = labels or {}
+        # An earlier run that failed and is not resumed; the target drops
+        # what it left behind.
+        self.abandoned: RunJournal | None = None
+        journal = RunJournal.load(journal_path)
+        if journal is not None and self.is_resumable(journal):
+            logger.info("BackupRun -> resume run %s (%s)", journal.data['run_id'], journal.data['output_filename'])
+            journal.data['pid'] = os.getpid()
+            journal.data['status'] = RUN_STATUS_RUNNING
+            journal.data['resumes'] = journal.data.get('resumes', 0) + 1
+            journal.save()
+            self.journal = journal
+        else:
+            if journal is not None and self.is_finished(journal):
+                self.abandoned = journal
+            self.journal = RunJournal.create(journal_path, output_filename)
+
+    @staticmethod
+    def is_finished(journal: RunJournal) -> bool:
+        # Failed, or still marked running by a process that is gone. A journal
+        # without a pid counts as gone: os.kill(0, 0) signals our own group.
+        if journal.data.get('status') == RUN_STATUS_RUNNING:
+            pid = journal.data.get('pid')
+            return not pid or not is_process_alive(pid)
+        return journal.data.get('status') == RUN_STATUS_FAILED
+
+    @classmethod
+    def is_resumable(cls, journal: RunJournal) -> bool:
+        if not cls.is_finished(journal) or journal.data.get('resumes', 0) >= RUN_MAX_RESUMES:
+            return False
+        artifact = journal.get_result('dump')
+        return not artifact or os.path.exists(artifact.get('path', ''))
+
+    @property
+    def run_id(self) -> str:
+        return self.journal.data['run_id']
+
+    @property
+    def output_filename(self) -> str:
+        return self.journal.data['output_filename']
+
+    def is_done(self, stage: str) -> bool:
+        return self.journal.is_done(stage)
+
+    def mark_done(self, stage: str, result: Any = None):
+        self.journal.mark(stage, RUN_STATUS_DONE, result)
+
+    def stage(self, name: str, func: Callable, *args, **kwargs) -> Any:
+        if self.journal.is_done(name):
+            logger.info("BackupRun -> skip completed stage '%s'", name)
+            return self.journal.get_result(name)
+
+        def attempt():
+            entry = self.journal.data['stages'].setdefault(name, {'attempts': 0})
+            self.journal.mark(name, RUN_STATUS_RUNNING, attempts=entry['attempts'] + 1)
+            return func(*args, **kwargs)
+
+        with log_context(stage=name):
+            started_at = time.monotonic()
+            try:
+                result = call_with_backoff(attempt, self.get_policy(name), name)
+            except Exception as e:
+                self.journal.mark(name, RUN_STATUS_FAILED, error=str(e))
+                raise
+            duration = time.monotonic() - started_at
+            self.journal.mark(name, RUN_STATUS_DONE, result, duration=duration)
+            retries = self.journal.data['stages'][name]['attempts'] - 1
+            self.record_stage(name, duration, retries)
+            logger.info("BackupRun -> stage '%s' done in %.1f seconds", name, duration, extra={'duration': duration, 'retries': retries})
+        return result
+
+    def record_stage(self, name: str, duration: float, retries: int):
+        stage = name.split(':', 1)[0]
+        get_metrics().observe('backup_stage_duration_seconds', duration, stage=stage, **self.labels)
+        if retries:
+            get_metrics().inc('backup_stage_retries_total', retries, stage=stage, **self.labels)
+
+    def get_policy(self, name: str) -> RetryPolicy:
+        return self.policies.get(name.split(':', 1)[0], self.policies['default'])
+
+    def pending(self, names: List[str]) -> List[str]:
+        return [name for name in names if not self.journal.is_done(name)]
+
+    def finish(self, status: str):
+        self.journal.data['status'] = status
+        self.journal.data['finished_at'] = time.time()
+        self.journal.save()
@@ -1,8 +1,19 @@
+import hashlib
+import io
+import itertools
 import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Deque, Dict, Iterator, List, Tuple
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from utils.environment import Environment
 from utils.functions import retry_if_exception_for_method
+from utils.io import read_full
 from utils.storages.base import Storage
 
 logger = logging.getLogger(__name__)
@@ -11,6 +22,62 @@ logger = logging.getLogger(__name__)
 STORAGE_RETRY_COUNT = 2
 STORAGE_RETRY_SLEEP = 5
 
+S3_MAX_PARTS = 10000
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_DELETE_BATCH_SIZE = 1000
+
+# One client per process and configuration. boto3 clients are thread-safe and
+# keep a pool of HTTP connections, so reusing them saves a TLS handshake and
+# credential resolution on every upload.
+_clients: Dict[Tuple, object] = {}
+_clients_lock = threading.Lock()
+
+
+class S3RangeReader(io.RawIOBase):
+    # Streams a large object with several ranged GETs in flight at once and
+    # hands the parts out in order. At most `workers` parts are buffered, so
+    # memory stays bounded however large the object is.
+
+    def __init__(self, client, bucket: str, key: str, size: int, part_size: int, workers: int):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.part_size = part_size
+        self.workers = max(workers, 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending: Deque[Future] = deque()
+        self.offset = 0
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def fetch(self, start: int, end: int) -> bytes:
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range='bytes=%s-%s' % (start, end - 1))
+        return response['Body'].read()
+
+    def fill(self):
+        while self.offset < self.size and len(self.pending) < self.workers:
+            end = min(self.offset + self.part_size, self.size)
+            self.pending.append(self.executor.submit(self.fetch, self.offset, end))
+            self.offset = end
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            self.fill()
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        super(S3RangeReader, self).close()
+
 
 class AWSStorage(Storage):
 
@@ -22,24 +89,214 @@ class AWSStorage(Storage):
         aws_secret_access_key: str,
         environment: Environment,
         namespace: str | None,
+        endpoint_url: str | None = None,
+        multipart_threshold: int = 8 * 1024 * 1024,
+        multipart_chunksize: int = 8 * 1024 * 1024,
+        max_concurrency: int = 10,
+        use_threads: bool = True,
+        max_pool_connections: int | None = None,
+        throttle: dict | None = None,
     ):
-        super(AWSStorage, self).__init__(environment, namespace)
+        super(AWSStorage, self).__init__(environment, namespace, throttle)
         self.aws_bucket_name = aws_bucket_name
         self.aws_region = aws_region
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self.endpoint_url = endpoint_url
+        self.max_pool_connections = int(max_pool_connections or max(int(max_concurrency), 10))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=int(multipart_threshold),
+            multipart_chunksize=max(int(multipart_chunksize), S3_MIN_PART_SIZE),
+            max_concurrency=int(max_concurrency),
+            use_threads=use_threads,
+        )
+        # Multipart uploads that failed part-way, keyed by output: the upload
+        # id, the part size and the (MD5, ETag) of every part sent.
+        self.multipart_uploads: Dict[str, dict] = {}
+
+    def get_client(self):
+        key = (self.aws_region, self.aws_access_key_id, self.endpoint_url, self.max_pool_connections)
+        with _clients_lock:
+            if key not in _clients:
+                _clients[key] = boto3.session.Session().client(
+                    's3',
+                    region_name=self.aws_region,
+                    aws_access_key_id=self.aws_access_key_id,
+                    aws_secret_access_key=self.aws_secret_access_key,
+                    endpoint_url=self.endpoint_url,
+                    config=Config(max_pool_connections=self.max_pool_connections),
+                )
+            return _clients[key]
 
     @retry_if_exception_for_method(STORAGE_RETRY_COUNT, STORAGE_RETRY_SLEEP)
     def upload(self, source: str, output: str):
-        logger.info("AWSStorage -> upload('%s', '%s')" % (source, output))
-        s3 = boto3.resource(
-            's3',
-            region_name=self.aws_region,
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
+        logger.info("AWSStorage -> upload('%s', '%s')", source, output)
+        with open(source, 'rb') as f:
+            self.upload_stream(f, output)
+
+    def upload_stream(self, fileobj: BinaryIO, output: str, metadata: dict | None = None):
+        # Objects below the multipart threshold are sent with one PUT, larger
+        # ones as parts of `multipart_chunksize`, the layout FanOut predicts
+        # the ETag from. Only `max_concurrency` parts are in memory at a time.
+        logger.info("AWSStorage -> upload_stream('%s')", output)
+        fileobj = self.throttled(fileobj)
+        part_size = self.transfer_config.multipart_chunksize
+        head: List[bytes] = []
+        size = 0
+        while size < self.transfer_config.multipart_threshold:
+            part = read_full(fileobj, part_size)
+            if part:
+                head.append(part)
+                size += len(part)
+            if len(part) < part_size:
+                break
+        if size < self.transfer_config.multipart_threshold or not head:
+            # S3 refuses to complete a multipart upload without parts.
+            self.get_client().put_object(
+                Bucket=self.aws_bucket_name, Key=output, Body=b''.join(head), **({'Metadata': metadata} if metadata else {}),
+            )
+            return
+        parts = itertools.chain(head, iter(lambda: read_full(fileobj, part_size), b''))
+        self.upload_parts(parts, output, part_size, metadata)
+
+    def upload_parts(self, parts: Iterator[bytes], output: str, part_size: int, metadata: dict | None):
+        # A multipart upload that fails is kept for the next attempt of the
+        # same output (upload_stage retries re-open the artifact). The parts
+        # of the new stream are hashed and only those whose MD5 differs from
+        # the part S3 already holds are sent, so an unchanged artifact resumes
+        # where it stopped and a changed one is still uploaded correctly.
+        client = self.get_client()
+        upload = self.get_resumable_upload(output, part_size)
+        if upload is None:
+            response = client.create_multipart_upload(
+                Bucket=self.aws_bucket_name, Key=output, **({'Metadata': metadata} if metadata else {}),
+            )
+            upload = {'upload_id': response['UploadId'], 'part_size': part_size, 'parts': {}}
+            self.multipart_uploads[output] = upload
+        sent: Dict[int, Tuple[str, str]] = upload['parts']
+
+        def upload_part(number: int, body: bytes, digest: str):
+            response = client.upload_part(
+                Bucket=self.aws_bucket_name, Key=output, UploadId=upload['upload_id'], PartNumber=number, Body=body,
+            )
+            sent[number] = (digest, response['ETag'])
+
+        count = 0
+        skipped = 0
+        workers = self.transfer_config.max_request_concurrency if self.transfer_config.use_threads else 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending: Deque[Future] = deque()
+            for count, body in enumerate(parts, 1):
+                if count > S3_MAX_PARTS:
+                    raise IOError("%s has more than %s parts, raise multipart_chunksize" % (output, S3_MAX_PARTS))
+                digest = hashlib.md5(body, usedforsecurity=False).hexdigest()
+                if count in sent and sent[count][0] == digest:
+                    skipped += 1
+                    continue
+                while len(pending) >= workers:
+                    pending.popleft().result()
+                pending.append(executor.submit(upload_part, count, body, digest))
+            while pending:
+                pending.popleft().result()
+        if skipped:
+            logger.info("AWSStorage -> resumed upload of '%s', %s of %s parts were already uploaded", output, skipped, count)
+
+        client.complete_multipart_upload(
+            Bucket=self.aws_bucket_name,
+            Key=output,
+            UploadId=upload['upload_id'],
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': sent[number][1]} for number in range(1, count + 1)]},
+        )
+        del self.multipart_uploads[output]
+
+    def get_resumable_upload(self, output: str, part_size: int) -> dict | None:
+        # Keeps the parts of an earlier attempt that S3 still has.
+        upload = self.multipart_uploads.get(output)
+        if upload is None or upload['part_size'] != part_size:
+            return None
+        etags: Dict[int, str] = {}
+        try:
+            paginator = self.get_client().get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.aws_bucket_name, Key=output, UploadId=upload['upload_id']):
+                for part in page.get('Parts', []):
+                    etags[part['PartNumber']] = part['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+            del self.multipart_uploads[output]
+            return None
+        upload['parts'] = {number: part for number, part in upload['parts'].items() if etags.get(number) == part[1]}
+        return upload
+
+    def abort_partial_uploads(self):
+        # Multipart uploads of a process that died are not aborted here; a
+        # bucket lifecycle rule with AbortIncompleteMultipartUpload removes
+        # their parts.
+        client = self.get_client()
+        for output, upload in list(self.multipart_uploads.items()):
+            logger.info("AWSStorage -> abort the multipart upload of '%s'", output)
+            try:
+                client.abort_multipart_upload(Bucket=self.aws_bucket_name, Key=output, UploadId=upload['upload_id'])
+            except ClientError as e:
+                logger.warning("AWSStorage -> failed to abort the multipart upload of '%s': %s", output, e)
+            del self.multipart_uploads[output]
+
+    def download_stream(self, key: str) -> BinaryIO:
+        logger.info("AWSStorage -> download_stream('%s')", key)
+        client = self.get_client()
+        size = client.head_object(Bucket=self.aws_bucket_name, Key=key)['ContentLength']
+        if size < self.transfer_config.multipart_threshold or not self.transfer_config.use_threads:
+            return client.get_object(Bucket=self.aws_bucket_name, Key=key)['Body']
+        return S3RangeReader(  # type: ignore
+            client, self.aws_bucket_name, key, size,
+            self.transfer_config.multipart_chunksize, self.transfer_config.max_request_concurrency,
+        )
+
+    def download(self, key: str, path: str):
+        # download_file fetches ranges concurrently and writes them in place.
+        logger.info("AWSStorage -> download('%s', '%s')", key, path)
+        self.get_client().download_file(self.aws_bucket_name, key, path, Config=self.transfer_config)
+
+    def read_range(self, key: str, offset: int, length: int) -> bytes:
+        response = self.get_client().get_object(
+            Bucket=self.aws_bucket_name, Key=key, Range='bytes=%s-%s' % (offset, offset + length - 1),
         )
-        bucket = s3.Bucket(self.aws_bucket_name)
-        bucket.upload_file(source, output)
+        return response['Body'].read()
+
+    def stat(self, key: str) -> dict:
+        response = self.get_client().head_object(Bucket=self.aws_bucket_name, Key=key)
+        # Under SSE-KMS (e.g. a bucket default) or SSE-C the ETag is not an
+        # MD5 of the content, so there is nothing to compare it with and
+        # callers fall back to the size.
+        if response.get('ServerSideEncryption') == 'aws:kms' or 'SSECustomerAlgorithm' in response:
+            return {'size': response['ContentLength'], 'etag': None}
+        return {'size': response['ContentLength'], 'etag': response['ETag'].strip('"')}
+
+    def get_multipart_config(self) -> Tuple[int, int] | None:
+        return self.transfer_config.multipart_threshold, self.transfer_config.multipart_chunksize
+
+    def list(self, prefix: str) -> Iterator[dict]:
+        paginator = self.get_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.aws_bucket_name, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield {'key': item['Key'], 'size': item['Size'], 'modified': item['LastModified'].timestamp()}
+
+    def delete_many(self, keys: List[str]):
+        # One DeleteObjects request per 1000 keys instead of a request per key.
+        logger.info("AWSStorage -> delete_many(%s keys)", len(keys))
+        client = self.get_client()
+        errors = []
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            response = client.delete_objects(
+                Bucket=self.aws_bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys[start:start + S3_DELETE_BATCH_SIZE]], 'Quiet': True},
+            )
+            errors.extend(response.get('Errors', []))
+        if errors:
+            raise IOError("Failed to delete %s objects, e.g. %s: %s" % (len(errors), errors[0].get('Key'), errors[0].get('Message')))
+
+    def get_resource_keys(self) -> List[str]:
+        return ['s3:%s' % (self.endpoint_url or self.aws_region)]
 
     def describe(self):
         return '(AWS region: %s, S3 Bucket: %s)' % (self.aws_region, self.aws_bucket_name)
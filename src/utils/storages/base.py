@@ -1,17 +1,81 @@
 import logging
+import shutil
 from abc import ABC, abstractmethod
+from typing import BinaryIO, Iterator, List, Tuple
 
 from utils.environment import Environment
+from utils.throttling import Throttle, throttled
 
 logger = logging.getLogger(__name__)
 
 
+STORAGE_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
 class Storage(ABC):
 
-    def __init__(self, environment: Environment, namespace: str | None):
+    def __init__(self, environment: Environment, namespace: str | None, throttle: dict | None = None):
         self.environment = environment
         self.namespace = namespace
+        self.throttle_config = throttle
+        self._throttle: Throttle | None = None
 
     @abstractmethod
     def upload(self, source: str, output: str):
         pass
+
+    @abstractmethod
+    def upload_stream(self, fileobj: BinaryIO, output: str, metadata: dict | None = None):
+        pass
+
+    def download_stream(self, key: str) -> BinaryIO:
+        raise NotImplementedError
+
+    def download(self, key: str, path: str):
+        with self.download_stream(key) as stream, open(path, 'wb') as f:
+            shutil.copyfileobj(stream, f, STORAGE_DOWNLOAD_CHUNK_SIZE)
+
+    def read_range(self, key: str, offset: int, length: int) -> bytes:
+        raise NotImplementedError
+
+    def stat(self, key: str) -> dict:
+        # {'size': ..., 'etag': ... or None} of a stored object.
+        raise NotImplementedError
+
+    def abort_partial_uploads(self):
+        # Drops what failed uploads left behind for a retry to resume from,
+        # once the run gives up on them. Storages that keep nothing between
+        # attempts have nothing to drop.
+        return None
+
+    def get_multipart_config(self) -> Tuple[int, int] | None:
+        # (threshold, part size) of storages whose ETags derive from the
+        # parts of multipart uploads.
+        return None
+
+    def list(self, prefix: str) -> Iterator[dict]:
+        # Yields {'key', 'size', 'modified'} for every object whose key starts
+        # with `prefix`, recursively.
+        raise NotImplementedError
+
+    def delete_many(self, keys: List[str]):
+        raise NotImplementedError
+
+    def get_throttle(self) -> Throttle | None:
+        # The bucket is named after the storage, so every namespace and worker
+        # uploading to the same storage draws from the same budget.
+        if self._throttle is None and self.throttle_config is not None:
+            self._throttle = Throttle.from_config(self.throttle_config, 'storage:%s' % self.get_key(), self.environment.STATE_DIR)  # type: ignore
+        return self._throttle
+
+    def throttled(self, fileobj: BinaryIO) -> BinaryIO:
+        return throttled(fileobj, [self.get_throttle()])
+
+    def describe(self):
+        return '()'
+
+    def get_resource_keys(self) -> List[str]:
+        return []
+
+    def get_key(self) -> str:
+        return '%s%s' % (type(self).__name__, self.describe())
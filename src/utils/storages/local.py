@@ -1,8 +1,12 @@
+import contextlib
 import logging
+import os
 import shutil
+from typing import BinaryIO, Iterator, List
 
 from utils.environment import Environment
 from utils.functions import retry_if_exception_for_method
+from utils.io import get_disk_key
 from utils.storages.base import Storage
 
 logger = logging.getLogger(__name__)
@@ -10,6 +14,7 @@ logger = logging.getLogger(__name__)
 
 STORAGE_RETRY_COUNT = 2
 STORAGE_RETRY_SLEEP = 5
+STORAGE_STREAM_CHUNK_SIZE = 1024 * 1024
 
 
 class LocalStorage(Storage):
@@ -19,14 +24,91 @@ class LocalStorage(Storage):
         backup_path: str,
         environment: Environment,
         namespace: str | None,
+        throttle: dict | None = None,
     ):
-        super(LocalStorage, self).__init__(environment, namespace)
+        super(LocalStorage, self).__init__(environment, namespace, throttle)
         self.backup_path = backup_path
 
     @retry_if_exception_for_method(STORAGE_RETRY_COUNT, STORAGE_RETRY_SLEEP)
     def upload(self, source: str, output: str):
-        logger.info("LocalStorage -> upload('%s', '%s')" % (source, output))
-        shutil.copyfile(source, self.backup_path + '/' + output)
+        logger.info("LocalStorage -> upload('%s', '%s')", source, output)
+        if self.get_throttle() is None:
+            shutil.copyfile(source, self.get_output_path(output))
+            return
+        with open(source, 'rb') as f, open(self.get_output_path(output), 'wb') as target:
+            shutil.copyfileobj(self.throttled(f), target, STORAGE_STREAM_CHUNK_SIZE)
+
+    def upload_stream(self, fileobj: BinaryIO, output: str, metadata: dict | None = None):
+        logger.info("LocalStorage -> upload_stream('%s')", output)
+        with open(self.get_output_path(output), 'wb') as f:
+            shutil.copyfileobj(self.throttled(fileobj), f, STORAGE_STREAM_CHUNK_SIZE)
+
+    def get_output_path(self, output: str) -> str:
+        path = self.backup_path + '/' + output
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def download_stream(self, key: str) -> BinaryIO:
+        logger.info("LocalStorage -> download_stream('%s')", key)
+        # Returned open; callers close it.
+        return open(self.backup_path + '/' + key, 'rb')  # noqa: SIM115
+
+    def download(self, key: str, path: str):
+        logger.info("LocalStorage -> download('%s', '%s')", key, path)
+        shutil.copyfile(self.backup_path + '/' + key, path)
+
+    def read_range(self, key: str, offset: int, length: int) -> bytes:
+        with open(self.backup_path + '/' + key, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def stat(self, key: str) -> dict:
+        return {'size': os.path.getsize(self.backup_path + '/' + key), 'etag': None}
+
+    def list(self, prefix: str) -> Iterator[dict]:
+        # Only entries of the prefix's directory that match it are walked, so
+        # listing one namespace does not descend into the others.
+        directory, _, name_prefix = prefix.rpartition('/')
+        root = os.path.join(self.backup_path, directory) if directory else self.backup_path
+        try:
+            entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.name.startswith(name_prefix):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                for current, dirnames, filenames in os.walk(entry.path):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        yield self.get_object(os.path.join(current, filename))
+            elif entry.is_file(follow_symlinks=False):
+                yield self.get_object(entry.path)
+
+    def get_object(self, path: str) -> dict:
+        stat = os.stat(path)
+        return {'key': os.path.relpath(path, self.backup_path), 'size': stat.st_size, 'modified': stat.st_mtime}
+
+    def delete_many(self, keys: List[str]):
+        logger.info("LocalStorage -> delete_many(%s keys)", len(keys))
+        root = os.path.normpath(self.backup_path)
+        parents = set()
+        for key in keys:
+            path = os.path.normpath(os.path.join(root, key))
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            parents.add(os.path.dirname(path))
+        # Drop directories emptied by the deletion, e.g. of directory dumps.
+        for parent in sorted(parents, key=len, reverse=True):
+            while parent != root and parent.startswith(root + os.sep):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+
+    def get_resource_keys(self) -> List[str]:
+        return [get_disk_key(self.backup_path)]
 
     def describe(self):
         return '(Local directory path: %s)' % (self.backup_path,)
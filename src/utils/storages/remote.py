@@ -1,8 +1,18 @@
+import atexit
+import contextlib
+import hashlib
+import io
 import logging
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import BinaryIO, Dict, Iterator, List, Set, Tuple
 
 import paramiko
 from utils.environment import Environment
 from utils.functions import retry_if_exception_for_method
+from utils.io import read_full
 from utils.storages.base import Storage
 
 logger = logging.getLogger(__name__)
@@ -11,6 +21,119 @@ logger = logging.getLogger(__name__)
 STORAGE_RETRY_COUNT = 2
 STORAGE_RETRY_SLEEP = 5
 
+SFTP_WINDOW_SIZE = 64 * 1024 * 1024
+SFTP_MAX_PACKET_SIZE = 256 * 1024
+SFTP_BUFFER_SIZE = 1024 * 1024
+SFTP_MAX_CHANNELS = 4
+SFTP_PARTIAL_SUFFIX = '.part'
+SFTP_PREFETCH_REQUESTS = 64
+
+
+class SFTPConnectionPool:
+    # Keeps one SSH transport per (host, port, user) open for the whole run and
+    # hands out SFTP channels multiplexed over it, so several files can be
+    # uploaded concurrently without paying the handshake and auth per file.
+
+    def __init__(self, host: str, port: int, username: str, password: str, max_channels: int):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(max_channels)
+        self.ssh: paramiko.SSHClient | None = None
+        self.idle: List[paramiko.SFTPClient] = []
+
+    def get_transport(self) -> paramiko.Transport:
+        with self.lock:
+            transport = self.ssh.get_transport() if self.ssh is not None else None
+            if transport is None or not transport.is_active():
+                self.close_locked()
+                logger.info("SFTPConnectionPool -> connect to %s:%s", self.host, self.port)
+                ssh = paramiko.SSHClient()
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                ssh.connect(hostname=self.host, port=self.port, username=self.username, password=self.password)
+                transport = ssh.get_transport()
+                transport.default_window_size = SFTP_WINDOW_SIZE  # type: ignore
+                transport.default_max_packet_size = SFTP_MAX_PACKET_SIZE  # type: ignore
+                self.ssh = ssh
+            return transport  # type: ignore
+
+    @contextmanager
+    def channel(self) -> Iterator[paramiko.SFTPClient]:
+        with self.semaphore:
+            transport = self.get_transport()
+            with self.lock:
+                sftp = self.idle.pop() if self.idle else None
+            if sftp is None or sftp.get_channel().get_transport() is not transport:  # type: ignore
+                sftp = paramiko.SFTPClient.from_transport(
+                    transport, window_size=SFTP_WINDOW_SIZE, max_packet_size=SFTP_MAX_PACKET_SIZE,
+                )
+            try:
+                yield sftp  # type: ignore
+            except Exception:
+                sftp.close()  # type: ignore
+                raise
+            with self.lock:
+                self.idle.append(sftp)  # type: ignore
+
+    def close_locked(self):
+        for sftp in self.idle:
+            sftp.close()
+        self.idle = []
+        if self.ssh is not None:
+            self.ssh.close()
+            self.ssh = None
+
+    def close(self):
+        with self.lock:
+            self.close_locked()
+
+
+_pools: Dict[Tuple[str, int, str], SFTPConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host: str, port: int, username: str, password: str, max_channels: int) -> SFTPConnectionPool:
+    key = (host, int(port), username)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = SFTPConnectionPool(host, int(port), username, password, max_channels)
+        return _pools[key]
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+class SFTPDownloadStream(io.RawIOBase):
+    # Holds a pooled channel for as long as the download is open. Reads are
+    # prefetched with a bounded number of requests in flight, which hides the
+    # round trip per packet without buffering the whole file.
+
+    def __init__(self, pool: SFTPConnectionPool, path: str):
+        self.stack = ExitStack()
+        sftp = self.stack.enter_context(pool.channel())
+        self.file = self.stack.enter_context(sftp.open(path, 'rb'))
+        self.file.prefetch(max_concurrent_requests=SFTP_PREFETCH_REQUESTS)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.stack.close()
+        super(SFTPDownloadStream, self).close()
+
 
 class RemoteStorage(Storage):
 
@@ -23,24 +146,180 @@ class RemoteStorage(Storage):
         remote_dir_path: str,
         environment: Environment,
         namespace: str | None,
+        max_channels: int = SFTP_MAX_CHANNELS,
+        throttle: dict | None = None,
     ):
-        super(RemoteStorage, self).__init__(environment, namespace)
+        super(RemoteStorage, self).__init__(environment, namespace, throttle)
         self.ssh_username = ssh_username
         self.ssh_password = ssh_password
         self.ssh_host = ssh_host
         self.ssh_port = ssh_port
         self.remote_dir_path = remote_dir_path
+        self.max_channels = int(max_channels)
+        # SHA-256 of the blocks written to the `.part` of failed uploads,
+        # keyed by output.
+        self.partial_uploads: Dict[str, List[bytes]] = {}
+
+    def get_pool(self) -> SFTPConnectionPool:
+        return get_pool(self.ssh_host, self.ssh_port, self.ssh_username, self.ssh_password, self.max_channels)
 
     @retry_if_exception_for_method(STORAGE_RETRY_COUNT, STORAGE_RETRY_SLEEP)
     def upload(self, source: str, output: str):
-        logger.info("RemoteStorage -> upload('%s', '%s')" % (source, output))
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname=self.ssh_host, port=self.ssh_port, username=self.ssh_username, password=self.ssh_password)
-        sftp = ssh.open_sftp()
-        sftp.put(source, self.remote_dir_path + '/' + output)
-        sftp.close()
-        ssh.close()
+        logger.info("RemoteStorage -> upload('%s', '%s')", source, output)
+        with open(source, 'rb') as f:
+            self.upload_stream(f, output)
+
+    def upload_stream(self, fileobj: BinaryIO, output: str, metadata: dict | None = None):
+        # Files are written to `<output>.part` and renamed when complete. The
+        # SHA-256 of every SFTP_BUFFER_SIZE block written is kept, so when a
+        # retry of the same output finds the `.part` of a failed attempt, the
+        # blocks of the new stream that match whole blocks of it are skipped.
+        # The file is cut back to the first block that differs or was only
+        # partly written, and the upload continues from there.
+        logger.info("RemoteStorage -> upload_stream('%s')", output)
+        fileobj = self.throttled(fileobj)
+        with self.get_pool().channel() as sftp:
+            path = self.get_output_path(sftp, output)
+            partial_path = path + SFTP_PARTIAL_SUFFIX
+            sent = self.partial_uploads.get(output, [])
+            held = self.get_partial_size(sftp, partial_path) // SFTP_BUFFER_SIZE if sent else 0
+
+            digests: List[bytes] = []
+            block = read_full(fileobj, SFTP_BUFFER_SIZE)
+            while len(block) == SFTP_BUFFER_SIZE and len(digests) < min(held, len(sent)):
+                digest = hashlib.sha256(block).digest()
+                if digest != sent[len(digests)]:
+                    break
+                digests.append(digest)
+                block = read_full(fileobj, SFTP_BUFFER_SIZE)
+
+            offset = len(digests) * SFTP_BUFFER_SIZE
+            if offset:
+                logger.info("RemoteStorage -> resume '%s' at %s bytes", output, offset)
+                remote = sftp.open(partial_path, 'r+b')
+                remote.truncate(offset)
+                remote.seek(offset)
+            else:
+                remote = sftp.open(partial_path, 'wb')
+            self.partial_uploads[output] = digests
+            size = offset
+            with remote:
+                # Pipelined writes don't wait for the server to acknowledge
+                # each packet; errors are raised when the file is closed.
+                remote.set_pipelined(True)
+                while block:
+                    remote.write(block)
+                    digests.append(hashlib.sha256(block).digest())
+                    size += len(block)
+                    block = read_full(fileobj, SFTP_BUFFER_SIZE)
+
+            if sftp.stat(partial_path).st_size != size:
+                raise IOError("size mismatch after upload of %s" % output)
+            self.rename(sftp, partial_path, path)
+        del self.partial_uploads[output]
+
+    def abort_partial_uploads(self):
+        outputs = list(self.partial_uploads)
+        self.partial_uploads.clear()
+        with self.get_pool().channel() as sftp:
+            for output in outputs:
+                logger.info("RemoteStorage -> remove the partial upload of '%s'", output)
+                with contextlib.suppress(FileNotFoundError):
+                    sftp.remove(self.remote_dir_path + '/' + output + SFTP_PARTIAL_SUFFIX)
+
+    @staticmethod
+    def get_partial_size(sftp: paramiko.SFTPClient, path: str) -> int:
+        try:
+            return sftp.stat(path).st_size or 0
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def rename(sftp: paramiko.SFTPClient, source: str, target: str):
+        try:
+            sftp.posix_rename(source, target)
+        except IOError:
+            # Servers without the posix-rename extension refuse to overwrite.
+            with contextlib.suppress(FileNotFoundError):
+                sftp.remove(target)
+            sftp.rename(source, target)
+
+    def get_output_path(self, sftp: paramiko.SFTPClient, output: str) -> str:
+        path = self.remote_dir_path + '/' + output
+        parent = self.remote_dir_path
+        for part in output.split('/')[:-1]:
+            parent = parent + '/' + part
+            try:
+                if not stat.S_ISDIR(sftp.stat(parent).st_mode or 0):
+                    raise IOError("%s is not a directory" % parent)
+            except FileNotFoundError:
+                try:
+                    sftp.mkdir(parent)
+                except IOError:
+                    # Another channel may have created it concurrently.
+                    sftp.stat(parent)
+        return path
+
+    def download_stream(self, key: str) -> BinaryIO:
+        logger.info("RemoteStorage -> download_stream('%s')", key)
+        return SFTPDownloadStream(self.get_pool(), self.remote_dir_path + '/' + key)  # type: ignore
+
+    def read_range(self, key: str, offset: int, length: int) -> bytes:
+        # readv pipelines the reads of a large range.
+        with self.get_pool().channel() as sftp, sftp.open(self.remote_dir_path + '/' + key, 'rb') as f:
+            return b''.join(f.readv([(offset, length)]))
+
+    def stat(self, key: str) -> dict:
+        with self.get_pool().channel() as sftp:
+            return {'size': sftp.stat(self.remote_dir_path + '/' + key).st_size, 'etag': None}
+
+    def list(self, prefix: str) -> Iterator[dict]:
+        directory, _, name_prefix = prefix.rpartition('/')
+        root = self.remote_dir_path + '/' + directory if directory else self.remote_dir_path
+        with self.get_pool().channel() as sftp:
+            try:
+                entries = sorted(sftp.listdir_attr(root), key=lambda entry: entry.filename)
+            except FileNotFoundError:
+                return
+            pending = [
+                ((directory + '/' if directory else '') + entry.filename, entry) for entry in entries
+                if entry.filename.startswith(name_prefix)
+            ]
+            while pending:
+                key, entry = pending.pop(0)
+                if stat.S_ISDIR(entry.st_mode or 0):
+                    children = sorted(sftp.listdir_attr(self.remote_dir_path + '/' + key), key=lambda child: child.filename)
+                    pending[0:0] = [(key + '/' + child.filename, child) for child in children]
+                elif stat.S_ISREG(entry.st_mode or 0):
+                    yield {'key': key, 'size': entry.st_size, 'modified': entry.st_mtime}
+
+    def delete_many(self, keys: List[str]):
+        # SFTP has no batch delete; removals are spread over the pool's
+        # channels instead.
+        logger.info("RemoteStorage -> delete_many(%s keys)", len(keys))
+        parents: Set[str] = set()
+
+        def remove(key: str):
+            with self.get_pool().channel() as sftp, contextlib.suppress(FileNotFoundError):
+                sftp.remove(self.remote_dir_path + '/' + key)
+            parents.add(key.rpartition('/')[0])
+
+        with ThreadPoolExecutor(max_workers=self.max_channels) as executor:
+            for future in [executor.submit(remove, key) for key in keys]:
+                future.result()
+
+        # Drop directories emptied by the deletion, e.g. of directory dumps.
+        with self.get_pool().channel() as sftp:
+            for parent in sorted(parents, key=len, reverse=True):
+                while parent:
+                    try:
+                        sftp.rmdir(self.remote_dir_path + '/' + parent)
+                    except IOError:
+                        break
+                    parent = parent.rpartition('/')[0]
+
+    def get_resource_keys(self) -> List[str]:
+        return ['sftp:%s:%s' % (self.ssh_host, self.ssh_port)]
 
     def describe(self):
         return '(Remote host: %s, directory path: %s)' % (self.ssh_host, self.remote_dir_path,)
@@ -1,10 +1,31 @@
+import io
+import json
 import logging
+import os
+import random
+import re
+import shutil
+import time
 from abc import ABC, abstractmethod
-from typing import List
+from typing import BinaryIO, Dict, List, Tuple
 
+from utils.catalog import Catalog, get_catalog_path
+from utils.checksums import MANIFEST_SUFFIX, check_range, dump_manifest, get_manifest_key
+from utils.compression import build_codec
+from utils.config import Config
+from utils.encryption import ENCRYPTION_EXTENSION, Encryption
 from utils.environment import Environment
+from utils.fanout import FanOut, FanOutResult
+from utils.functions import RetryPolicy
+from utils.logs import log_context
+from utils.metrics import get_metrics
 from utils.notifiers.base import Notifier
+from utils.notifiers.dispatcher import flush_notifications
+from utils.restore import RestoreStats
+from utils.retention import RetentionPolicy
+from utils.runs import RUN_STATUS_DONE, RUN_STATUS_FAILED, BackupRun
 from utils.storages.base import Storage
+from utils.throttling import Throttle, throttled
 
 logger = logging.getLogger(__name__)
 
@@ -12,15 +33,524 @@ logger = logging.getLogger(__name__)
 TARGET_RETRY_COUNT = 2
 TARGET_RETRY_SLEEP = 5
 
+DEFAULT_RETRY_POLICIES = {
+    'default': RetryPolicy(times=TARGET_RETRY_COUNT, sleep=TARGET_RETRY_SLEEP, max_sleep=60),
+    'dump': RetryPolicy(times=TARGET_RETRY_COUNT, sleep=TARGET_RETRY_SLEEP, max_sleep=60),
+    'upload': RetryPolicy(times=3, sleep=TARGET_RETRY_SLEEP, max_sleep=120),
+    'notify': RetryPolicy(times=3, sleep=3, max_sleep=30),
+}
+
+# `<prefix>_<timestamp>.` of artifacts named by get_output_filename.
+ARTIFACT_TIMESTAMP_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\.')
+ARTIFACT_PARTIAL_SUFFIX = '.part'
+
 
 class Target(ABC):
 
-    def __init__(self, storages: List[Storage], notifiers: List[Notifier], environment: Environment, namespace: str | None):
+    backup_kind = 'backup'
+
+    def __init__(
+        self,
+        storages: List[Storage],
+        notifiers: List[Notifier],
+        environment: Environment,
+        namespace: str | None,
+        compression: dict | None = None,
+        retry: dict | None = None,
+        throttle: dict | None = None,
+        retention: dict | None = None,
+        encryption: dict | None = None,
+    ):
         self.storages = storages
         self.notifiers = notifiers
         self.environment = environment
         self.namespace = namespace
+        self.codec = build_codec(compression)
+        self.retry_policies: Dict[str, RetryPolicy] = {
+            stage: RetryPolicy.from_config((retry or {}).get(stage), policy)
+            for stage, policy in DEFAULT_RETRY_POLICIES.items()
+        }
+        # Reads of the source are limited by the global BACKUP_THROTTLE and by
+        # the namespace's `throttle`; uploads are additionally limited by the
+        # throttle of each storage.
+        self.throttles = [
+            Throttle.from_config(Config.load_config_from_string(environment.THROTTLE or ''), 'global', environment.STATE_DIR),  # type: ignore
+            Throttle.from_config(throttle, 'namespace:%s' % self.get_prefix_name(), environment.STATE_DIR),  # type: ignore
+        ]
+        self.retention = RetentionPolicy.from_config(retention)
+        # Namespaces without `encryption` use BACKUP_ENCRYPTION_KEY when set.
+        self.encryption = Encryption.from_config(encryption, environment.ENCRYPTION_KEY)  # type: ignore
+
+    def get_prefix_name(self):
+        if self.namespace is not None:
+            return '%s_%s' % (self.environment.APP_NAME, self.namespace)
+        return self.environment.APP_NAME
 
     @abstractmethod
-    def backup(self, text):
+    def get_output_filename(self) -> str:
         pass
+
+    def get_lock_path(self) -> str:
+        return '%s/locks/%s.lock' % (self.environment.STATE_DIR, self.get_prefix_name())  # type: ignore
+
+    def get_resource_keys(self) -> List[str]:
+        # Shared resources a backup of this target keeps busy. The worker pool
+        # limits how many running jobs may hold the same key.
+        keys: List[str] = []
+        for storage in self.storages:
+            for key in storage.get_resource_keys():
+                if key not in keys:
+                    keys.append(key)
+        return keys
+
+    def get_journal_path(self) -> str:
+        return '%s/runs/%s.json' % (self.environment.STATE_DIR, self.get_prefix_name())  # type: ignore
+
+    # Stages
+
+    def create_artifact(self, output_filename: str) -> dict | None:
+        # The `dump` stage. Targets that stage their artifact on the local disk
+        # return {'path': ..., 'temporary': bool}; streaming targets produce
+        # nothing here and generate the data in open_artifact instead.
+        return None
+
+    def open_artifact(self, artifact: dict | None) -> BinaryIO:
+        if artifact is None:
+            raise NotImplementedError
+        # Returned open; upload_artifact closes it.
+        return open(artifact['path'], 'rb')  # noqa: SIM115
+
+    def upload_artifact(self, run: BackupRun, artifact: dict | None, storages: List[Storage]) -> List[FanOutResult]:
+        with self.open_artifact(artifact) as stream:
+            return self.upload_to_storages(stream, run.output_filename, storages)
+
+    def cleanup_artifact(self, artifact: dict | None):
+        if not artifact or not artifact.get('temporary'):
+            return
+        if os.path.isdir(artifact['path']):
+            shutil.rmtree(artifact['path'], ignore_errors=True)
+        elif os.path.exists(artifact['path']):
+            os.remove(artifact['path'])
+
+    def abort_partial_uploads(self):
+        for storage in self.storages:
+            try:
+                storage.abort_partial_uploads()
+            except Exception as e:
+                logger.warning("%s -> failed to abort the partial uploads of %s: %s", type(self).__name__, storage.describe(), e)
+
+    def backup(self):
+        logger.info("%s -> backup", type(self).__name__)
+        started_at = time.monotonic()
+        run = BackupRun(self.get_journal_path(), self.get_output_filename(), self.retry_policies, self.get_metric_labels())
+        artifact = None
+        if run.abandoned is not None:
+            self.cleanup_artifact(run.abandoned.get_result('dump'))
+            self.abort_partial_uploads()
+
+        with log_context(namespace=self.namespace, run_id=run.run_id):
+            try:
+                artifact = run.stage('dump', self.create_artifact, run.output_filename)
+                with log_context(stage='upload'):
+                    self.upload_stage(run, artifact)
+                run.stage('catalog', self.catalog_artifacts, run)
+                if self.retention is not None:
+                    try:
+                        run.stage('prune', self.prune_catalog)
+                    except Exception as e:
+                        # Old artifacts are pruned again by the next run.
+                        logger.warning("%s -> pruning failed: %s", type(self).__name__, e)
+                run.stage('notify', self.notify_success, run)
+            except Exception as e:
+                run.finish(RUN_STATUS_FAILED)
+                if not BackupRun.is_resumable(run.journal):
+                    self.cleanup_artifact(artifact)
+                    self.abort_partial_uploads()
+                self.notify_error(e)
+                flush_notifications()
+                self.record_run(RUN_STATUS_FAILED, time.monotonic() - started_at)
+                raise e
+
+            run.finish(RUN_STATUS_DONE)
+            self.cleanup_artifact(artifact)
+            # Notifications are sent in the background; only wait for them once
+            # the backup itself is complete.
+            flush_notifications()
+            duration = time.monotonic() - started_at
+            self.record_run(RUN_STATUS_DONE, duration)
+            logger.info("%s -> backup done in %.1f seconds", type(self).__name__, duration, extra={'duration': duration})
+
+    def upload_stage(self, run: BackupRun, artifact: dict | None):
+        # Every storage is its own `upload:<storage>` stage. Pending storages
+        # are uploaded together through one fan-out; a retry only targets the
+        # storages that failed, with the upload stage's backoff in between.
+        policy = run.get_policy('upload')
+        attempt = 0
+        started_at = time.monotonic()
+        while True:
+            pending = [storage for storage in self.storages if not run.is_done('upload:%s' % storage.get_key())]
+            if not pending:
+                run.record_stage('upload', time.monotonic() - started_at, attempt)
+                return
+
+            try:
+                results = self.upload_artifact(run, artifact, pending)
+            except Exception as e:
+                results = []
+                for storage in pending:
+                    result = FanOutResult(storage, run.output_filename)
+                    result.error = e
+                    results.append(result)
+
+            for result in results:
+                if result.ok:
+                    self.upload_manifest(run, result)
+
+            failed = []
+            for result in results:
+                if result.ok:
+                    run.mark_done('upload:%s' % result.storage.get_key(), {
+                        'bytes': result.bytes_written,
+                        'duration': result.duration,
+                        'checksum': result.checksum,
+                    })
+                else:
+                    failed.append(result)
+            if not failed:
+                run.record_stage('upload', time.monotonic() - started_at, attempt)
+                return
+
+            attempt += 1
+            errors = '; '.join('%s: %s' % (result.storage.describe(), result.error) for result in failed)
+            if attempt >= policy.times:
+                raise Exception("Upload of `%s` failed in %s of %s storages: %s" % (
+                    run.output_filename, len(failed), len(self.storages), errors,
+                ))
+            delay = policy.get_delay(attempt - 1)
+            logger.warning("Upload failed in %s storages (%s), sleep %.1f seconds", len(failed), errors, delay)
+            time.sleep(delay)
+            logger.info("Retry upload (left attempts: %s) ...", policy.times - attempt)
+
+    def upload_manifest(self, run: BackupRun, result: FanOutResult):
+        # Sidecar with the digests computed while the artifact streamed to
+        # the storage. A storage that did not get it counts as failed.
+        manifest = {
+            'version': 1,
+            'key': run.output_filename,
+            'run_id': run.run_id,
+            'created_at': run.journal.data['started_at'],
+            'codec': self.get_artifact_codec(),
+            'encryption': self.encryption.get_metadata() if self.encryption is not None else None,
+        }
+        if result.digest is not None:
+            manifest.update(result.digest)
+        elif result.files:
+            manifest['files'] = result.files
+        else:
+            return
+        try:
+            result.storage.upload_stream(io.BytesIO(dump_manifest(manifest)), get_manifest_key(run.output_filename))
+        except Exception as e:
+            logger.warning("Upload of the manifest of `%s` failed in %s: %s", run.output_filename, result.storage.describe(), e)
+            result.error = e
+
+    def get_success_digest(self, run: BackupRun) -> str:
+        # One message per run covering every storage.
+        lines = ["💚 Created a %s `%s` for application `%s` in %s storages:" % (
+            self.backup_kind, run.output_filename, self.environment.APP_NAME, len(self.storages),  # type: ignore
+        )]
+        for storage in self.storages:
+            result = run.journal.get_result('upload:%s' % storage.get_key()) or {}
+            lines.append("• `%s` (%.1f MiB in %.1f s)" % (
+                storage.describe(), (result.get('bytes') or 0) / 1024 / 1024, result.get('duration') or 0,
+            ))
+        return '\n'.join(lines)
+
+    def notify_success(self, run: BackupRun):
+        text = self.get_success_digest(run)
+        for notifier in self.notifiers:
+            notifier.notify(text, self.retry_policies['notify'])
+
+    def notify_error(self, error: Exception):
+        app_name = self.environment.APP_NAME  # type: ignore
+        for notifier in self.notifiers:
+            try:
+                notifier.notify("💔 Error: `%s` ```%s```" % (app_name, error), self.retry_policies['notify'])
+            except Exception as e:
+                logger.warning("Failed to send error notification: %s", e)
+
+    # Catalog
+
+    def get_catalog_namespace(self) -> str:
+        return self.namespace or ''
+
+    def get_artifact_codec(self) -> str | None:
+        return self.codec.name if self.codec is not None else None
+
+    def is_prefix_artifact(self) -> bool:
+        # Whether an artifact is a directory of objects (e.g. a pg_dump
+        # directory dump) rather than a single object.
+        return False
+
+    def get_listing_prefix(self) -> str:
+        return '%s_' % self.get_prefix_name()
+
+    def is_own_artifact(self, name: str) -> bool:
+        # Tells this target's artifacts apart from those of namespaces whose
+        # prefix merely starts with the same name. `name` is relative to the
+        # directory of the listing prefix.
+        prefix = '%s_' % self.get_prefix_name().rpartition('/')[2]
+        if not name.startswith(prefix) or name.endswith((ARTIFACT_PARTIAL_SUFFIX, MANIFEST_SUFFIX)):
+            return False
+        return ARTIFACT_TIMESTAMP_PATTERN.match(name, len(prefix)) is not None
+
+    def open_catalog(self) -> Catalog:
+        return Catalog(get_catalog_path(self.environment.STATE_DIR))  # type: ignore
+
+    def catalog_artifacts(self, run: BackupRun):
+        catalog = self.open_catalog()
+        try:
+            for storage in self.storages:
+                result = run.journal.get_result('upload:%s' % storage.get_key()) or {}
+                catalog.record(
+                    self.get_catalog_namespace(),
+                    storage.get_key(),
+                    run.output_filename,
+                    result.get('bytes'),
+                    checksum=result.get('checksum'),
+                    codec=self.get_artifact_codec(),
+                    is_prefix=self.is_prefix_artifact(),
+                    run_id=run.run_id,
+                    created_at=run.journal.data['started_at'],
+                    upload_seconds=result.get('duration'),
+                )
+        finally:
+            catalog.close()
+
+    def prune_catalog(self):
+        catalog = self.open_catalog()
+        try:
+            self.prune(catalog)
+        finally:
+            catalog.close()
+
+    def prune(self, catalog: Catalog, dry_run: bool = False) -> Dict[str, List[dict]]:
+        # Expired artifacts are looked up in the catalog and deleted with one
+        # batched delete per storage; storages are only listed to expand
+        # artifacts that are directories of objects.
+        if self.retention is None:
+            return {}
+        expired_by_storage = {}
+        for storage in self.storages:
+            expired = self.retention.get_expired(catalog.get_artifacts(self.get_catalog_namespace(), storage.get_key()))
+            if not expired:
+                continue
+            expired_by_storage[storage.get_key()] = expired
+            if dry_run:
+                continue
+            keys: List[str] = []
+            for artifact in expired:
+                if artifact['is_prefix']:
+                    keys.extend(item['key'] for item in storage.list(artifact['key'] + '/'))
+                else:
+                    keys.append(artifact['key'])
+                keys.append(get_manifest_key(artifact['key']))
+            logger.info("%s -> prune %s artifacts (%s objects) from %s", type(self).__name__, len(expired), len(keys), storage.describe())
+            storage.delete_many(keys)
+            catalog.remove(storage.get_key(), [artifact['key'] for artifact in expired])
+            get_metrics().inc('backup_pruned_artifacts_total', len(expired), storage=storage.get_key(), **self.get_metric_labels())
+        return expired_by_storage
+
+    def list_artifacts(self, storage: Storage) -> Dict[str, dict]:
+        # Artifacts of this target in a storage listing. Objects below an
+        # artifact's name (directory dumps) are folded into one artifact.
+        listed: Dict[str, dict] = {}
+        prefix = self.get_listing_prefix()
+        directory = prefix.rpartition('/')[0]
+        for item in storage.list(prefix):
+            relative = item['key'][len(directory) + 1:] if directory else item['key']
+            name, _, rest = relative.partition('/')
+            if not self.is_own_artifact(name):
+                continue
+            key = '%s/%s' % (directory, name) if directory else name
+            artifact = listed.setdefault(key, {'size': 0, 'modified': item['modified'], 'is_prefix': bool(rest)})
+            artifact['size'] += item['size']
+            artifact['modified'] = min(artifact['modified'], item['modified'])
+        return listed
+
+    def reconcile(self, catalog: Catalog) -> Dict[str, Dict[str, int]]:
+        # Rebuilds the catalog of every storage from its listing.
+        return {
+            storage.get_key(): catalog.reconcile(self.get_catalog_namespace(), storage.get_key(), self.list_artifacts(storage))
+            for storage in self.storages
+        }
+
+    # Verification
+
+    def verify(self, catalog: Catalog, samples: int = 2) -> Dict[str, Dict[str, str | None]]:
+        # Spot-checks every catalogued artifact against its sidecar manifest.
+        # Returns the error of each artifact, None for those that passed.
+        report: Dict[str, Dict[str, str | None]] = {}
+        for storage in self.storages:
+            report[storage.get_key()] = {}
+            for artifact in catalog.get_artifacts(self.get_catalog_namespace(), storage.get_key()):
+                try:
+                    self.verify_artifact(storage, artifact['key'], samples)
+                    error = None
+                except Exception as e:
+                    error = '%s: %s' % (type(e).__name__, e)
+                report[storage.get_key()][artifact['key']] = error
+                get_metrics().inc(
+                    'backup_verify_total', 1, status='failed' if error else 'ok', storage=storage.get_key(), **self.get_metric_labels(),
+                )
+        return report
+
+    def verify_artifact(self, storage: Storage, key: str, samples: int) -> int:
+        # Sizes and, where the storage has them (S3), ETags are compared from
+        # metadata alone; the content is checked by reading `samples` random
+        # parts and comparing their MD5 with the manifest. Returns the number
+        # of bytes read.
+        with storage.download_stream(get_manifest_key(key)) as stream:
+            manifest = json.loads(stream.read())
+        entries = manifest['files'] if 'files' in manifest else {key: manifest}
+
+        parts: List[Tuple[str, dict, int]] = []
+        for object_key, entry in entries.items():
+            stat = storage.stat(object_key)
+            if stat['size'] != entry['size']:
+                raise IOError("%s has %s bytes, %s expected" % (object_key, stat['size'], entry['size']))
+            if stat.get('etag') and entry.get('etag') and stat['etag'] != entry['etag']:
+                raise IOError("%s has the ETag %s, %s expected" % (object_key, stat['etag'], entry['etag']))
+            parts.extend((object_key, entry, index) for index in range(len(entry['parts'])) if entry['size'])
+
+        bytes_read = 0
+        for object_key, entry, index in random.sample(parts, min(samples, len(parts))):  # nosec B311
+            offset = index * entry['part_size']
+            data = storage.read_range(object_key, offset, min(entry['part_size'], entry['size'] - offset))
+            bytes_read += len(data)
+            if not check_range(entry, index, data):
+                raise IOError("%s is corrupt at bytes %s-%s" % (object_key, offset, offset + len(data) - 1))
+            if self.encryption is not None and object_key.endswith('.' + ENCRYPTION_EXTENSION):
+                # The MD5s only cover the stored ciphertext; decrypting the
+                # same span also proves the configured key still opens it.
+                bytes_read += self.verify_decryption(storage, object_key, entry['size'], offset, len(data))
+        return bytes_read
+
+    def verify_decryption(self, storage: Storage, key: str, size: int, offset: int, length: int) -> int:
+        # Authenticates the chunks covering `length` plaintext bytes at
+        # `offset` of an encrypted artifact. Returns the number of bytes read.
+        fetched = [0]
+
+        def read_range(start: int, count: int) -> bytes:
+            data = storage.read_range(key, start, count)
+            fetched[0] += len(data)
+            return data
+
+        self.encryption.read_range(read_range, size, offset, length)  # type: ignore
+        return fetched[0]
+
+    # Restore
+
+    def restore(self, storage: Storage, key: str, destination: str | None = None, jobs: int = 1) -> RestoreStats:
+        logger.info("%s -> restore('%s') from %s", type(self).__name__, key, storage.describe())
+        stats = RestoreStats(key)
+        self.restore_artifact(storage, key, destination, max(int(jobs), 1), stats)
+        stats.finish({**self.get_metric_labels(), 'storage': storage.get_key()})
+        logger.info("%s -> restored %s", type(self).__name__, stats.describe())
+        try:
+            get_metrics().flush(self.environment.STATE_DIR)  # type: ignore
+        except OSError as e:
+            logger.warning("Failed to write metrics: %s", e)
+        return stats
+
+    def restore_artifact(self, storage: Storage, key: str, destination: str | None, jobs: int, stats: RestoreStats):
+        # `destination` is where the target's data goes back to; targets
+        # restore to their source by default.
+        raise NotImplementedError
+
+    # Pipeline
+
+    def throttled(self, fileobj: BinaryIO) -> BinaryIO:
+        return throttled(fileobj, self.throttles)
+
+    def get_pipeline_suffix(self) -> str:
+        suffix = '.%s' % self.codec.extension if self.codec is not None else ''
+        return suffix + self.get_encryption_suffix()
+
+    def get_encryption_suffix(self) -> str:
+        return '.%s' % ENCRYPTION_EXTENSION if self.encryption is not None else ''
+
+    def get_pipeline_metadata(self, raw: bool = False) -> dict:
+        metadata = self.codec.get_metadata() if self.codec is not None and not raw else {}
+        if self.encryption is not None:
+            metadata.update(self.encryption.get_metadata())
+        return metadata
+
+    def open_pipeline(self, fileobj: BinaryIO, raw: bool = False) -> BinaryIO:
+        # Stages applied to every artifact stream between the target and the
+        # storages. Raw uploads (already compressed pg_dump directories, dedup
+        # chunks and manifests) skip compression but are still encrypted.
+        if self.codec is not None and not raw:
+            fileobj = self.codec.compress(fileobj)
+        if self.encryption is not None:
+            fileobj = self.encryption.encrypt(fileobj)
+        return fileobj
+
+    def upload_to_storages(
+        self,
+        fileobj: BinaryIO,
+        output_filename: str,
+        storages: List[Storage] | None = None,
+        raw: bool = False,
+    ) -> List[FanOutResult]:
+        fan_out = FanOut(self.storages if storages is None else storages)
+        fileobj = self.throttled(fileobj)
+        stream = self.open_pipeline(fileobj, raw)
+        try:
+            results = fan_out.upload(stream, output_filename, self.get_pipeline_metadata(raw) or None)
+        finally:
+            if stream is not fileobj:
+                stream.close()
+        self.record_upload(fan_out, results)
+        return results
+
+    # Metrics
+
+    def get_metric_labels(self) -> Dict[str, str]:
+        return {'namespace': self.namespace or '', 'target': type(self).__name__}
+
+    def record_upload(self, fan_out: FanOut, results: List[FanOutResult]):
+        metrics = get_metrics()
+        labels = self.get_metric_labels()
+        metrics.inc('backup_source_read_seconds_total', fan_out.read_seconds, **labels)
+        metrics.inc('backup_source_bytes_total', fan_out.bytes_read, **labels)
+        for result in results:
+            storage = result.storage.get_key()
+            metrics.inc('backup_storage_bytes_total', result.bytes_written, storage=storage, **labels)
+            metrics.inc('backup_storage_upload_seconds_total', result.duration, storage=storage, **labels)
+            if not result.ok:
+                metrics.inc('backup_storage_upload_errors_total', 1, storage=storage, **labels)
+            elif result.duration > 0:
+                metrics.set('backup_storage_throughput_bytes_per_second', result.bytes_written / result.duration, storage=storage, **labels)
+
+    def record_run(self, status: str, duration: float):
+        metrics = get_metrics()
+        labels = self.get_metric_labels()
+        metrics.inc('backup_runs_total', 1, status=status, **labels)
+        metrics.set('backup_last_duration_seconds', duration, **labels)
+        if status == RUN_STATUS_DONE:
+            metrics.set('backup_last_success_timestamp_seconds', time.time(), **labels)
+        try:
+            metrics.flush(self.environment.STATE_DIR)  # type: ignore
+        except OSError as e:
+            logger.warning("Failed to write metrics: %s", e)
+
+    def upload_file_to_storages(
+        self,
+        path: str,
+        output_filename: str,
+        storages: List[Storage] | None = None,
+        raw: bool = False,
+    ) -> List[FanOutResult]:
+        with open(path, 'rb') as f:
+            return self.upload_to_storages(f, output_filename, storages, raw=raw)
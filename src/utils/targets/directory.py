@@ -1,25 +1,51 @@
+import io
+import json
 import logging
 import os
 import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List
+from typing import BinaryIO, List
 
+from utils.chunking import CHUNK_AVG_SIZE, CHUNK_MAX_SIZE, CHUNK_MIN_SIZE, ContentDefinedChunker
+from utils.chunkstore import ChunkIndex, ChunkStore, get_chunk_path
 from utils.environment import Environment
-from utils.functions import retry_if_exception_for_method
+from utils.fanout import FanOutResult
+from utils.io import get_disk_key, open_tar_stream
 from utils.notifiers.base import Notifier
+from utils.restore import (
+    RESTORE_CHUNK_SIZE,
+    RestoreStats,
+    extract_zip,
+    open_download,
+    remove_path,
+    strip_encryption_suffix,
+)
+from utils.runs import BackupRun
 from utils.storages.base import Storage
 from utils.targets.base import Target
-from utils.io import delete_file_if_exists
 
 logger = logging.getLogger(__name__)
 
 
-TARGET_RETRY_COUNT = 2
-TARGET_RETRY_SLEEP = 5
+# Refuse members that would land outside the destination, where supported.
+TAR_EXTRACT_ARGS: dict = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+
+def get_restore_path(root: str, relative: str) -> str:
+    # Manifest paths are resolved with symlinks already on disk followed, so
+    # neither `..` nor a planted link can lead outside of `root`.
+    path = os.path.realpath(os.path.join(root, relative))
+    if path != root and not path.startswith(root + os.sep):
+        raise ValueError("Refusing to restore %s outside of %s" % (relative, root))
+    return path
 
 
 class DirectoryTarget(Target):
 
+    backup_kind = 'directory backup'
+
     def __init__(
         self,
         dirpath: str,
@@ -27,48 +53,160 @@ class DirectoryTarget(Target):
         notifiers: List[Notifier],
         environment: Environment,
         namespace: str | None,
+        compression: dict | None = None,
+        retry: dict | None = None,
+        throttle: dict | None = None,
+        retention: dict | None = None,
+        encryption: dict | None = None,
+        mode: str = 'archive',
+        index_path: str | None = None,
+        chunk_min_size: int = CHUNK_MIN_SIZE,
+        chunk_avg_size: int = CHUNK_AVG_SIZE,
+        chunk_max_size: int = CHUNK_MAX_SIZE,
     ):
-        super(DirectoryTarget, self).__init__(storages, notifiers, environment, namespace)
+        super(DirectoryTarget, self).__init__(storages, notifiers, environment, namespace, compression, retry, throttle, retention, encryption)
+        if mode not in ('archive', 'dedup'):
+            raise ValueError("Unknown directory backup mode: %s" % mode)
+        if mode == 'dedup' and self.encryption is not None:
+            # Chunks are addressed by the digest of their plaintext and shared
+            # by all snapshots; they are not encrypted.
+            raise ValueError("Encryption is not supported for dedup directory backups")
         self.dirpath = dirpath
+        self.mode = mode
+        self.index_path = index_path or '%s/%s.chunks.sqlite' % (self.environment.STATE_DIR, self.get_prefix_name())  # type: ignore
+        self.chunker = ContentDefinedChunker(int(chunk_min_size), int(chunk_avg_size), int(chunk_max_size))
 
     def get_output_filename(self):
-        if self.namespace is not None:
-            prefix_name = '%s_%s' % (self.environment.APP_NAME, self.namespace)
-        else:
-            prefix_name = self.environment.APP_NAME
-        return '%s_%s.zip' % (prefix_name, datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'))
+        if self.mode == 'dedup':
+            return '%s.dedup/manifests/%s_%s.json' % (
+                self.get_prefix_name(), self.get_prefix_name(), datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'),
+            )
+        if self.codec is not None:
+            return '%s_%s.tar%s' % (self.get_prefix_name(), datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'), self.get_pipeline_suffix())
+        return '%s_%s.zip%s' % (self.get_prefix_name(), datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'), self.get_encryption_suffix())
+
+    def get_resource_keys(self) -> List[str]:
+        keys = [get_disk_key(self.dirpath)]
+        if self.mode == 'archive' and self.codec is None and get_disk_key('/tmp') not in keys:
+            keys.append(get_disk_key('/tmp'))
+        return keys + super(DirectoryTarget, self).get_resource_keys()
+
+    def get_listing_prefix(self) -> str:
+        if self.mode == 'dedup':
+            # Chunks are shared by all snapshots; only manifests are artifacts.
+            return '%s.dedup/manifests/%s_' % (self.get_prefix_name(), self.get_prefix_name())
+        return super(DirectoryTarget, self).get_listing_prefix()
+
+    def get_artifact_codec(self) -> str | None:
+        if self.mode == 'dedup':
+            return None
+        return super(DirectoryTarget, self).get_artifact_codec()
 
     def create_archive(self, filepath: str):
-        logger.info("DirectoryTarget -> create_archive('%s')" % filepath)
+        logger.info("DirectoryTarget -> create_archive('%s')", filepath)
         filename, _ = os.path.splitext(filepath)
         parent_dir = os.path.dirname(self.dirpath)
         relative_dir = os.path.basename(self.dirpath)
         return shutil.make_archive(filename, 'zip', root_dir=parent_dir, base_dir=relative_dir)
 
-    @retry_if_exception_for_method(TARGET_RETRY_COUNT, TARGET_RETRY_SLEEP)
-    def backup(self):
-        logger.info("DirectoryTarget -> backup")
-        app_name = self.environment.APP_NAME
+    def create_artifact(self, output_filename: str) -> dict | None:
+        # With a codec configured the directory is streamed as a tar through
+        # the compression stage, without building a zip in /tmp first.
+        if self.mode == 'dedup' or self.codec is not None:
+            return None
+        temp_path = '/tmp/%s' % strip_encryption_suffix(output_filename)
+        self.create_archive(temp_path)
+        return {'path': temp_path, 'temporary': True}
+
+    def open_artifact(self, artifact: dict | None) -> BinaryIO:
+        if artifact is None:
+            return open_tar_stream(self.dirpath)
+        return super(DirectoryTarget, self).open_artifact(artifact)
 
-        output_filename = self.get_output_filename()
-        temp_path = '/tmp/%s' % output_filename
+    def upload_artifact(self, run: BackupRun, artifact: dict | None, storages: List[Storage]) -> List[FanOutResult]:
+        if self.mode == 'dedup':
+            return self.upload_snapshot(run.output_filename, storages)
+        return super(DirectoryTarget, self).upload_artifact(run, artifact, storages)
+
+    def upload_snapshot(self, manifest_filename: str, storages: List[Storage]) -> List[FanOutResult]:
+        logger.info("DirectoryTarget -> upload_snapshot('%s')", manifest_filename)
+        index = ChunkIndex(self.index_path)
 
         try:
-            self.create_archive(temp_path)
-
-            for storage in self.storages:
-                storage.upload(temp_path, output_filename)
-
-                for notifier in self.notifiers:
-                    notifier.notify(
-                        "💚 Created a directory backup `%s` for application `%s` in storage `%s`" % (output_filename, app_name, storage.describe()),
-                    )
-
-        except Exception as e:
-            for notifier in self.notifiers:
-                notifier.notify(
-                    "💔 Error: `%s` ```%s```" % (app_name, e),
-                )
-            raise e
+            chunk_store = ChunkStore(storages, index, '%s.dedup' % self.get_prefix_name(), self.chunker, throttles=self.throttles)
+            manifest, errors = chunk_store.snapshot(self.dirpath)
         finally:
-            delete_file_if_exists(temp_path)
+            index.close()
+
+        # A snapshot only exists in storages that received all its chunks.
+        complete = [storage for storage in storages if storage.get_key() not in errors]
+        uploaded = iter(self.upload_to_storages(io.BytesIO(json.dumps(manifest).encode()), manifest_filename, complete, raw=True))
+        results = []
+        for storage in storages:
+            if storage in complete:
+                results.append(next(uploaded))
+            else:
+                result = FanOutResult(storage)
+                result.error = errors[storage.get_key()]
+                results.append(result)
+        return results
+
+    def restore_artifact(self, storage: Storage, key: str, destination: str | None, jobs: int, stats: RestoreStats):
+        # Archives hold the directory under its own name, so they are
+        # extracted into the parent of `destination`'s default.
+        destination = destination or os.path.dirname(os.path.normpath(self.dirpath))
+        os.makedirs(destination, exist_ok=True)
+        name = strip_encryption_suffix(key)
+        if name.endswith('.json'):
+            self.restore_snapshot(storage, key, destination, jobs, stats)
+        elif name.endswith('.zip'):
+            # Zip archives keep their index at the end and need random access.
+            temp_path = '/tmp/%s' % os.path.basename(name)
+            try:
+                if name != key:
+                    with open_download(storage, key, stats, self.encryption) as stream, open(temp_path, 'wb') as f:
+                        shutil.copyfileobj(stream, f, RESTORE_CHUNK_SIZE)
+                else:
+                    storage.download(key, temp_path)
+                    stats.add(downloaded=os.path.getsize(temp_path))
+                extract_zip(temp_path, destination, jobs, stats)
+            finally:
+                remove_path(temp_path)
+        else:
+            with open_download(storage, key, stats, self.encryption) as stream, tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    tar.extract(member, destination, **TAR_EXTRACT_ARGS)
+                    if member.isfile():
+                        stats.add(restored=member.size, files=1)
+
+    def restore_snapshot(self, storage: Storage, key: str, destination: str, jobs: int, stats: RestoreStats):
+        # Files of a dedup snapshot are rebuilt from their chunks, several
+        # files at a time.
+        logger.info("DirectoryTarget -> restore_snapshot('%s')", key)
+        with storage.download_stream(key) as stream:
+            data = stream.read()
+        stats.add(downloaded=len(data))
+        manifest = json.loads(data)
+        prefix = key.split('/manifests/')[0]
+        root = get_restore_path(os.path.realpath(destination), manifest['root'])
+        for directory in manifest['directories']:
+            os.makedirs(get_restore_path(root, directory), exist_ok=True)
+
+        def restore_file(entry: dict):
+            path = get_restore_path(root, entry['path'])
+            if path == root:
+                raise ValueError("Refusing to restore %s over %s" % (entry['path'], root))
+            with open(path + '.part', 'wb') as f:
+                for digest in entry['chunks']:
+                    with storage.download_stream(get_chunk_path(prefix, digest)) as chunk_stream:
+                        chunk = chunk_stream.read()
+                    f.write(chunk)
+                    stats.add(downloaded=len(chunk), restored=len(chunk))
+            os.chmod(path + '.part', entry['mode'])
+            os.utime(path + '.part', (entry['mtime'], entry['mtime']))
+            os.replace(path + '.part', path)
+            stats.add(files=1)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in [executor.submit(restore_file, entry) for entry in manifest['files']]:
+                future.result()
@@ -1,24 +1,39 @@
 #!python
 
 
+import io
+import json
 import logging
 import os
-from typing import List
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
 
+from utils.catalog import Catalog
+from utils.delta import DELTA_BLOCK_SIZE, DELTA_FULL_EVERY, DeltaIndex, DeltaReader, decode_extents, read_block
 from utils.environment import Environment
-from utils.functions import retry_if_exception_for_method
+from utils.fanout import FanOutResult, merge_upload_results
+from utils.io import get_disk_key
 from utils.notifiers.base import Notifier
+from utils.restore import RestoreStats, copy_to_file, open_download, strip_encryption_suffix
+from utils.runs import RUN_STATUS_DONE, BackupRun
 from utils.storages.base import Storage
 from utils.targets.base import Target
 
 logger = logging.getLogger(__name__)
 
 
-TARGET_RETRY_COUNT = 2
-TARGET_RETRY_SLEEP = 5
-
-
 class FileTarget(Target):
+    # `mode: full` uploads the whole file on every run and replaces the last
+    # upload. `mode: delta` is for large files that change a little between
+    # runs (SQLite databases, VM images): a run uploads a blob with only the
+    # changed blocks and a manifest mapping every block of the file to the
+    # blob of the run that stored it. Every `full_every`-th run starts a new
+    # chain with a full upload. A run is skipped when the file's size, mtime
+    # and inode are the same as at the last run.
+
+    backup_kind = 'file backup'
 
     def __init__(
         self,
@@ -27,37 +42,216 @@ class FileTarget(Target):
         notifiers: List[Notifier],
         environment: Environment,
         namespace: str | None,
+        compression: dict | None = None,
+        retry: dict | None = None,
+        throttle: dict | None = None,
+        retention: dict | None = None,
+        encryption: dict | None = None,
+        mode: str = 'full',
+        index_path: str | None = None,
+        block_size: int = DELTA_BLOCK_SIZE,
+        full_every: int = DELTA_FULL_EVERY,
     ):
-        super(FileTarget, self).__init__(storages, notifiers, environment, namespace)
+        super(FileTarget, self).__init__(storages, notifiers, environment, namespace, compression, retry, throttle, retention, encryption)
+        if mode not in ('full', 'delta'):
+            raise ValueError("Unknown file backup mode: %s" % mode)
         self.filepath = filepath
+        self.mode = mode
+        self.index_path = index_path or '%s/%s.delta.sqlite' % (self.environment.STATE_DIR, self.get_prefix_name())  # type: ignore
+        self.block_size = int(block_size)
+        self.full_every = max(int(full_every), 1)
 
     def get_output_filename(self):
+        if self.mode == 'delta':
+            return '%s.delta/%s_%s.json%s' % (
+                self.get_prefix_name(), self.get_prefix_name(), datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'), self.get_encryption_suffix(),
+            )
         filename = os.path.basename(self.filepath)
-        if self.namespace is not None:
-            prefix_name = '%s_%s' % (self.environment.APP_NAME, self.namespace)
-        else:
-            prefix_name = self.environment.APP_NAME
-        return '%s_%s' % (prefix_name, filename)
+        return '%s_%s%s' % (self.get_prefix_name(), filename, self.get_pipeline_suffix())
+
+    def get_resource_keys(self) -> List[str]:
+        return [get_disk_key(self.filepath)] + super(FileTarget, self).get_resource_keys()
+
+    def get_listing_prefix(self) -> str:
+        if self.mode == 'delta':
+            # Blobs are shared by the manifests of a chain; only manifests
+            # are artifacts.
+            return '%s.delta/%s_' % (self.get_prefix_name(), self.get_prefix_name())
+        return super(FileTarget, self).get_listing_prefix()
+
+    def is_own_artifact(self, name: str) -> bool:
+        if self.mode == 'delta':
+            return super(FileTarget, self).is_own_artifact(name)
+        # File backups are not timestamped, every run replaces the last one.
+        return name == self.get_output_filename()
+
+    def get_artifact_codec(self) -> str | None:
+        if self.mode == 'delta':
+            return None
+        return super(FileTarget, self).get_artifact_codec()
+
+    def create_artifact(self, output_filename: str) -> dict | None:
+        # The file is uploaded in place and must survive the cleanup.
+        return {'path': self.filepath, 'temporary': False}
+
+    # Delta
+
+    def get_blob_key(self, version: str) -> str:
+        return '%s.delta/blobs/%s.bin%s' % (self.get_prefix_name(), version, self.get_pipeline_suffix())
 
-    @retry_if_exception_for_method(TARGET_RETRY_COUNT, TARGET_RETRY_SLEEP)
     def backup(self):
-        logger.info("FileTarget -> backup")
-        app_name = self.environment.APP_NAME
+        if self.mode == 'delta' and self.is_unchanged():
+            logger.info("FileTarget -> %s is unchanged since the last run, skip", self.filepath)
+            self.record_run(RUN_STATUS_DONE, 0)
+            return
+        super(FileTarget, self).backup()
+
+    def is_unchanged(self) -> bool:
+        stat = os.stat(self.filepath)
+        index = DeltaIndex(self.index_path)
+        try:
+            versions = [index.get_version(storage.get_key()) for storage in self.storages]
+        finally:
+            index.close()
+        return all(
+            version is not None and (version['size'], version['mtime_ns'], version['inode']) == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            for version in versions
+        )
 
+    def upload_artifact(self, run: BackupRun, artifact: dict | None, storages: List[Storage]) -> List[FanOutResult]:
+        if self.mode != 'delta':
+            return super(FileTarget, self).upload_artifact(run, artifact, storages)
+        # Storages holding the same version share one pass over the file.
+        index = DeltaIndex(self.index_path)
         try:
-            output_filename = self.get_output_filename()
-
-            for storage in self.storages:
-                storage.upload(self.filepath, output_filename)
-
-                for notifier in self.notifiers:
-                    notifier.notify(
-                        "💚 Created a file backup `%s` for application `%s` in storage `%s`" % (output_filename, app_name, storage.describe()),
-                    )
-
-        except Exception as e:
-            for notifier in self.notifiers:
-                notifier.notify(
-                    "💔 Error: `%s` ```%s```" % (app_name, e),
-                )
-            raise e
+            groups: Dict[str | None, List[Storage]] = {}
+            for storage in storages:
+                version = index.get_version(storage.get_key())
+                groups.setdefault(version['version'] if version else None, []).append(storage)
+            results = []
+            for group in groups.values():
+                results.extend(self.upload_delta(run, index, group))
+            index.remove_unused()
+        finally:
+            index.close()
+        return results
+
+    def upload_delta(self, run: BackupRun, index: DeltaIndex, storages: List[Storage]) -> List[FanOutResult]:
+        previous = index.get_version(storages[0].get_key())
+        manifest = previous['manifest'] if previous else None
+        if manifest is not None and (manifest['block_size'] != self.block_size or manifest['chain'] + 1 >= self.full_every):
+            manifest = None
+        signatures = index.get_signatures(previous['version']) if manifest is not None and previous is not None else {}
+
+        version = uuid.uuid4().hex
+        blob_key = self.get_blob_key(version)
+        stat = os.stat(self.filepath)
+        logger.info("FileTarget -> upload_delta('%s') against %s", blob_key, manifest['key'] if manifest else 'nothing, full upload')
+        with open(self.filepath, 'rb') as f:
+            reader = DeltaReader(f, stat.st_size, self.block_size, blob_key, manifest, signatures)  # type: ignore
+            with reader:
+                blob_results = self.upload_to_storages(reader, blob_key, storages)  # type: ignore
+        sources, extents = reader.get_extents()
+        new_manifest = {
+            'version': 1,
+            'key': run.output_filename,
+            'path': os.path.basename(self.filepath),
+            'size': stat.st_size,
+            'mode': stat.st_mode & 0o7777,
+            'mtime': stat.st_mtime,
+            'block_size': self.block_size,
+            'base': manifest['key'] if manifest else None,
+            'chain': manifest['chain'] + 1 if manifest else 0,
+            'sources': sources,
+            'extents': extents,
+        }
+        logger.info(
+            "FileTarget -> %s of %s blocks changed (%.1f MiB)",
+            len(reader.new_blocks), len(reader.blocks), reader.changed_bytes / 1024 / 1024,
+        )
+
+        # The manifest only goes to storages that received the blob.
+        complete = [result.storage for result in blob_results if result.ok]
+        manifest_results = self.upload_to_storages(io.BytesIO(json.dumps(new_manifest).encode()), run.output_filename, complete, raw=True) if complete else []
+        results = merge_upload_results(storages, [blob_results, manifest_results])
+        if any(result.ok for result in results):
+            index.add_version(version, reader.signatures)
+        for result in results:
+            if result.ok:
+                index.set_version(result.storage.get_key(), version, new_manifest, stat)
+        index.commit()
+        return results
+
+    def prune(self, catalog: Catalog, dry_run: bool = False) -> Dict[str, List[dict]]:
+        # Blobs that none of the remaining manifests points into are deleted
+        # with them. Blobs newer than the oldest manifest are kept, they may
+        # belong to a run that is still uploading.
+        expired = super(FileTarget, self).prune(catalog, dry_run)
+        if self.mode != 'delta' or self.retention is None or dry_run:
+            return expired
+        for storage in self.storages:
+            artifacts = catalog.get_artifacts(self.get_catalog_namespace(), storage.get_key())
+            if not artifacts:
+                continue
+            used = set()
+            for artifact in artifacts:
+                used.update(self.load_manifest(storage, artifact['key'], RestoreStats(artifact['key']))['sources'])
+            cutoff = min(artifact['created_at'] for artifact in artifacts)
+            keys = [
+                item['key'] for item in storage.list('%s.delta/blobs/' % self.get_prefix_name())
+                if item['key'] not in used and item['modified'] < cutoff
+            ]
+            if keys:
+                logger.info("FileTarget -> prune %s blobs from %s", len(keys), storage.describe())
+                storage.delete_many(keys)
+        return expired
+
+    # Restore
+
+    def load_manifest(self, storage: Storage, key: str, stats: RestoreStats) -> dict:
+        with open_download(storage, key, stats, self.encryption, raw=True) as stream:
+            return json.loads(stream.read())
+
+    def restore_artifact(self, storage: Storage, key: str, destination: str | None, jobs: int, stats: RestoreStats):
+        if strip_encryption_suffix(key).endswith('.json'):
+            self.restore_delta(storage, key, destination or self.filepath, jobs, stats)
+            return
+        with open_download(storage, key, stats, self.encryption) as stream:
+            copy_to_file(stream, destination or self.filepath, stats)
+
+    def restore_delta(self, storage: Storage, key: str, path: str, jobs: int, stats: RestoreStats):
+        # The file is rebuilt from the blobs its manifest points into, several
+        # blobs at a time. Every blob is read once from start to end; holes
+        # are left sparse.
+        logger.info("FileTarget -> restore_delta('%s')", key)
+        manifest = self.load_manifest(storage, key, stats)
+        block_size = manifest['block_size']
+        targets: Dict[str, Dict[int, List[int]]] = {}
+        for index, block in enumerate(decode_extents(manifest)):
+            if block is not None:
+                targets.setdefault(block[0], {}).setdefault(block[1], []).append(index)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        partial_path = path + '.part'
+        fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, manifest['size'])
+
+            def restore_blob(source: str, blocks: Dict[int, List[int]]):
+                with open_download(storage, source, stats, self.encryption) as stream:
+                    for offset in range(max(blocks) + 1):
+                        data = read_block(stream, block_size)
+                        for index in blocks.get(offset, []):
+                            length = min(block_size, manifest['size'] - index * block_size)
+                            os.pwrite(fd, data[:length], index * block_size)
+                            stats.add(restored=length)
+
+            with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+                for future in [executor.submit(restore_blob, source, blocks) for source, blocks in targets.items()]:
+                    future.result()
+        finally:
+            os.close(fd)
+        os.chmod(partial_path, manifest['mode'])
+        os.utime(partial_path, (manifest['mtime'], manifest['mtime']))
+        os.replace(partial_path, path)
+        stats.add(files=1)
@@ -1,25 +1,49 @@
 import logging
 import os
 import shlex
+import shutil
+import subprocess  # nosec B404
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import List
+from typing import BinaryIO, Dict, List
 
+from utils.compression import detect_codec
 from utils.environment import Environment
-from utils.functions import retry_if_exception_for_method
+from utils.fanout import FanOutResult, merge_upload_results
+from utils.io import ProcessOutputReader, get_disk_key, get_open_file_paths
 from utils.notifiers.base import Notifier
+from utils.restore import (
+    RestoreStats,
+    copy_to_file,
+    download_files,
+    open_download,
+    pipe_to_process,
+    remove_path,
+    run_process,
+    strip_encryption_suffix,
+)
+from utils.runs import BackupRun
 from utils.storages.base import Storage
 from utils.targets.base import Target
-from utils.io import delete_file_if_exists
 
 logger = logging.getLogger(__name__)
 
 
-TARGET_RETRY_COUNT = 2
-TARGET_RETRY_SLEEP = 5
+PG_DUMP_PIPE_BUFFER_SIZE = 1024 * 1024
+PG_DUMP_POLL_INTERVAL = 1
+
+PG_DUMP_FORMATS = {
+    'plain': 'sql',
+    'custom': 'dump',
+    'directory': 'dir',
+}
 
 
 class PostgreSQLTarget(Target):
 
+    backup_kind = 'postgresql backup'
+
     def __init__(
         self,
         postgres_host: str,
@@ -31,25 +55,55 @@ class PostgreSQLTarget(Target):
         notifiers: List[Notifier],
         environment: Environment,
         namespace: str | None,
+        compression: dict | None = None,
+        retry: dict | None = None,
+        throttle: dict | None = None,
+        retention: dict | None = None,
+        encryption: dict | None = None,
+        streaming: bool = False,
+        format: str = 'plain',
+        jobs: int = 1,
     ):
-        super(PostgreSQLTarget, self).__init__(storages, notifiers, environment, namespace)
+        super(PostgreSQLTarget, self).__init__(storages, notifiers, environment, namespace, compression, retry, throttle, retention, encryption)
+        if format not in PG_DUMP_FORMATS:
+            raise ValueError("Unknown pg_dump format: %s" % format)
         self.postgres_host = postgres_host
         self.postgres_port = postgres_port
         self.postgres_db = postgres_db
         self.postgres_user = postgres_user
         self.postgres_password = postgres_password
+        self.streaming = streaming
+        self.format = format
+        self.jobs = int(jobs)
+        # Digests of the files of a directory dump every storage received.
+        self.uploaded_files: Dict[str, Dict[str, dict]] = {}
 
     def get_output_filename(self):
-        if self.namespace is not None:
-            prefix_name = '%s_%s' % (self.environment.APP_NAME, self.namespace)
-        else:
-            prefix_name = self.environment.APP_NAME
-        return '%s_%s.sql' % (prefix_name, datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'))
+        output_filename = '%s_%s.%s' % (self.get_prefix_name(), datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'), PG_DUMP_FORMATS[self.format])
+        if self.format == 'directory':
+            # Table files of a directory dump are already compressed by pg_dump.
+            return output_filename
+        return output_filename + self.get_pipeline_suffix()
+
+    def get_resource_keys(self) -> List[str]:
+        keys = ['postgres:%s:%s' % (self.postgres_host, self.postgres_port)]
+        if not self.streaming or self.format == 'directory':
+            keys.append(get_disk_key('/tmp'))
+        return keys + super(PostgreSQLTarget, self).get_resource_keys()
+
+    def get_artifact_codec(self) -> str | None:
+        if self.format == 'directory':
+            return None
+        return super(PostgreSQLTarget, self).get_artifact_codec()
+
+    def is_prefix_artifact(self) -> bool:
+        return self.format == 'directory'
 
     def create_temp_backup_sql(self, path: str):
-        logger.info("PostgreSQLTarget -> create_temp_backup_sql('%s')" % path)
-        exit_code = os.system('PGPASSWORD=%(postgres_password)s pg_dump --no-owner --no-privileges -h %(postgres_host)s -p %(postgres_port)s -U %(postgres_user)s %(postgres_db)s -f %(path)s -F plain' % {  # nosec B605
+        logger.info("PostgreSQLTarget -> create_temp_backup_sql('%s')", path)
+        exit_code = os.system('PGPASSWORD=%(postgres_password)s pg_dump --no-owner --no-privileges -h %(postgres_host)s -p %(postgres_port)s -U %(postgres_user)s %(postgres_db)s -f %(path)s -F %(format)s' % {  # nosec B605
             'path': shlex.quote(path),
+            'format': shlex.quote(self.format),
             'postgres_host': shlex.quote(self.postgres_host),
             'postgres_port': shlex.quote(self.postgres_port),
             'postgres_db': shlex.quote(self.postgres_db),
@@ -59,30 +113,169 @@ class PostgreSQLTarget(Target):
         if exit_code != 0:
             raise Exception("pg_dump failed with the exit code: %s" % exit_code)
 
-    @retry_if_exception_for_method(TARGET_RETRY_COUNT, TARGET_RETRY_SLEEP)
-    def backup(self):
-        logger.info("PostgreSQLTarget -> backup")
-        app_name = self.environment.APP_NAME
+    def get_pg_dump_args(self, *args: str) -> List[str]:
+        return [
+            'pg_dump', '--no-owner', '--no-privileges',
+            '-h', self.postgres_host,
+            '-p', str(self.postgres_port),
+            '-U', self.postgres_user,
+            *args,
+            self.postgres_db,
+        ]
+
+    def get_pg_env(self) -> Dict[str, str]:
+        return {**os.environ, 'PGPASSWORD': self.postgres_password}
+
+    def open_backup_sql_stream(self) -> subprocess.Popen:
+        logger.info("PostgreSQLTarget -> open_backup_sql_stream")
+        return subprocess.Popen(  # nosec B603 B607
+            self.get_pg_dump_args('-F', self.format),
+            stdout=subprocess.PIPE,
+            env=self.get_pg_env(),
+            bufsize=PG_DUMP_PIPE_BUFFER_SIZE,
+        )
+
+    def create_backup_directory(self, path: str, output_dirname: str, executor: ThreadPoolExecutor) -> List[Future]:
+        # pg_dump -Fd writes one file per table from N worker processes. A file
+        # is complete as soon as no process holds it open any more, so it can be
+        # uploaded while the remaining tables are still being dumped. toc.dat is
+        # only valid once pg_dump has exited and goes last.
+        logger.info("PostgreSQLTarget -> create_backup_directory('%s')", path)
+        process = subprocess.Popen(  # nosec B603 B607
+            self.get_pg_dump_args('-F', 'directory', '-j', str(self.jobs), '-f', path),
+            env=self.get_pg_env(),
+        )
+
+        futures: List[Future] = []
+        submitted = set()
 
-        output_filename = self.get_output_filename()
+        def submit_finished_files(finished: bool):
+            if not os.path.isdir(path):
+                return
+            filenames = sorted(os.listdir(path))
+            open_paths = get_open_file_paths(path) if not finished else set()
+            for filename in filenames:
+                filepath = os.path.join(path, filename)
+                if filename in submitted or filepath in open_paths:
+                    continue
+                if filename == 'toc.dat' and not finished:
+                    continue
+                submitted.add(filename)
+                futures.append(executor.submit(self.upload_file_to_storages, filepath, '%s/%s%s' % (output_dirname, filename, self.get_encryption_suffix()), raw=True))
+
+        while process.poll() is None:
+            submit_finished_files(finished=False)
+            time.sleep(PG_DUMP_POLL_INTERVAL)
+
+        if process.returncode != 0:
+            raise Exception("pg_dump failed with the exit code: %s" % process.returncode)
+
+        submit_finished_files(finished=True)
+        return futures
+
+    def create_artifact(self, output_filename: str) -> dict | None:
         temp_path = '/tmp/%s' % output_filename
+        # Databases of a cluster target are named `<namespace>/<database>`.
+        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+        if self.format == 'directory':
+            # pg_dump refuses to write into an existing directory, e.g. one
+            # left behind by a failed attempt.
+            shutil.rmtree(temp_path, ignore_errors=True)
+            self.uploaded_files = {}
+            with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as executor:
+                futures = self.create_backup_directory(temp_path, output_filename, executor)
+                for future in futures:
+                    for result in future.result():
+                        if result.ok:
+                            self.uploaded_files.setdefault(result.storage.get_key(), {})[result.output] = result.digest
+            return {'path': temp_path, 'temporary': True}
+        if self.streaming:
+            return None
+        self.create_temp_backup_sql(temp_path)
+        return {'path': temp_path, 'temporary': True}
+
+    def open_artifact(self, artifact: dict | None) -> BinaryIO:
+        if artifact is None:
+            # A single pg_dump is piped straight into all storages at once,
+            # nothing is staged on the local disk.
+            return ProcessOutputReader(self.open_backup_sql_stream(), 'pg_dump')  # type: ignore
+        return super(PostgreSQLTarget, self).open_artifact(artifact)
+
+    def upload_artifact(self, run: BackupRun, artifact: dict | None, storages: List[Storage]) -> List[FanOutResult]:
+        if self.format != 'directory':
+            return super(PostgreSQLTarget, self).upload_artifact(run, artifact, storages)
+
+        # Upload the table files that did not make it to a storage while
+        # pg_dump was running; toc.dat goes last.
+        path = artifact['path']  # type: ignore
+        filenames = sorted(os.listdir(path), key=lambda filename: filename == 'toc.dat')
+        uploads = []
+        with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as executor:
+            for is_toc in (False, True):
+                futures = []
+                for filename in filenames:
+                    if (filename == 'toc.dat') != is_toc:
+                        continue
+                    output = '%s/%s%s' % (run.output_filename, filename, self.get_encryption_suffix())
+                    missing = [storage for storage in storages if output not in self.uploaded_files.get(storage.get_key(), {})]
+                    if missing:
+                        futures.append(executor.submit(self.upload_file_to_storages, os.path.join(path, filename), output, missing, raw=True))
+                for future in futures:
+                    for result in future.result():
+                        if result.ok:
+                            self.uploaded_files.setdefault(result.storage.get_key(), {})[result.output] = result.digest  # type: ignore
+                    uploads.append(future.result())
+        results = merge_upload_results(storages, uploads)
+        for result in results:
+            # Files uploaded while pg_dump was still running belong in the
+            # sidecar manifest too.
+            result.files = dict(self.uploaded_files.get(result.storage.get_key(), {}))
+        return results
+
+    def get_pg_restore_args(self, database: str, *args: str) -> List[str]:
+        return [
+            'pg_restore', '--no-owner', '--no-privileges',
+            '-h', self.postgres_host,
+            '-p', str(self.postgres_port),
+            '-U', self.postgres_user,
+            '-d', database,
+            *args,
+        ]
 
+    def restore_artifact(self, storage: Storage, key: str, destination: str | None, jobs: int, stats: RestoreStats):
+        # `destination` names the database to restore into. Plain dumps are
+        # streamed into psql and custom dumps into pg_restore. pg_restore can
+        # only run parallel jobs on a seekable archive, so with jobs > 1 a
+        # custom dump is decompressed to /tmp first; directory dumps are
+        # downloaded file by file in parallel.
+        database = destination or self.postgres_db
+        name = strip_encryption_suffix(key)
+        name = os.path.splitext(name)[0] if detect_codec(name) is not None else name
+        extension = os.path.splitext(name)[1].lstrip('.')
+        temp_path = '/tmp/restore_%s' % os.path.basename(name)
         try:
-            self.create_temp_backup_sql(temp_path)
-
-            for storage in self.storages:
-                storage.upload(temp_path, output_filename)
-
-                for notifier in self.notifiers:
-                    notifier.notify(
-                        "💚 Created a postgresql backup `%s` for application `%s` in storage `%s`" % (output_filename, app_name, storage.describe()),
-                    )
-
-        except Exception as e:
-            for notifier in self.notifiers:
-                notifier.notify(
-                    "💔 Error: `%s` ```%s```" % (app_name, e),
-                )
-            raise e
+            if extension == PG_DUMP_FORMATS['directory']:
+                files = {
+                    item['key']: os.path.join(temp_path, strip_encryption_suffix(os.path.relpath(item['key'], key)))
+                    for item in storage.list(key + '/')
+                }
+                if not files:
+                    raise Exception("No files found below %s" % key)
+                download_files(storage, files, jobs, stats, self.encryption)
+                run_process(self.get_pg_restore_args(database, '-F', 'directory', '-j', str(jobs), temp_path), self.get_pg_env(), 'pg_restore')
+            elif extension == PG_DUMP_FORMATS['custom'] and jobs > 1:
+                with open_download(storage, key, stats, self.encryption) as stream:
+                    copy_to_file(stream, temp_path, stats)
+                run_process(self.get_pg_restore_args(database, '-j', str(jobs), temp_path), self.get_pg_env(), 'pg_restore')
+            elif extension == PG_DUMP_FORMATS['custom']:
+                with open_download(storage, key, stats, self.encryption) as stream:
+                    pipe_to_process(stream, self.get_pg_restore_args(database), self.get_pg_env(), 'pg_restore', stats)
+            else:
+                args = [
+                    'psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1',
+                    '-h', self.postgres_host, '-p', str(self.postgres_port), '-U', self.postgres_user, '-d', database,
+                ]
+                with open_download(storage, key, stats, self.encryption) as stream:
+                    pipe_to_process(stream, args, self.get_pg_env(), 'psql', stats)
         finally:
-            delete_file_if_exists(temp_path)
+            remove_path(temp_path)
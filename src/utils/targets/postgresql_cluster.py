@@ -0,0 +1,281 @@
+import fnmatch
+import logging
+import re
+import subprocess  # nosec B404
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import BinaryIO, Dict, List, Tuple
+
+from utils.catalog import Catalog
+from utils.environment import Environment
+from utils.fanout import FanOutResult
+from utils.io import ProcessOutputReader
+from utils.logs import bind_log_context
+from utils.notifiers.base import Notifier
+from utils.restore import RestoreStats
+from utils.runs import BackupRun, RunJournal
+from utils.storages.base import Storage
+from utils.targets.base import ARTIFACT_TIMESTAMP_PATTERN
+from utils.targets.postgresql import PG_DUMP_PIPE_BUFFER_SIZE, PostgreSQLTarget
+
+logger = logging.getLogger(__name__)
+
+
+PG_CLUSTER_CONCURRENCY = 4
+
+# Largest first; template databases and those that refuse connections are
+# skipped, like pg_dumpall does.
+PG_CLUSTER_DATABASES_QUERY = (
+    'SELECT datname, pg_database_size(datname) FROM pg_database '
+    'WHERE datallowconn AND NOT datistemplate ORDER BY 2 DESC'
+)
+
+# `<database>_<timestamp>.` of a database artifact below the cluster's prefix.
+DATABASE_ARTIFACT_PATTERN = re.compile(r'(.+)_%s' % ARTIFACT_TIMESTAMP_PATTERN.pattern)
+
+
+class PostgreSQLClusterTarget(PostgreSQLTarget):
+    # Backs up every database of a cluster in one run. Roles and tablespaces
+    # are dumped once with `pg_dumpall --globals-only`; that dump is this
+    # target's own artifact. Every database is dumped by a PostgreSQLTarget
+    # of its own under the namespace `<namespace>/<database>`, with its own
+    # artifacts, journal, catalog entries and retention. At most
+    # `concurrency` databases are dumped at a time, largest first, so a run
+    # takes about as long as the biggest database rather than all of them.
+
+    backup_kind = 'postgresql cluster backup'
+
+    def __init__(
+        self,
+        postgres_host: str,
+        postgres_port: str,
+        postgres_user: str,
+        postgres_password: str,
+        storages: List[Storage],
+        notifiers: List[Notifier],
+        environment: Environment,
+        namespace: str | None,
+        compression: dict | None = None,
+        retry: dict | None = None,
+        throttle: dict | None = None,
+        retention: dict | None = None,
+        encryption: dict | None = None,
+        postgres_db: str = 'postgres',
+        include: List[str] | None = None,
+        exclude: List[str] | None = None,
+        concurrency: int = PG_CLUSTER_CONCURRENCY,
+        streaming: bool = False,
+        format: str = 'plain',
+        jobs: int = 1,
+    ):
+        if namespace is None:
+            raise ValueError("PostgreSQL cluster targets need a namespace (BACKUP_USE_CONFIG=on)")
+        super(PostgreSQLClusterTarget, self).__init__(
+            postgres_host, postgres_port, postgres_db, postgres_user, postgres_password, storages, notifiers, environment, namespace,
+            compression, retry, throttle, retention, encryption, streaming, format, jobs,
+        )
+        # `postgres_db` is only the maintenance database to connect to.
+        self.include = include or ['*']
+        self.exclude = exclude or []
+        self.concurrency = max(int(concurrency), 1)
+        self.database_config = {'compression': compression, 'retry': retry, 'retention': retention, 'encryption': encryption}
+
+    def get_output_filename(self):
+        return '%s_%s.globals.sql%s' % (self.get_prefix_name(), datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'), self.get_pipeline_suffix())
+
+    def get_artifact_codec(self) -> str | None:
+        return self.codec.name if self.codec is not None else None
+
+    def is_prefix_artifact(self) -> bool:
+        return False
+
+    # Databases
+
+    def get_psql_args(self, *args: str) -> List[str]:
+        return [
+            'psql', '-X', '-A', '-t', '-F', '\t',
+            '-h', self.postgres_host,
+            '-p', str(self.postgres_port),
+            '-U', self.postgres_user,
+            '-d', self.postgres_db,
+            *args,
+        ]
+
+    def is_included(self, database: str) -> bool:
+        if not any(fnmatch.fnmatchcase(database, pattern) for pattern in self.include):
+            return False
+        return not any(fnmatch.fnmatchcase(database, pattern) for pattern in self.exclude)
+
+    def discover_databases(self) -> List[Tuple[str, int]]:
+        # (name, size in bytes) of the databases to back up, largest first.
+        logger.info("PostgreSQLClusterTarget -> discover_databases")
+        process = subprocess.run(  # nosec B603 B607
+            self.get_psql_args('-c', PG_CLUSTER_DATABASES_QUERY),
+            env=self.get_pg_env(),
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if process.returncode != 0:
+            raise Exception("psql failed with the exit code: %s" % process.returncode)
+        databases: List[Tuple[str, int]] = []
+        for line in process.stdout.splitlines():
+            name, _, size = line.rpartition('\t')
+            if name and self.is_included(name):
+                databases.append((name, int(size or 0)))
+        databases.sort(key=lambda database: database[1], reverse=True)
+        logger.info("PostgreSQLClusterTarget -> %s databases: %s" % (len(databases), ', '.join(name for name, _ in databases)))
+        return databases
+
+    def get_database_namespace(self, database: str) -> str:
+        return '%s/%s' % (self.namespace, database)
+
+    def build_database_target(self, database: str) -> PostgreSQLTarget:
+        target = PostgreSQLTarget(
+            self.postgres_host, self.postgres_port, database, self.postgres_user, self.postgres_password,
+            storages=self.storages,
+            notifiers=[],
+            environment=self.environment,
+            namespace=self.get_database_namespace(database),
+            streaming=self.streaming,
+            format=self.format,
+            jobs=self.jobs,
+            **self.database_config,
+        )
+        # All databases share the cluster's throttle instead of one each.
+        target.throttles = self.throttles
+        return target
+
+    def get_database_targets(self, catalog: Catalog) -> List[PostgreSQLTarget]:
+        # Databases the catalog has artifacts of, including dropped ones.
+        prefix = self.get_database_namespace('')
+        return [self.build_database_target(namespace[len(prefix):]) for namespace in catalog.get_namespaces(prefix)]
+
+    def get_artifact_database(self, key: str) -> str | None:
+        prefix = '%s/' % self.get_prefix_name()
+        if not key.startswith(prefix):
+            return None
+        match = DATABASE_ARTIFACT_PATTERN.match(key, len(prefix))
+        return match.group(1) if match else None
+
+    def backup_database(self, database: str) -> dict:
+        started_at = time.monotonic()
+        target = self.build_database_target(database)
+        target.backup()
+        journal = RunJournal.load(target.get_journal_path())
+        uploads = [journal.get_result('upload:%s' % storage.get_key()) or {} for storage in self.storages] if journal else []
+        return {
+            'output_filename': journal.data['output_filename'] if journal else None,
+            'bytes': max([upload.get('bytes') or 0 for upload in uploads] or [0]),
+            'duration': time.monotonic() - started_at,
+        }
+
+    def backup_databases(self, run: BackupRun):
+        # Databases that completed are checkpointed in the cluster's journal,
+        # so a resumed run only dumps the remaining ones.
+        databases = run.stage('discover', self.discover_databases)
+        if not databases:
+            logger.warning("PostgreSQLClusterTarget -> no databases match %s (excluding %s)" % (self.include, self.exclude))
+        pending = [name for name, _ in databases if not run.is_done('database:%s' % name)]
+        errors: Dict[str, Exception] = {}
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(bind_log_context(self.backup_database), name): name for name in pending}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    run.mark_done('database:%s' % name, future.result())
+                except Exception as e:
+                    logger.error("PostgreSQLClusterTarget -> backup of database `%s` failed: %s" % (name, e))
+                    errors[name] = e
+        run.record_stage('databases', time.monotonic() - started_at, 0)
+        if errors:
+            raise Exception("Backup of %s of %s databases failed: %s" % (
+                len(errors), len(databases), '; '.join('%s: %s' % (name, error) for name, error in errors.items()),
+            ))
+
+    # Stages
+
+    def create_artifact(self, output_filename: str) -> dict | None:
+        # The globals are small and always streamed.
+        return None
+
+    def open_artifact(self, artifact: dict | None) -> BinaryIO:
+        logger.info("PostgreSQLClusterTarget -> open_globals_stream")
+        process = subprocess.Popen(  # nosec B603 B607
+            [
+                'pg_dumpall', '--globals-only',
+                '-h', self.postgres_host,
+                '-p', str(self.postgres_port),
+                '-U', self.postgres_user,
+                '-l', self.postgres_db,
+            ],
+            stdout=subprocess.PIPE,
+            env=self.get_pg_env(),
+            bufsize=PG_DUMP_PIPE_BUFFER_SIZE,
+        )
+        return ProcessOutputReader(process, 'pg_dumpall')  # type: ignore
+
+    def upload_stage(self, run: BackupRun, artifact: dict | None):
+        # The databases go first: when one of them fails, the run fails
+        # before the globals are uploaded, catalogued and announced.
+        self.backup_databases(run)
+        super(PostgreSQLClusterTarget, self).upload_stage(run, artifact)
+
+    def upload_artifact(self, run: BackupRun, artifact: dict | None, storages: List[Storage]) -> List[FanOutResult]:
+        # The globals are a single plain dump whatever the databases' format.
+        with self.open_artifact(artifact) as stream:
+            return self.upload_to_storages(stream, run.output_filename, storages)
+
+    def get_success_digest(self, run: BackupRun) -> str:
+        lines = [super(PostgreSQLClusterTarget, self).get_success_digest(run)]
+        for name, _ in run.journal.get_result('discover') or []:
+            result = run.journal.get_result('database:%s' % name) or {}
+            lines.append("• database `%s`: `%s` (%.1f MiB in %.1f s)" % (
+                name, result.get('output_filename'), (result.get('bytes') or 0) / 1024 / 1024, result.get('duration') or 0,
+            ))
+        return '\n'.join(lines)
+
+    # Catalog
+
+    def prune(self, catalog: Catalog, dry_run: bool = False) -> Dict[str, List[dict]]:
+        expired = super(PostgreSQLClusterTarget, self).prune(catalog, dry_run)
+        for target in self.get_database_targets(catalog):
+            for storage, artifacts in target.prune(catalog, dry_run).items():
+                expired.setdefault(storage, []).extend(artifacts)
+        return expired
+
+    def reconcile(self, catalog: Catalog) -> Dict[str, Dict[str, int]]:
+        # Databases are found in the catalog and in the storage listings, so
+        # a fresh catalog learns about all of them.
+        stats = super(PostgreSQLClusterTarget, self).reconcile(catalog)
+        databases = {target.postgres_db for target in self.get_database_targets(catalog)}
+        prefix = '%s/' % self.get_prefix_name()
+        for storage in self.storages:
+            for item in storage.list(prefix):
+                match = DATABASE_ARTIFACT_PATTERN.match(item['key'], len(prefix))
+                if match:
+                    databases.add(match.group(1))
+        for database in sorted(databases):
+            for storage_key, counts in self.build_database_target(database).reconcile(catalog).items():
+                for name, count in counts.items():
+                    stats[storage_key][name] += count
+        return stats
+
+    def verify(self, catalog: Catalog, samples: int = 2) -> Dict[str, Dict[str, str | None]]:
+        report = super(PostgreSQLClusterTarget, self).verify(catalog, samples)
+        for target in self.get_database_targets(catalog):
+            for storage, errors in target.verify(catalog, samples).items():
+                report.setdefault(storage, {}).update(errors)
+        return report
+
+    # Restore
+
+    def restore_artifact(self, storage: Storage, key: str, destination: str | None, jobs: int, stats: RestoreStats):
+        # A database artifact goes back into its database (or `destination`),
+        # the globals are replayed with psql.
+        database = self.get_artifact_database(key)
+        if database is None:
+            super(PostgreSQLClusterTarget, self).restore_artifact(storage, key, destination, jobs, stats)
+            return
+        self.build_database_target(database).restore_artifact(storage, key, destination, jobs, stats)
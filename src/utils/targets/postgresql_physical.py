@@ -0,0 +1,325 @@
+import logging
+import os
+import shlex
+import subprocess  # nosec B404
+import sys
+import time
+from datetime import datetime
+from typing import BinaryIO, Dict, List, Set
+
+from utils.catalog import Catalog
+from utils.compression import detect_codec
+from utils.environment import ENVIRONMENT_PREFIX, Environment
+from utils.io import ProcessOutputReader
+from utils.metrics import get_metrics
+from utils.notifiers.base import Notifier
+from utils.restore import RestoreStats, copy_to_file, extract_tar_stream, open_download, strip_encryption_suffix
+from utils.storages.base import Storage
+from utils.targets.postgresql import PG_DUMP_PIPE_BUFFER_SIZE, PostgreSQLTarget
+
+logger = logging.getLogger(__name__)
+
+
+# pg_basebackup can only write a tar to stdout without streaming the WAL.
+PG_BASEBACKUP_WAL_METHODS = ('fetch', 'none')
+PG_BASEBACKUP_CHECKPOINTS = ('fast', 'spread')
+
+WAL_RECEIVE_POLL_INTERVAL = 1
+WAL_RECEIVE_MAX_RESTART_DELAY = 60
+# WAL segments are kept a while longer than the oldest base backup, in case
+# the clocks of the host and of the storage disagree.
+WAL_PRUNE_MARGIN = 60 * 60
+WAL_PARTIAL_SUFFIX = '.partial'
+WAL_HISTORY_SUFFIX = '.history'
+
+# Settings of the restore command written into a restored data directory.
+# Secrets (an inline BACKUP_CONFIG, BACKUP_ENCRYPTION_KEY) never end up in
+# postgresql.auto.conf; set `restore_command` when the server needs them.
+WAL_RESTORE_COMMAND_ENVS = ['APP_NAME', 'USE_CONFIG', 'CONFIG_FILE', 'STATE_DIR']
+WAL_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'wal.py')
+
+
+class PostgreSQLPhysicalTarget(PostgreSQLTarget):
+    # Physical backups of a whole cluster. A scheduled run streams a tar of
+    # `pg_basebackup` through the pipeline into the storages, nothing is
+    # staged on the local disk. Between base backups, WAL segments are
+    # shipped to the same storages under `<prefix>/wal/` as they fill, either
+    # by `wal.py archive` as the server's archive_command or by `wal.py
+    # receive` running pg_receivewal. A restore unpacks a base backup and
+    # lets the server replay the archived WAL up to any point in time.
+
+    backup_kind = 'postgresql base backup'
+
+    def __init__(
+        self,
+        postgres_host: str,
+        postgres_port: str,
+        postgres_user: str,
+        postgres_password: str,
+        storages: List[Storage],
+        notifiers: List[Notifier],
+        environment: Environment,
+        namespace: str | None,
+        compression: dict | None = None,
+        retry: dict | None = None,
+        throttle: dict | None = None,
+        retention: dict | None = None,
+        encryption: dict | None = None,
+        postgres_db: str = 'postgres',
+        wal_method: str = 'fetch',
+        checkpoint: str = 'fast',
+        slot: str | None = None,
+        restore_command: str | None = None,
+    ):
+        super(PostgreSQLPhysicalTarget, self).__init__(
+            postgres_host, postgres_port, postgres_db, postgres_user, postgres_password, storages, notifiers, environment, namespace,
+            compression, retry, throttle, retention, encryption, streaming=True,
+        )
+        if wal_method not in PG_BASEBACKUP_WAL_METHODS:
+            raise ValueError("Unknown pg_basebackup WAL method: %s, one of: %s" % (wal_method, ', '.join(PG_BASEBACKUP_WAL_METHODS)))
+        if checkpoint not in PG_BASEBACKUP_CHECKPOINTS:
+            raise ValueError("Unknown pg_basebackup checkpoint: %s, one of: %s" % (checkpoint, ', '.join(PG_BASEBACKUP_CHECKPOINTS)))
+        # `wal_method: fetch` makes every base backup restorable on its own,
+        # `none` relies on the WAL archive.
+        self.wal_method = wal_method
+        self.checkpoint = checkpoint
+        self.slot = slot
+        self.restore_command = restore_command
+        # Set by the restore CLI for a point-in-time recovery.
+        self.recovery_target_time: str | None = None
+
+    def get_output_filename(self):
+        return '%s_%s.base.tar%s' % (self.get_prefix_name(), datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ'), self.get_pipeline_suffix())
+
+    # Base backups
+
+    def get_pg_basebackup_args(self, label: str) -> List[str]:
+        return [
+            'pg_basebackup',
+            '-h', self.postgres_host,
+            '-p', str(self.postgres_port),
+            '-U', self.postgres_user,
+            '-D', '-',
+            '-F', 'tar',
+            '-X', self.wal_method,
+            '-c', self.checkpoint,
+            '-l', label,
+        ]
+
+    def create_artifact(self, output_filename: str) -> dict | None:
+        return None
+
+    def open_artifact(self, artifact: dict | None) -> BinaryIO:
+        logger.info("PostgreSQLPhysicalTarget -> open_basebackup_stream")
+        process = subprocess.Popen(  # nosec B603 B607
+            self.get_pg_basebackup_args(self.get_prefix_name()),
+            stdout=subprocess.PIPE,
+            env=self.get_pg_env(),
+            bufsize=PG_DUMP_PIPE_BUFFER_SIZE,
+        )
+        return ProcessOutputReader(process, 'pg_basebackup')  # type: ignore
+
+    # WAL
+
+    def get_wal_prefix(self) -> str:
+        return '%s/wal/' % self.get_prefix_name()
+
+    def get_wal_key(self, name: str) -> str:
+        # Timeline history files are tiny and stay uncompressed.
+        if name.endswith(WAL_HISTORY_SUFFIX):
+            return '%s%s%s' % (self.get_wal_prefix(), name, self.get_encryption_suffix())
+        return '%s%s%s' % (self.get_wal_prefix(), name, self.get_pipeline_suffix())
+
+    def get_wal_name(self, key: str) -> str:
+        name = strip_encryption_suffix(key[len(self.get_wal_prefix()):])
+        return os.path.splitext(name)[0] if detect_codec(name) is not None else name
+
+    def find_wal_key(self, storage: Storage, name: str) -> str | None:
+        # Segments archived before the compression or encryption settings
+        # changed are stored under other extensions.
+        for item in storage.list(self.get_wal_prefix() + name):
+            if self.get_wal_name(item['key']) == name:
+                return item['key']
+        return None
+
+    def has_wal(self, storage: Storage, key: str) -> bool:
+        try:
+            storage.stat(key)
+        except Exception:
+            return False
+        return True
+
+    def archive_wal(self, path: str):
+        # Uploads a finished WAL segment (or history file) to every storage
+        # that does not have it yet. Postgres retries an archive_command
+        # after a failure, so archiving a segment twice must succeed.
+        name = os.path.basename(path)
+        key = self.get_wal_key(name)
+        missing = [storage for storage in self.storages if not self.has_wal(storage, key)]
+        if not missing:
+            logger.info("PostgreSQLPhysicalTarget -> %s is already archived" % name)
+            return
+        logger.info("PostgreSQLPhysicalTarget -> archive_wal('%s') to %s storages" % (name, len(missing)))
+        failed = [result for result in self.upload_file_to_storages(path, key, missing, raw=name.endswith(WAL_HISTORY_SUFFIX)) if not result.ok]
+        if failed:
+            raise Exception("Archiving of `%s` failed in %s of %s storages: %s" % (
+                name, len(failed), len(missing), '; '.join('%s: %s' % (result.storage.describe(), result.error) for result in failed),
+            ))
+        metrics = get_metrics()
+        metrics.inc('backup_wal_segments_total', 1, action='archive', **self.get_metric_labels())
+        metrics.set('backup_wal_last_archived_timestamp_seconds', time.time(), **self.get_metric_labels())
+
+    def fetch_wal(self, name: str, path: str) -> bool:
+        # The restore_command side: False when no storage has the file, which
+        # is how postgres learns that the archive ends here.
+        for storage in self.storages:
+            try:
+                key = self.find_wal_key(storage, name)
+                if key is None:
+                    continue
+                stats = RestoreStats(key)
+                with open_download(storage, key, stats, self.encryption) as stream:
+                    copy_to_file(stream, path, stats)
+            except Exception as e:
+                logger.warning("PostgreSQLPhysicalTarget -> fetching %s from %s failed: %s" % (name, storage.describe(), e))
+                continue
+            get_metrics().inc('backup_wal_segments_total', 1, action='fetch', **self.get_metric_labels())
+            return True
+        logger.info("PostgreSQLPhysicalTarget -> %s is not archived" % name)
+        return False
+
+    def get_wal_spool_path(self) -> str:
+        return '%s/wal/%s' % (self.environment.STATE_DIR, self.get_prefix_name())  # type: ignore
+
+    def get_pg_receivewal_args(self, *args: str) -> List[str]:
+        return [
+            'pg_receivewal',
+            '-h', self.postgres_host,
+            '-p', str(self.postgres_port),
+            '-U', self.postgres_user,
+            *(['-S', self.slot] if self.slot else []),
+            *args,
+        ]
+
+    def archive_spooled_wal(self, spool_path: str, archived: Set[str]):
+        # pg_receivewal writes the current segment as `<name>.partial` and
+        # renames it once it is full. The newest archived segment stays in
+        # the spool so that a restarted pg_receivewal continues after it.
+        names = sorted(name for name in os.listdir(spool_path) if not name.endswith(WAL_PARTIAL_SUFFIX) and not name.startswith('.'))
+        for name in names:
+            if name in archived:
+                continue
+            try:
+                self.archive_wal(os.path.join(spool_path, name))
+            except Exception as e:
+                # Left in the spool and retried with the next poll.
+                logger.error("PostgreSQLPhysicalTarget -> %s" % e)
+                break
+            archived.add(name)
+        segments = [name for name in names if name in archived and not name.endswith(WAL_HISTORY_SUFFIX)]
+        for name in segments[:-1]:
+            os.remove(os.path.join(spool_path, name))
+            archived.discard(name)
+
+    def receive_wal(self):
+        # Runs until interrupted: streams the WAL with pg_receivewal into a
+        # spool directory below BACKUP_STATE_DIR and archives every segment
+        # as soon as it is complete. pg_receivewal is restarted with the
+        # backoff of the `default` retry policy when it exits.
+        spool_path = self.get_wal_spool_path()
+        os.makedirs(spool_path, exist_ok=True)
+        if self.slot:
+            exit_code = subprocess.call(self.get_pg_receivewal_args('--create-slot', '--if-not-exists'), env=self.get_pg_env())  # nosec B603
+            if exit_code != 0:
+                raise Exception("pg_receivewal --create-slot failed with the exit code: %s" % exit_code)
+        policy = self.retry_policies['default']
+        archived: Set[str] = set()
+        failures = 0
+        while True:
+            logger.info("PostgreSQLPhysicalTarget -> receive_wal('%s')" % spool_path)
+            process = subprocess.Popen(self.get_pg_receivewal_args('-D', spool_path, '-n'), env=self.get_pg_env())  # nosec B603
+            try:
+                while process.poll() is None:
+                    self.archive_spooled_wal(spool_path, archived)
+                    self.flush_metrics()
+                    time.sleep(WAL_RECEIVE_POLL_INTERVAL)
+            finally:
+                if process.poll() is None:
+                    process.terminate()
+                    process.wait()
+            count = len(archived)
+            self.archive_spooled_wal(spool_path, archived)
+            failures = 0 if len(archived) > count else failures + 1
+            delay = min(policy.get_delay(failures), WAL_RECEIVE_MAX_RESTART_DELAY)
+            logger.warning("pg_receivewal exited with the exit code: %s, restart in %.1f seconds" % (process.returncode, delay))
+            time.sleep(delay)
+
+    def prune(self, catalog: Catalog, dry_run: bool = False) -> Dict[str, List[dict]]:
+        # WAL older than the oldest base backup that is left is of no use.
+        # History files are kept, a recovery asks for all of them.
+        expired = super(PostgreSQLPhysicalTarget, self).prune(catalog, dry_run)
+        if self.retention is None:
+            return expired
+        for storage in self.storages:
+            artifacts = catalog.get_artifacts(self.get_catalog_namespace(), storage.get_key())
+            if dry_run:
+                artifacts = [artifact for artifact in artifacts if artifact not in expired.get(storage.get_key(), [])]
+            if not artifacts:
+                continue
+            cutoff = min(artifact['created_at'] for artifact in artifacts) - WAL_PRUNE_MARGIN
+            keys = [
+                item['key'] for item in storage.list(self.get_wal_prefix())
+                if item['modified'] < cutoff and not self.get_wal_name(item['key']).endswith(WAL_HISTORY_SUFFIX)
+            ]
+            if not keys:
+                continue
+            logger.info("%s -> %s %s WAL files from %s" % (type(self).__name__, 'would prune' if dry_run else 'prune', len(keys), storage.describe()))
+            if not dry_run:
+                storage.delete_many(keys)
+        return expired
+
+    # Restore
+
+    def get_restore_command(self) -> str:
+        if self.restore_command:
+            return self.restore_command
+        envs = [
+            '%s%s=%s' % (ENVIRONMENT_PREFIX, name, shlex.quote(getattr(self.environment, name)))
+            for name in WAL_RESTORE_COMMAND_ENVS if getattr(self.environment, name)
+        ]
+        args = [sys.executable, WAL_SCRIPT_PATH, 'fetch', *(['-n', self.namespace] if self.namespace is not None else [])]
+        return '%s %s %%f %%p' % (' '.join(envs), ' '.join(shlex.quote(arg) for arg in args))
+
+    def write_recovery_config(self, data_path: str):
+        settings = {'restore_command': self.get_restore_command()}
+        if self.recovery_target_time is not None:
+            settings['recovery_target_time'] = self.recovery_target_time
+            settings['recovery_target_action'] = 'promote'
+        with open(os.path.join(data_path, 'postgresql.auto.conf'), 'a') as f:
+            f.write('\n# Added by the backup restore\n')
+            for name, value in settings.items():
+                f.write("%s = '%s'\n" % (name, value.replace("'", "''")))
+        with open(os.path.join(data_path, 'recovery.signal'), 'w'):
+            pass
+
+    def restore_artifact(self, storage: Storage, key: str, destination: str | None, jobs: int, stats: RestoreStats):
+        # `destination` is the data directory of the restored cluster; it must
+        # be empty and the server stopped. The base backup is unpacked as it
+        # downloads and the server is set up to replay the WAL archive (up to
+        # recovery_target_time) on its next start.
+        if destination is None:
+            raise ValueError("A base backup is restored into a data directory, set it with -o")
+        if os.path.isdir(destination) and os.listdir(destination):
+            raise ValueError("%s is not empty" % destination)
+        os.makedirs(destination, exist_ok=True)
+        os.chmod(destination, 0o700)
+        with open_download(storage, key, stats, self.encryption) as stream:
+            extract_tar_stream(stream, destination, stats)
+        self.write_recovery_config(destination)
+        logger.info("PostgreSQLPhysicalTarget -> start the server on %s to replay the WAL" % destination)
+
+    def flush_metrics(self):
+        try:
+            get_metrics().flush(self.environment.STATE_DIR)  # type: ignore
+        except OSError as e:
+            logger.warning("Failed to write metrics: %s" % e)
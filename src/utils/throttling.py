@@ -0,0 +1,160 @@
+import fcntl
+import hashlib
+import io
+import logging
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import BinaryIO, List
+
+logger = logging.getLogger(__name__)
+
+
+THROTTLE_BUCKET_FORMAT = '<dd'
+THROTTLE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rate(value: str | int | float | None) -> float | None:
+    # Bytes per second, e.g. 1048576, '512k', '20M' or '1.5G'. None, 0 and
+    # 'off' mean unlimited.
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) or None
+    value = value.strip().lower()
+    if value in ('', 'off', 'none', 'unlimited'):
+        return None
+    for suffix in ('/s', 'b', 'i'):
+        value = value.removesuffix(suffix)
+    unit = value[-1] if value[-1] in THROTTLE_UNITS else ''
+    number = value[:-1] if unit else value
+    return float(number) * THROTTLE_UNITS[unit] or None
+
+
+def parse_time(value: str) -> int:
+    hours, _, minutes = str(value).partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+class TokenBucket:
+    # Token bucket whose state (tokens, last refill) lives in a small file in
+    # the state directory. Every consumer, in any worker process, takes the
+    # tokens it needs under an flock, so all processes share one budget.
+    # Consumers may drive the bucket negative; they then sleep until the debt
+    # is paid off, which keeps the lock held only for a read and a write.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd: int | None = None
+        self.pid: int | None = None
+
+    def get_fd(self) -> int:
+        # flock is held per open file description, so every process (and not
+        # a forked copy of the parent's descriptor) needs its own.
+        if self.fd is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+        return self.fd
+
+    def consume(self, amount: int, rate: float, burst: float):
+        with self.lock:
+            fd = self.get_fd()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                now = time.monotonic()
+                data = os.pread(fd, struct.calcsize(THROTTLE_BUCKET_FORMAT), 0)
+                if len(data) == struct.calcsize(THROTTLE_BUCKET_FORMAT):
+                    tokens, updated_at = struct.unpack(THROTTLE_BUCKET_FORMAT, data)
+                    # A timestamp from the future comes from before a reboot.
+                    elapsed = now - updated_at if updated_at <= now else burst / rate
+                    tokens = min(burst, tokens + elapsed * rate)
+                else:
+                    tokens = burst
+                tokens -= amount
+                os.pwrite(fd, struct.pack(THROTTLE_BUCKET_FORMAT, tokens, now), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+
+
+class Throttle:
+    # A rate limit with optional time-of-day profiles, e.g.
+    #
+    #   throttle:
+    #     rate: 50M
+    #     profiles:
+    #     - {from: '08:00', to: '19:00', rate: 5M}
+    #
+    # A profile that spans midnight (`from` later than `to`) is allowed. The
+    # first matching profile wins; outside of all profiles `rate` applies.
+
+    def __init__(self, name: str, bucket: TokenBucket, rate: float | None, burst: float | None, profiles: List[dict]):
+        self.name = name
+        self.bucket = bucket
+        self.rate = rate
+        self.burst = burst
+        self.profiles = [
+            (parse_time(profile['from']), parse_time(profile['to']), parse_rate(profile.get('rate')), parse_rate(profile.get('burst')))
+            for profile in profiles
+        ]
+
+    @classmethod
+    def from_config(cls, config: str | int | dict | None, name: str, state_dir: str) -> 'Throttle | None':
+        if config is None:
+            return None
+        if not isinstance(config, dict):
+            config = {'rate': config}
+        if not config.get('rate') and not config.get('profiles'):
+            return None
+        path = '%s/throttle/%s.bucket' % (state_dir, hashlib.sha1(name.encode(), usedforsecurity=False).hexdigest()[:16])
+        return cls(name, TokenBucket(path), parse_rate(config.get('rate')), parse_rate(config.get('burst')), config.get('profiles') or [])
+
+    def get_limits(self) -> tuple:
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate, burst in self.profiles:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate, burst
+        return self.rate, self.burst
+
+    def consume(self, amount: int):
+        rate, burst = self.get_limits()
+        if rate is None or amount <= 0:
+            return
+        # By default the bucket holds one second worth of tokens.
+        self.bucket.consume(amount, rate, burst or rate)
+
+
+class ThrottledReader(io.RawIOBase):
+    # Passes reads through to `fileobj`, waiting on every throttle for the
+    # bytes read. The wrapped file object is left open on close.
+
+    def __init__(self, fileobj: BinaryIO, throttles: List[Throttle]):
+        self.fileobj = fileobj
+        self.throttles = throttles
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if hasattr(self.fileobj, 'readinto'):
+            size = self.fileobj.readinto(buffer)
+        else:
+            data = self.fileobj.read(len(buffer))
+            size = len(data)
+            buffer[:size] = data
+        for throttle in self.throttles:
+            throttle.consume(size or 0)
+        return size
+
+
+def throttled(fileobj: BinaryIO, throttles: List[Throttle | None]) -> BinaryIO:
+    active = [throttle for throttle in throttles if throttle is not None]
+    if not active:
+        return fileobj
+    return ThrottledReader(fileobj, active)  # type: ignore
@@ -0,0 +1,73 @@
+#!python
+
+
+import argparse
+import contextlib
+import logging
+import sys
+
+import urllib3
+from utils.builders import TargetBuilder
+from utils.config import Config
+from utils.environment import Environment
+from utils.targets.postgresql_physical import PostgreSQLPhysicalTarget
+
+urllib3.disable_warnings()
+
+# Logging
+
+handler = logging.StreamHandler()
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter('[PID: %(process)d] - %(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+
+logging.basicConfig(level=logging.INFO, handlers=[handler])
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    # archive_command = 'python /app/wal.py archive -n <namespace> %p'
+    # restore_command = 'python /app/wal.py fetch -n <namespace> %f %p'
+    parser = argparse.ArgumentParser(description="Ship the WAL of a postgresql_physical namespace to its storages and back.")
+    parser.add_argument('-n', '--namespace', help="namespace of the config (required with BACKUP_USE_CONFIG=on)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    archive = commands.add_parser('archive', help="archive one finished WAL file (archive_command)")
+    archive.add_argument('path', help="path of the WAL file (%%p)")
+    fetch = commands.add_parser('fetch', help="fetch one archived WAL file, exit with 1 when it is not archived (restore_command)")
+    fetch.add_argument('name', help="name of the WAL file (%%f)")
+    fetch.add_argument('path', help="path to write it to (%%p)")
+    commands.add_parser('receive', help="stream the WAL with pg_receivewal and archive every finished segment")
+    args = parser.parse_args()
+
+    environment = Environment()
+    namespaces = Config.load_namespaces(environment)
+    if args.namespace is None and None not in namespaces:
+        parser.error("--namespace is required, one of: %s" % ', '.join(namespaces))
+    if args.namespace is not None and args.namespace not in namespaces:
+        parser.error("Unknown namespace `%s`" % args.namespace)
+
+    target = TargetBuilder(namespaces[args.namespace], environment, args.namespace).build()
+    if not isinstance(target, PostgreSQLPhysicalTarget):
+        parser.error("Namespace `%s` is not a postgresql_physical target" % (args.namespace or '-'))
+
+    if args.command == 'receive':
+        with contextlib.suppress(KeyboardInterrupt):
+            target.receive_wal()
+        return
+    try:
+        if args.command == 'archive':
+            target.archive_wal(args.path)
+            found = True
+        else:
+            found = target.fetch_wal(args.name, args.path)
+    except Exception as e:
+        logger.error("%s of %s failed: %s" % (args.command.capitalize(), args.path, e))
+        found = False
+    finally:
+        target.flush_metrics()
+    sys.exit(0 if found else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The packages live in src/ and are imported as top-level modules, the way
+# the entry points in there import them.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
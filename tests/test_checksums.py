@@ -0,0 +1,78 @@
+import hashlib
+import io
+import os
+
+import pytest
+from utils.checksums import StreamDigest, check_range
+
+PART_SIZE = 5 * 1024 * 1024
+THRESHOLD = 6 * 1024 * 1024
+
+
+def get_s3_etag(data: bytes, threshold: int, part_size: int) -> str:
+    # How S3 derives ETags: the MD5 of a single PUT, or the MD5 of the parts'
+    # MD5s with the number of parts for multipart uploads.
+    if len(data) < threshold or not data:
+        return hashlib.md5(data, usedforsecurity=False).hexdigest()
+    parts = [data[offset:offset + part_size] for offset in range(0, len(data), part_size)]
+    digests = b''.join(hashlib.md5(part, usedforsecurity=False).digest() for part in parts)
+    return '%s-%s' % (hashlib.md5(digests, usedforsecurity=False).hexdigest(), len(parts))
+
+
+def digest(data: bytes, part_size: int, update_size: int) -> StreamDigest:
+    result = StreamDigest(part_size)
+    for offset in range(0, len(data), update_size):
+        result.update(data[offset:offset + update_size])
+    return result
+
+
+@pytest.mark.parametrize('size', [0, 1, 999, 1000, 1001, 4000, 4321])
+@pytest.mark.parametrize('update_size', [1, 7, 1000, 4096])
+def test_etag(size, update_size):
+    data = os.urandom(size)
+    result = digest(data, 1000, update_size)
+    assert result.size == size
+    assert result.get_checksum() == 'sha256:%s' % hashlib.sha256(data).hexdigest()
+    assert result.get_etag(1000) == get_s3_etag(data, 1000, 1000)
+    if size <= 1000:
+        # Single PUTs are predictable when they fit in one part.
+        assert result.get_etag(10000) == get_s3_etag(data, 10000, 1000)
+    else:
+        assert result.get_etag(10000) is None
+
+
+def test_manifest_ranges():
+    data = os.urandom(4321)
+    manifest = digest(data, 1000, 333).get_manifest()
+    assert manifest['size'] == 4321 and manifest['part_size'] == 1000
+    assert len(manifest['parts']) == 5
+    for index in range(5):
+        assert check_range(manifest, index, data[index * 1000:(index + 1) * 1000])
+    assert not check_range(manifest, 0, data[1:1001])
+
+
+@pytest.mark.parametrize('size', [0, 1024, THRESHOLD - 1, THRESHOLD, PART_SIZE * 3, PART_SIZE * 2 + 12345])
+def test_etag_parity_with_s3(size):
+    moto = pytest.importorskip('moto')
+    import boto3
+    from utils.environment import Environment
+    from utils.fanout import FanOut
+    from utils.storages.aws import AWSStorage
+
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='backups')
+        storage = AWSStorage(
+            'backups', 'us-east-1', 'test', 'test', Environment(), None,
+            multipart_threshold=THRESHOLD, multipart_chunksize=PART_SIZE,
+        )
+        data = os.urandom(size)
+        results = FanOut([storage]).upload(io.BytesIO(data), 'artifact')
+        assert results[0].ok, results[0].error
+        stored = storage.stat('artifact')
+        assert stored['size'] == size
+        assert stored['etag'] == get_s3_etag(data, THRESHOLD, PART_SIZE)
+        if PART_SIZE < size < THRESHOLD:
+            # A single PUT larger than a part: its MD5 is not computed.
+            assert results[0].digest['etag'] is None
+        else:
+            assert results[0].digest['etag'] == stored['etag']
@@ -0,0 +1,52 @@
+import io
+import random
+
+from utils.chunking import ContentDefinedChunker
+
+MIN_SIZE = 2 * 1024
+AVG_SIZE = 8 * 1024
+MAX_SIZE = 32 * 1024
+
+
+def get_chunks(data: bytes) -> list:
+    chunker = ContentDefinedChunker(MIN_SIZE, AVG_SIZE, MAX_SIZE)
+    return [chunk for _, chunk in chunker.iter_chunks(io.BytesIO(data))]
+
+
+def get_data(size: int, seed: int = 1) -> bytes:
+    return random.Random(seed).randbytes(size)  # nosec B311
+
+
+def test_chunks_cover_the_data():
+    data = get_data(1024 * 1024)
+    chunks = get_chunks(data)
+    assert b''.join(chunks) == data
+    assert all(MIN_SIZE <= len(chunk) <= MAX_SIZE for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= MAX_SIZE
+
+
+def test_boundaries_are_deterministic():
+    data = get_data(512 * 1024)
+    assert get_chunks(data) == get_chunks(data)
+
+
+def test_boundaries_survive_inserts():
+    data = get_data(1024 * 1024)
+    before = get_chunks(data)
+    middle = len(data) // 2
+    after = get_chunks(data[:middle] + get_data(100, seed=2) + data[middle:])
+    # Only the chunks around the insertion change; the ones before it and
+    # (once the boundaries resync) the ones after it are the same.
+    unchanged = set(before) & set(after)
+    assert len(unchanged) >= len(before) - 3
+    assert before[0] == after[0] and before[-1] == after[-1]
+
+
+def test_runs_of_zeroes_are_split():
+    chunks = get_chunks(bytes(256 * 1024))
+    assert b''.join(chunks) == bytes(256 * 1024)
+    assert all(len(chunk) <= MAX_SIZE for chunk in chunks)
+
+
+def test_empty():
+    assert get_chunks(b'') == []
@@ -0,0 +1,84 @@
+import os
+from typing import Dict, Tuple
+
+from utils.delta import DeltaReader, decode_extents
+
+BLOCK_SIZE = 4096
+
+
+def write(path: str, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def backup(path: str, source: str, blobs: Dict[str, bytes], previous: dict | None = None, signatures: dict | None = None) -> Tuple[DeltaReader, dict]:
+    # One run of the file target's delta mode: the new blocks go to the blob
+    # `source`, the manifest points into it and into older blobs.
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        reader = DeltaReader(f, size, BLOCK_SIZE, source, previous, signatures)
+        blobs[source] = reader.read()
+        sources, extents = reader.get_extents()
+        reader.close()
+    return reader, {'size': size, 'block_size': BLOCK_SIZE, 'sources': sources, 'extents': extents}
+
+
+def restore(manifest: dict, blobs: Dict[str, bytes]) -> bytes:
+    data = bytearray(manifest['size'])
+    for index, block in enumerate(decode_extents(manifest)):
+        if block is None:
+            continue
+        source, offset = block
+        start = index * BLOCK_SIZE
+        length = min(BLOCK_SIZE, manifest['size'] - start)
+        data[start:start + length] = blobs[source][offset * BLOCK_SIZE:offset * BLOCK_SIZE + length]
+    return bytes(data)
+
+
+def test_full_then_delta(tmp_path):
+    path = str(tmp_path / 'file')
+    blobs: Dict[str, bytes] = {}
+    original = os.urandom(BLOCK_SIZE * 20 + 123)
+    write(path, original)
+    first, first_manifest = backup(path, 'v1', blobs)
+    assert restore(first_manifest, blobs) == original
+    assert first.changed_bytes == len(original)
+
+    changed = bytearray(original)
+    # One block changed, one block moved to another aligned offset, one block
+    # zeroed and the file grown.
+    changed[BLOCK_SIZE * 3 + 10] ^= 0xff
+    changed[BLOCK_SIZE * 10:BLOCK_SIZE * 11] = original[BLOCK_SIZE * 15:BLOCK_SIZE * 16]
+    changed[BLOCK_SIZE * 12:BLOCK_SIZE * 13] = bytes(BLOCK_SIZE)
+    changed += os.urandom(BLOCK_SIZE * 2)
+    write(path, bytes(changed))
+    _, second_manifest = backup(path, 'v2', blobs, first_manifest, first.signatures)
+    assert restore(second_manifest, blobs) == bytes(changed)
+    # The changed block, the last block of v1 (now full) and the new tail.
+    assert len(blobs['v2']) == BLOCK_SIZE * 3 + 123
+    assert restore(first_manifest, blobs) == original
+
+
+def test_unchanged_file_stores_nothing(tmp_path):
+    path = str(tmp_path / 'file')
+    blobs: Dict[str, bytes] = {}
+    write(path, os.urandom(BLOCK_SIZE * 4))
+    first, first_manifest = backup(path, 'v1', blobs)
+    second, second_manifest = backup(path, 'v2', blobs, first_manifest, first.signatures)
+    assert blobs['v2'] == b''
+    assert second.changed_bytes == 0
+    assert second_manifest['sources'] == ['v1']
+
+
+def test_sparse_file(tmp_path):
+    path = str(tmp_path / 'file')
+    blobs: Dict[str, bytes] = {}
+    data = os.urandom(BLOCK_SIZE)
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.seek(BLOCK_SIZE * 50)
+        f.write(data)
+    _, manifest = backup(path, 'v1', blobs)
+    # Holes are left out and the repeated block is stored once.
+    assert len(blobs['v1']) == BLOCK_SIZE
+    assert restore(manifest, blobs) == data + bytes(BLOCK_SIZE * 49) + data
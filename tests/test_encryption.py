@@ -0,0 +1,72 @@
+import io
+import os
+
+import pytest
+from utils.encryption import ENCRYPTION_TAG_SIZE, HEADER_SIZE, Encryption, EncryptionError
+
+CHUNK_SIZE = 1000
+
+
+def encrypt(encryption: Encryption, data: bytes) -> bytes:
+    with encryption.encrypt(io.BytesIO(data)) as stream:
+        return stream.read()
+
+
+def decrypt(encryption: Encryption, data: bytes) -> bytes:
+    with encryption.decrypt(io.BytesIO(data)) as stream:
+        return stream.read()
+
+
+@pytest.fixture
+def encryption() -> Encryption:
+    return Encryption(os.urandom(32), key_id='test', chunk_size=CHUNK_SIZE, threads=2)
+
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, CHUNK_SIZE * 5 + 17])
+def test_round_trip(encryption, size):
+    data = os.urandom(size)
+    assert decrypt(encryption, encrypt(encryption, data)) == data
+
+
+def test_wrong_key(encryption):
+    encrypted = encrypt(encryption, os.urandom(CHUNK_SIZE * 2))
+    with pytest.raises(EncryptionError):
+        decrypt(Encryption(os.urandom(32), key_id='test', chunk_size=CHUNK_SIZE), encrypted)
+
+
+@pytest.mark.parametrize('cut', [1, CHUNK_SIZE])
+def test_truncated(encryption, cut):
+    encrypted = encrypt(encryption, os.urandom(CHUNK_SIZE * 3))
+    with pytest.raises(EncryptionError):
+        decrypt(encryption, encrypted[:-cut])
+
+
+def test_tampered(encryption):
+    encrypted = bytearray(encrypt(encryption, os.urandom(CHUNK_SIZE * 3)))
+    encrypted[-CHUNK_SIZE] ^= 1
+    with pytest.raises(EncryptionError):
+        decrypt(encryption, bytes(encrypted))
+
+
+@pytest.mark.parametrize('offset, length', [
+    (0, 10),
+    (0, CHUNK_SIZE * 5 + 17),
+    (CHUNK_SIZE - 5, 10),
+    (CHUNK_SIZE * 2, CHUNK_SIZE),
+    (CHUNK_SIZE * 5, 17),
+    (CHUNK_SIZE * 5 + 10, 100),
+    (CHUNK_SIZE * 7, 10),
+])
+def test_read_range(encryption, offset, length):
+    data = os.urandom(CHUNK_SIZE * 5 + 17)
+    encrypted = encrypt(encryption, data)
+    requests = []
+
+    def read_range(start: int, count: int) -> bytes:
+        requests.append((start, count))
+        return encrypted[start:start + count]
+
+    assert encryption.read_range(read_range, len(encrypted), offset, length) == data[offset:offset + length]
+    # Only the header and the chunks covering the range are fetched.
+    chunks = len(range(offset // CHUNK_SIZE, min(offset + length - 1, len(data)) // CHUNK_SIZE + 1))
+    assert sum(count for _, count in requests) <= HEADER_SIZE + len('test') + chunks * (CHUNK_SIZE + ENCRYPTION_TAG_SIZE)
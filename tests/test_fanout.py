@@ -0,0 +1,85 @@
+import io
+import os
+import threading
+import time
+from typing import BinaryIO
+
+from utils.environment import Environment
+from utils.fanout import FanOut
+from utils.storages.local import LocalStorage
+
+
+class FailingStorage(LocalStorage):
+
+    def upload_stream(self, fileobj: BinaryIO, output: str, metadata: dict | None = None):
+        fileobj.read(1024)
+        raise IOError("disk on fire")
+
+
+class SlowStorage(LocalStorage):
+
+    def __init__(self, *args, **kwargs):
+        super(SlowStorage, self).__init__(*args, **kwargs)
+        self.release = threading.Event()
+
+    def upload_stream(self, fileobj: BinaryIO, output: str, metadata: dict | None = None):
+        self.release.wait()
+        super(SlowStorage, self).upload_stream(fileobj, output, metadata)
+
+
+def read(storage: LocalStorage, key: str) -> bytes:
+    with storage.download_stream(key) as stream:
+        return stream.read()
+
+
+def test_upload_to_every_storage(tmp_path):
+    storages = [LocalStorage(str(tmp_path / name), Environment(), None) for name in ('a', 'b', 'c')]
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    fanout = FanOut(storages, chunk_size=64 * 1024)
+    results = fanout.upload(io.BytesIO(data), 'dir/artifact')
+    assert fanout.bytes_read == len(data)
+    for storage, result in zip(storages, results):
+        assert result.ok, result.error
+        assert result.bytes_written == len(data)
+        assert result.digest['size'] == len(data)
+        assert read(storage, 'dir/artifact') == data
+
+
+def test_failed_storage_does_not_stop_the_others(tmp_path):
+    good = LocalStorage(str(tmp_path / 'good'), Environment(), None)
+    bad = FailingStorage(str(tmp_path / 'bad'), Environment(), None)
+    data = os.urandom(1024 * 1024)
+    results = FanOut([bad, good], chunk_size=4096, queue_size=2).upload(io.BytesIO(data), 'artifact')
+    assert not results[0].ok and 'disk on fire' in str(results[0].error)
+    assert results[1].ok
+    assert read(good, 'artifact') == data
+
+
+def test_source_error_reaches_every_storage(tmp_path):
+
+    class BrokenSource(io.RawIOBase):
+
+        def readable(self):
+            return True
+
+        def readinto(self, buffer):
+            raise IOError("dump failed")
+
+    storages = [LocalStorage(str(tmp_path / name), Environment(), None) for name in ('a', 'b')]
+    results = FanOut(storages).upload(BrokenSource(), 'artifact')  # type: ignore
+    assert all(not result.ok for result in results)
+
+
+def test_queues_bound_the_read_ahead(tmp_path):
+    slow = SlowStorage(str(tmp_path / 'slow'), Environment(), None)
+    fast = LocalStorage(str(tmp_path / 'fast'), Environment(), None)
+    data = os.urandom(1024 * 1024)
+    fanout = FanOut([slow, fast], chunk_size=4096, queue_size=4)
+    thread = threading.Thread(target=fanout.upload, args=(io.BytesIO(data), 'artifact'))
+    thread.start()
+    time.sleep(0.2)
+    # The source is only read as far as the slow storage's queue allows.
+    assert fanout.bytes_read <= 4096 * 6
+    slow.release.set()
+    thread.join()
+    assert read(slow, 'artifact') == read(fast, 'artifact') == data
@@ -0,0 +1,27 @@
+import pytest
+from utils.throttling import parse_rate
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    (0, None),
+    ('', None),
+    ('off', None),
+    ('Unlimited', None),
+    (1048576, 1048576.0),
+    (0.5, 0.5),
+    ('100', 100.0),
+    ('512k', 512 * 1024.0),
+    ('512KiB', 512 * 1024.0),
+    ('20M', 20 * 1024 ** 2.0),
+    ('20mb/s', 20 * 1024 ** 2.0),
+    ('1.5G', 1.5 * 1024 ** 3),
+    (' 2g ', 2 * 1024 ** 3.0),
+])
+def test_parse_rate(value, expected):
+    assert parse_rate(value) == expected
+
+
+def test_parse_rate_invalid():
+    with pytest.raises(ValueError):
+        parse_rate('fast')